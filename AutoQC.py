@@ -1,6 +1,15 @@
-import arcpy
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import metrics
+from geometry_backend import MemoryTable, get_backend, get_spatial_reference, get_vertex_arrays, get_xy, search_cursor
+from hausdorff import directed_hausdorff, hausdorff_distance_pairs
 
 """
 Compare the following to create a confidence score:
@@ -20,22 +29,26 @@ log.setLevel(logging.DEBUG) # Set the debug level here
 fileHandler = logging.FileHandler(f'AutoQC.log', mode='w')
 log.addHandler(fileHandler)
 
+# Geometry backend used to create points.  See set_backend
+backend = get_backend()
+
+# get_confidence_scores uses every core for at least this many segments
+PARALLEL_MIN_SEGMENTS = 5000
+
+
+def set_backend(name=None):
+    """ Sets the geometry backend used to score segments, 'arcpy' or 'numpy' """
+    global backend
+    backend = get_backend(name)
+
+
 def hausdorff_distance(geom1, geom2, normalized):
-    distances = []
-    for part in geom1:
-        for point in part:
-            point = arcpy.PointGeometry(point, arcpy.SpatialReference(3969))
-            distances.append(point.distanceTo(geom2))
-    
     # Normalize by reducing each distance by minimum distance.  This will "move" the
     # closest parts of geom1 and geom2 together to better compare geometry shape
-    if normalized:
-        distances = [dist - min(distances) for dist in distances]
-
-    hausdorff = max(distances)
-    return hausdorff
+    return directed_hausdorff(geom1, geom2, normalized=normalized)
 
 
+@metrics.timed('AutoQC.is_similar_shape')
 def is_similar_shape(geom1, geom2, normalized=False):
     if not geom1:
         return False, None
@@ -57,21 +70,21 @@ def get_bearing(begin, end):
 
 
 def compare_bearing(XDGeom, geom2, part):
-    XDGeom_Begin = arcpy.PointGeometry(XDGeom.firstPoint)
-    XDGeom_End = arcpy.PointGeometry(XDGeom.lastPoint)
+    XDGeom_Begin = backend.PointGeometry(XDGeom.firstPoint)
+    XDGeom_End = backend.PointGeometry(XDGeom.lastPoint)
 
     # Conflation geom's direction is not preserved after dissolving.  Try to find
     # the correct start point based on distance from XDGeom_Begin
 
-    geom2_firstPoint = arcpy.PointGeometry(geom2.firstPoint)
-    geom2_lastPoint = arcpy.PointGeometry(geom2.lastPoint)
+    geom2_firstPoint = backend.PointGeometry(geom2.firstPoint)
+    geom2_lastPoint = backend.PointGeometry(geom2.lastPoint)
 
     if XDGeom_Begin.distanceTo(geom2_firstPoint) < XDGeom_Begin.distanceTo(geom2_lastPoint):
-        geom2_Begin = arcpy.PointGeometry(geom2.firstPoint)
-        geom2_End = arcpy.PointGeometry(geom2.lastPoint)
+        geom2_Begin = backend.PointGeometry(geom2.firstPoint)
+        geom2_End = backend.PointGeometry(geom2.lastPoint)
     else:
-        geom2_Begin = arcpy.PointGeometry(geom2.lastPoint)
-        geom2_End = arcpy.PointGeometry(geom2.firstPoint)
+        geom2_Begin = backend.PointGeometry(geom2.lastPoint)
+        geom2_End = backend.PointGeometry(geom2.firstPoint)
 
 
 
@@ -99,18 +112,19 @@ def add_confidence_field(conflationLayer, scores):
     # Create dictionary containing scores by XDSegID
     scoreDict = {}
     for score in scores:
-        scoreDict[score['XDSegID']] = score['confidence']
+        scoreDict[int(score['XDSegID'])] = score['confidence']
     
     # Add scores to conflation layer
     with arcpy.da.UpdateCursor(conflationLayer, ['XDSegID', 'confidence']) as cur:
         for row in cur:
-            XDSegID = row[0]
+            XDSegID = int(row[0])
             if XDSegID in scoreDict.keys():
                 row[1] = scoreDict[XDSegID]
                 cur.updateRow(row)
     
 
 
+@metrics.timed('AutoQC.get_confidence_score')
 def get_confidence_score(XDSegID, XDGeom, conflationGeom):
     """
     
@@ -140,8 +154,8 @@ def get_confidence_score(XDSegID, XDGeom, conflationGeom):
     isSimilarShapeNormalized, hausorffDistanceNormalized = is_similar_shape(conflationGeom, XDGeom, normalized=True)
     
     # Location
-    XDCentroid = arcpy.PointGeometry(XDGeom.centroid, arcpy.SpatialReference(3969))
-    conflationCentroid = arcpy.PointGeometry(conflationGeom.centroid, arcpy.SpatialReference(3969))
+    XDCentroid = backend.PointGeometry(XDGeom.centroid, backend.SpatialReference(3969))
+    conflationCentroid = backend.PointGeometry(conflationGeom.centroid, backend.SpatialReference(3969))
     centroidDifference = round(XDCentroid.distanceTo(conflationCentroid))
 
     # Bearing
@@ -199,54 +213,261 @@ def get_confidence_score(XDSegID, XDGeom, conflationGeom):
     return finalScore
 
 
-def run_AutoQC(conflationName, inputXD, inputConflation, outputCSV):
-    fileHandler = logging.FileHandler(f'Logs\{conflationName}_AutoQC.log', mode='w')
-    log.addHandler(fileHandler)
+def get_summary(geom):
+    """ Returns (length, first x, first y, last x, last y, mid x, mid y, centroid x, centroid y)
+        of a polyline, read with the same geometry methods as get_confidence_score """
+    first = geom.firstPoint
+    last = geom.lastPoint
+    midX, midY = get_xy(geom.positionAlongLine(0.5, 'TRUE'))
+    centroid = geom.centroid
+    return geom.getLength(), first.X, first.Y, last.X, last.Y, midX, midY, centroid.X, centroid.Y
 
-    conflation = r'memory\conflation'
 
-    arcpy.env.overwriteOutput = True
+def get_bearings(beginX, beginY, endX, endY):
+    """ Array version of get_bearing """
+    return np.round(np.degrees(np.arctan2(endX - beginX, endY - beginY)))
 
-    # Make dissolved copy of input conflation in memory
-    arcpy.Dissolve_management(inputConflation, conflation, 'XDSegID')
 
-    # List XDs in dissolved layer
-    XDs = [row[0] for row in arcpy.da.SearchCursor(conflation, 'XDSegID')]
+def get_shape_distances(conflationParts, XDParts, workers=1):
+    """ Returns the hausdorff_distance_pairs of the conflation and XD vertex arrays, split
+        across worker processes if workers > 1 """
+    if workers <= 1 or len(XDParts) < workers:
+        return hausdorff_distance_pairs(conflationParts, XDParts)
 
+    chunkSize = -(-len(XDParts) // (workers * 4))
+    starts = range(0, len(XDParts), chunkSize)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            hausdorff_distance_pairs,
+            [conflationParts[i:i + chunkSize] for i in starts],
+            [XDParts[i:i + chunkSize] for i in starts]
+        ))
 
+    return tuple(
+        tuple(np.concatenate([result[direction][stat] for result in results]) for stat in range(2))
+        for direction in range(2)
+    )
 
-    # Build dictionary of geometries
-    print('Building XDGeomDict')
-    XDGeomDict = {int(row[0]): row[1] for row in arcpy.da.SearchCursor(inputXD, ['XDSegID','SHAPE@'])}
 
+@metrics.timed('AutoQC.get_confidence_scores')
+def get_confidence_scores(XDSegIDs, XDGeoms, conflationGeoms, workers=None):
+    """
+    Bulk version of get_confidence_score.  Each geometry is read once, into vertex arrays
+    and its length, end points, mid-point and centroid, and the length, shape, location
+    and bearing tests of every segment are computed together with array math.  The scores
+    are the same as get_confidence_score.
 
-    
-    print('Building ConflationGeomDict')
-    ConflationGeomDict = {int(row[0]): row[1] for row in arcpy.da.SearchCursor(conflation, ['XDSegID','SHAPE@'])}
- 
-    output = []
-    for XD in XDs:
-        log.debug(f'\n\n=== Processing {XD} ===')
+    inputs:
+        XDSegIDs (list) - The XD Segment IDs
+        XDGeoms (list) - The geometry of each XD segment
+        conflationGeoms (list) - The dissolved conflation geometry of each XD segment
+        workers (int) - Processes used for the hausdorff distances.  Defaults to every core
+                        for PARALLEL_MIN_SEGMENTS or more segments, and to 1 otherwise
+    output:
+        list of confidence scores, in the order of XDSegIDs
+    """
+    scores = [None] * len(XDSegIDs)
+    bulk = []
+    XDSummary = []
+    conflationSummary = []
+    for i, (XDSegID, XDGeom, conflationGeom) in enumerate(zip(XDSegIDs, XDGeoms, conflationGeoms)):
+        # Segments without conflation geometry, or with an empty XD geometry, get the scalar
+        # result (or error)
+        if not conflationGeom or not XDGeom or round(XDGeom.getLength(), 2) == 0:
+            scores[i] = get_confidence_score(XDSegID, XDGeom, conflationGeom)
+            continue
+
+        bulk.append(i)
+        XDSummary.append(get_summary(XDGeom))
+        conflationSummary.append(get_summary(conflationGeom))
+
+    if not bulk:
+        return scores
+
+    XD = np.array(XDSummary).T
+    conflation = np.array(conflationSummary).T
 
-        # Get geometries
-        XDGeom = XDGeomDict[XD]
-        ConflationGeom = ConflationGeomDict[XD]
+    # Length
+    XDLen = [round(length, 2) for length in XD[0].tolist()]
+    conflationLen = [round(length, 2) for length in conflation[0].tolist()]
+    totalLengthDifference = np.array([round(abs(a - b), 2) for a, b in zip(XDLen, conflationLen)])
+    totalLengthRatio = np.array([round(b / a, 2) for a, b in zip(XDLen, conflationLen)])
+    isSimilarLength = (0.75 <= totalLengthRatio) & (totalLengthRatio <= 1.25)
 
-        confidence = get_confidence_score(XD, XDGeom, ConflationGeom)
+    # Shape
+    workers = workers or (os.cpu_count() if len(bulk) >= PARALLEL_MIN_SEGMENTS else 1)
+    (max1, min1), (max2, min2) = get_shape_distances(
+        [get_vertex_arrays(conflationGeoms[i]) for i in bulk],
+        [get_vertex_arrays(XDGeoms[i]) for i in bulk],
+        workers
+    )
+    hausdorffDistance = np.array([round(min(a, b), 2) for a, b in zip(max1.tolist(), max2.tolist())])
+    hausdorffDistanceNormalized = np.array([round(min(a, b), 2) for a, b in zip((max1 - min1).tolist(), (max2 - min2).tolist())])
+    isSimilarShape = (hausdorffDistance < conflation[0] / 10) & (hausdorffDistance < 10)
+    isSimilarShapeNormalized = (hausdorffDistanceNormalized < conflation[0] / 10) & (hausdorffDistanceNormalized < 10)
+
+    # Location
+    centroidDifference = np.round(np.hypot(conflation[7] - XD[7], conflation[8] - XD[8]))
+
+    # Bearing.  The conflation geometry starts at the end closest to the XD begin point.
+    isForward = np.hypot(conflation[1] - XD[1], conflation[2] - XD[2]) < np.hypot(conflation[3] - XD[1], conflation[4] - XD[2])
+    beginX, beginY = np.where(isForward, conflation[1], conflation[3]), np.where(isForward, conflation[2], conflation[4])
+    endX, endY = np.where(isForward, conflation[3], conflation[1]), np.where(isForward, conflation[4], conflation[2])
+    XDBearings = [get_bearings(XD[1], XD[2], XD[3], XD[4]), get_bearings(XD[1], XD[2], XD[5], XD[6]), get_bearings(XD[5], XD[6], XD[3], XD[4])]
+    conflationBearings = [get_bearings(beginX, beginY, endX, endY), get_bearings(beginX, beginY, conflation[5], conflation[6]), get_bearings(conflation[5], conflation[6], endX, endY)]
+    segmentBearing = [np.abs(a - b) for a, b in zip(XDBearings, conflationBearings)]
+    isSimilarBearing = segmentBearing[0] + segmentBearing[1] + segmentBearing[2] <= 30
+
+    ### Calculate final score: ###
+    finalScore = np.ones(len(bulk))
+
+    subtraction = [
+        np.where(totalLengthDifference < 100, 0, 0.1),
+        np.where(isSimilarLength, 0, 0.3),
+        np.where(isSimilarShape, 0, 0.3),
+        np.where(isSimilarShapeNormalized, 0, 0.3),
+        np.where(centroidDifference < 100, 0, 0.1),
+        np.where(isSimilarBearing, 0, 0)
+    ]
+
+    for item in subtraction:
+        finalScore -= item
+
+    finalScore = np.round(np.maximum(finalScore, 0) * 100).astype(int)
+
+    for j, i in enumerate(bulk):
+        scores[i] = int(finalScore[j])
+        log.debug(
+            f'{XDSegIDs[i]}: confidence {scores[i]} (length {XDLen[j]}m [XD] {conflationLen[j]}m [Conflation], '
+            f'hausdorff {hausdorffDistance[j]}m, normalized {hausdorffDistanceNormalized[j]}m, centroid {centroidDifference[j]:.0f}m, '
+            f'bearing {segmentBearing[0][j]:.0f}/{segmentBearing[1][j]:.0f}/{segmentBearing[2][j]:.0f})'
+        )
+
+    return scores
+
+
+def dissolve_events(inputConflation):
+    """ Merges the event geometries of each XD segment into one polyline, like Dissolve on
+        XDSegID, in one pass over the conflation events.  An event that starts where the
+        previous event of the same XD segment ends is joined to it in the same part.
+
+    Input:
+        inputConflation - the conflation event feature class, layer or MemoryTable
+    Output:
+        {XDSegID (int): polyline} sorted by XDSegID.  XD segments without any event
+        geometry get None.
+    """
+    parts = {}
+    with search_cursor(inputConflation, ['XDSegID', 'SHAPE@']) as cur:
+        for XDSegID, geom in cur:
+            geomParts = parts.setdefault(int(XDSegID), [])
+            if geom is None:
+                continue
+
+            for part in get_vertex_arrays(geom):
+                if geomParts and np.array_equal(geomParts[-1][-1, :2], part[0, :2]):
+                    geomParts[-1] = np.concatenate([geomParts[-1], part[1:]])
+                else:
+                    geomParts.append(part)
+
+    spatialReference = get_spatial_reference(inputConflation)
+    return {XDSegID: backend.Polyline(parts[XDSegID], spatialReference) if parts[XDSegID] else None for XDSegID in sorted(parts)}
+
+
+def get_xd_geometries(inputXD, XDs):
+    """ Returns {XDSegID (int): polyline} for the XDs, in one pass over inputXD """
+    XDs = set(int(XD) for XD in XDs)
+    XDGeomDict = {}
+    with search_cursor(inputXD, ['XDSegID', 'SHAPE@']) as cur:
+        for XDSegID, geom in cur:
+            if int(XDSegID) in XDs:
+                XDGeomDict[int(XDSegID)] = geom
+
+    return XDGeomDict
+
+
+def run_AutoQC(conflationName, inputXD, inputConflation, outputCSV, xdSegIDs=None, previousCSV=None, workers=None):
+    """ Scores each XD segment in inputConflation and saves the scores to outputCSV.
+
+        If xdSegIDs is given, only those XD segments are scored.  The scores of the other
+        XD segments are carried forward from previousCSV, the outputCSV of a previous run.
+        See xd_to_rns.run_incremental_conflation.
+
+        The segments are scored together by get_confidence_scores, on workers processes.
+        Returns the list of {'XDSegID', 'confidence'} records.
+    """
+    fileHandler = logging.FileHandler(os.path.join('Logs', f'{conflationName}_AutoQC.log'), mode='w')
+    log.addHandler(fileHandler)
+    timer = metrics.StageTimer('run_AutoQC')
+
+    # Dissolve the conflation events by XDSegID in one pass
+    print('Dissolving conflation events')
+    ConflationGeomDict = dissolve_events(inputConflation)
+    XDs = list(ConflationGeomDict)
+    timer.lap('dissolve')
+
+    # Scores of the previous run, by XDSegID
+    previousScores = {}
+    if xdSegIDs is not None:
+        xdSegIDs = set(str(XDSegID) for XDSegID in xdSegIDs)
+    if xdSegIDs is not None and os.path.exists(previousCSV or ''):
+        previousScores = {str(row[0]): row[1] for row in pd.read_csv(previousCSV, dtype={'XDSegID': str})[['XDSegID', 'confidence']].values}
+
+    # XD segments that keep their previous score
+    carried = set(XD for XD in XDs if xdSegIDs is not None and str(XD) not in xdSegIDs and str(XD) in previousScores)
+
+    # Only the XD geometry of the segments being scored is kept
+    print('Building XDGeomDict')
+    XDGeomDict = get_xd_geometries(inputXD, [XD for XD in XDs if XD not in carried])
+    timer.lap('load')
+
+    # Carry forward the previous scores of the XD segments that aren't being scored
+    output = []
+    score = []
+    for XD in XDs:
+        if XD in carried:
+            output.append({
+                'XDSegID': XD,
+                'confidence': previousScores[str(XD)]
+            })
+            continue
 
         record = {
             'XDSegID': XD,
-            'confidence': confidence
+            'confidence': None
         }
 
         output.append(record)
+        score.append(record)
+
+    # Score the rest together
+    confidences = get_confidence_scores(
+        [record['XDSegID'] for record in score],
+        [XDGeomDict[record['XDSegID']] for record in score],
+        [ConflationGeomDict[record['XDSegID']] for record in score],
+        workers
+    )
+    for record, confidence in zip(score, confidences):
+        record['confidence'] = confidence
+
+    timer.lap('score')
 
     print(f'Saving output CSV to {outputCSV}')    
     df = pd.DataFrame(output)
     df.to_csv(outputCSV, index=False)
+    timer.lap('write')
 
-    print(f'Adding confidence field to {inputConflation}')
-    add_confidence_field(inputConflation, output)
+    # In-memory conflation events get their confidence when they are saved.  See RunConflation.start
+    if not isinstance(inputConflation, MemoryTable):
+        print(f'Adding confidence field to {inputConflation}')
+        add_confidence_field(inputConflation, output)
+        timer.lap('add_confidence_field')
+    timer.total()
+
+    metrics.count('autoqc.segments', len(output))
+    metrics.save_metrics(conflationName)
+
+    return output
 
 
 
@@ -1,35 +1,108 @@
-import arcpy
+import numpy as np
 import pandas as pd
+from geometry_backend import search_cursor
 
+"""
+Finds conflation events that overlap other events on the same route.
 
-inputevents = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Output\FinalBatches.gdb\FinalBatches_1'
+The events are read once and sorted by route and by their lower measure, so the
+events that overlap an event are the ones after it on the same route that begin
+before it ends.  These are found with a binary search for each event, which
+takes O(n log n) plus the number of overlapping pairs.  Events are compared on
+their measure range whatever their direction, so an event with BEGIN_MSR >
+END_MSR is the same as its reverse.  Events that only touch end to end, and
+zero length events, do not overlap.
 
-EventDict = {row[0]:[] for row in arcpy.da.SearchCursor(inputevents, 'RTE_NM')}
+Each overlapping pair is saved with the overlapping range and its length, and
+whether one of the events is within the other.
+"""
 
-with arcpy.da.SearchCursor(inputevents, ['XDSegID', 'RTE_NM','BEGIN_MSR','END_MSR']) as cur:
-    for XDSegID, RTE_NM, BEGIN_MSR, END_MSR in cur:
-        try:
+EVENT_FIELDS = ['XDSegID', 'RTE_NM', 'BEGIN_MSR', 'END_MSR']
 
-            EventDict[RTE_NM].append((BEGIN_MSR, END_MSR))
-        except:
-            continue
+OUTPUT_FIELDS = [
+    'XDSegID_1', 'XDSegID_2', 'RTE_NM', 'Begin_Msr_1', 'End_Msr_1', 'Begin_Msr_2', 'End_Msr_2',
+    'Overlap_Begin', 'Overlap_End', 'Overlap_Length', 'Contained'
+]
 
-overlaps = []
 
-with arcpy.da.SearchCursor(inputevents, ['XDSegID', 'RTE_NM','BEGIN_MSR','END_MSR']) as cur:
-    for XDSegID, RTE_NM, BEGIN_MSR, END_MSR in cur:
-        try:
+def load_events(inputEvents):
+    """ Returns a DataFrame of the events in inputEvents that have a route and both measures,
+        sorted by RTE_NM and the lower measure, with the measure range as LO and HI """
+    with search_cursor(inputEvents, EVENT_FIELDS) as cur:
+        events = pd.DataFrame([tuple(row) for row in cur], columns=EVENT_FIELDS)
 
-            events = EventDict[RTE_NM]
-            overlapCount = 0
-            for event in events:
-                if BEGIN_MSR >= event[0] and END_MSR <= event[1]:
-                    overlapCount += 1
-            if overlapCount > 1:
-                overlaps.append((XDSegID, RTE_NM, BEGIN_MSR, END_MSR))
-        except:
-            continue
+    events = events[events['RTE_NM'].notna()]
+    events = events.astype({'BEGIN_MSR': float, 'END_MSR': float})
+    events = events[events['BEGIN_MSR'].notna() & events['END_MSR'].notna()].copy()
 
-df = pd.DataFrame(overlaps, columns=['XDSegID','RTE_NM','Begin_Msr','End_Msr'])
-df.to_csv('overlappingEvents.csv',index=False)
-print(len(overlaps))
\ No newline at end of file
+    events['LO'] = np.minimum(events['BEGIN_MSR'], events['END_MSR'])
+    events['HI'] = np.maximum(events['BEGIN_MSR'], events['END_MSR'])
+
+    return events.sort_values(['RTE_NM', 'LO'], kind='stable').reset_index(drop=True)
+
+
+def find_overlapping_events(events):
+    """ Returns a DataFrame of every pair of overlapping events.
+
+    Input:
+        events - DataFrame from load_events
+    Output:
+        DataFrame with OUTPUT_FIELDS, one row per pair.  The first event of each pair has
+        the lower (or the same) begin measure.
+    """
+    lo = events['LO'].to_numpy()
+    hi = events['HI'].to_numpy()
+    routes = events['RTE_NM'].to_numpy()
+
+    # For each event, the index after the last event on the same route that begins before it ends
+    ends = np.empty(len(events), dtype=int)
+    routeStarts = np.flatnonzero(np.r_[True, routes[1:] != routes[:-1]]) if len(events) else np.empty(0, dtype=int)
+    for start, end in zip(routeStarts, np.r_[routeStarts[1:], len(events)]):
+        ends[start:end] = start + np.searchsorted(lo[start:end], hi[start:end], side='left')
+
+    # Every event j after event i that begins before i ends
+    counts = np.maximum(ends - np.arange(len(events)) - 1, 0)
+    first = np.repeat(np.arange(len(events)), counts)
+    pairStarts = np.repeat(np.cumsum(counts) - counts, counts)
+    second = first + 1 + np.arange(counts.sum()) - pairStarts
+
+    overlapBegin = lo[second]
+    overlapEnd = np.minimum(hi[first], hi[second])
+    overlapLength = overlapEnd - overlapBegin
+    isOverlap = overlapLength > 0
+    first, second = first[isOverlap], second[isOverlap]
+
+    # The second event begins within the first, so one contains the other if it ends within
+    # the first, or if they begin together and the first ends within it
+    isContained = (hi[second] <= hi[first]) | ((lo[first] == lo[second]) & (hi[first] <= hi[second]))
+
+    return pd.DataFrame({
+        'XDSegID_1': events['XDSegID'].to_numpy()[first],
+        'XDSegID_2': events['XDSegID'].to_numpy()[second],
+        'RTE_NM': routes[first],
+        'Begin_Msr_1': events['BEGIN_MSR'].to_numpy()[first],
+        'End_Msr_1': events['END_MSR'].to_numpy()[first],
+        'Begin_Msr_2': events['BEGIN_MSR'].to_numpy()[second],
+        'End_Msr_2': events['END_MSR'].to_numpy()[second],
+        'Overlap_Begin': overlapBegin[isOverlap],
+        'Overlap_End': overlapEnd[isOverlap],
+        'Overlap_Length': overlapLength[isOverlap],
+        'Contained': isContained
+    }, columns=OUTPUT_FIELDS)
+
+
+def run_find_overlapping_events(inputEvents, outputCSV='overlappingEvents.csv'):
+    """ Saves the overlapping pairs of events in inputEvents to outputCSV """
+    events = load_events(inputEvents)
+    overlaps = find_overlapping_events(events)
+
+    overlaps.to_csv(outputCSV, index=False)
+    print(f'{len(overlaps)} overlapping pairs of events on {overlaps["RTE_NM"].nunique()} routes')
+
+    return overlaps
+
+
+if __name__ == '__main__':
+    inputevents = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Output\FinalBatches.gdb\FinalBatches_1'
+
+    run_find_overlapping_events(inputevents)
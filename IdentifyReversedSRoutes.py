@@ -1,5 +1,27 @@
-import arcpy
 import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from hausdorff import get_segments
+from lrs_diff import build_lrs_manifest
+from xd_manifest import load_manifest, save_manifest
+
+"""
+Finds S-routes that are digitized in the wrong direction.
+
+NP routes should be digitized against the direction of travel, so their parent
+(PR) route should be on their right.  For each part of an NP route, the point on
+the parent route closest to the middle vertex of the part is found, and if that
+point is on the left of the NP route, the NP route is reversed.  If the NP route
+is also on the right of the parent route, the parent route is reversed too.
+
+The closest points and sides of line are computed with NumPy over the vertex
+arrays of every part of a route at once, and large LRS are checked in parallel
+chunks of routes.  The result of each route is saved in a manifest next to the
+output JSON with the geometry hashes of the route and its parent, so a later run
+only re-checks the routes whose geometry (or whose parent's geometry) changed.
+"""
 
 MasterLRS = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Data\ProjectedInput.gdb\LRS'
 
@@ -7,56 +29,159 @@ sqlTest = None # To limit the routes to test
 sqlGeomDict = None # To limit the LRS geometries to test against
 outputJSON = 'LRS_RTE_ERRORS__REVERSED_MP.json'
 
-geomDict = {row[0]: row[1] for row in arcpy.da.SearchCursor(MasterLRS, ['RTE_NM', 'SHAPE@'], sqlGeomDict)}
-
-ReversedRoutes = []
-
-
-with arcpy.da.SearchCursor(MasterLRS, ['RTE_NM', 'RTE_OPPOSITE_DIRECTION_RTE_NM', 'SHAPE@'], sqlTest) as cur:
-    for rte_nm, parent_rte_nm, geom in cur:
-        if rte_nm.startswith('S-VA') and rte_nm[7:9] == 'NP':
-        # if rte_nm.startswith('R-VA') and rte_nm[14:16] in ['SB', 'WB'] and 'RMP' not in rte_nm:
-            try:
-                for i in range(geom.partCount):
-                # For each segment of route:
-                    partGeom = geom.getPart(i)
-                    masterGeom = geomDict[parent_rte_nm]
-                    
-                    # Find the point on the parent route closest to the midpoint of this route segment
-                    partMidPoint =  partGeom[round(len(partGeom) / 2)]
-                    masterRteMeasure = masterGeom.measureOnLine(partMidPoint)
-                    masterRtePoint = masterGeom.positionAlongLine(masterRteMeasure)
-
-                    # Find which side of the route the masterRtePoint is located on
-                    queryPointAndDistance = geom.queryPointAndDistance(masterRtePoint)
-                    distance = queryPointAndDistance[-2]
-                    if distance < 1:
-                        continue
-
-                    sideOfRoute = queryPointAndDistance[-1]
-                    
-                    # If sideOfRoute == True, this means that the master route is located to the right of
-                    # the NP route geometry.  Since NP routes should be digitized against the direction
-                    # of travel, the PR route geometry should be to the right.  Therefore if
-                    # sideOfRoute == False, the S-route is digitized backwards.
-                    if not sideOfRoute:
-                        ReversedRoutes.append(rte_nm)
-
-                        # Verify if the parent_rte_nm is also reversed
-                        masterSideOfRoute = masterGeom.queryPointAndDistance(partMidPoint)[-1]
-
-                        # If masterSideOfRoute == True, then the NP route is to the right of the PR route
-                        # and this side is also digitized in reverse.
-                        if masterSideOfRoute == True:
-                            ReversedRoutes.append(parent_rte_nm)
-
-            except Exception as e:
-                print(f'Error on {rte_nm}: {e}')
-                
-
-# Save list of reversed routes
-with open(outputJSON,'w') as file:
-    json.dump(ReversedRoutes, file)
-
-print(f'Reversed routes found: {len(ReversedRoutes)}')
-print(f'List saved as {outputJSON}')
\ No newline at end of file
+# Routes closer than this (m) to their parent route are not tested
+MIN_DISTANCE = 1
+
+
+def is_np_route(rte_nm):
+    return rte_nm.startswith('S-VA') and rte_nm[7:9] == 'NP'
+
+
+def get_manifest_path(outputJSON):
+    return f'{os.path.splitext(outputJSON)[0]}_manifest.json'
+
+
+def get_closest_points(points, segments):
+    """ Returns the closest point on segments to each of the (n, 2) points, like queryPointAndDistance.
+    Output:
+        (x, y, distance, rightSide) arrays.  rightSide is True where the point is to the
+        right of the closest segment.
+    """
+    x, y = points[:, 0:1], points[:, 1:2]
+    x0, y0, x1, y1 = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    dx = x1 - x0
+    dy = y1 - y0
+    segLenSq = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((x - x0) * dx + (y - y0) * dy) / segLenSq
+    t = np.where(segLenSq > 0, np.clip(t, 0, 1), 0)
+    dists = np.hypot(x0 + t * dx - x, y0 + t * dy - y)
+
+    i = dists.argmin(axis=1)
+    rows = np.arange(len(points))
+    closestX = x0[i] + t[rows, i] * dx[i]
+    closestY = y0[i] + t[rows, i] * dy[i]
+    rightSide = dx[i] * (y[:, 0] - y0[i]) - dy[i] * (x[:, 0] - x0[i]) < 0
+
+    return closestX, closestY, dists[rows, i], rightSide
+
+
+def check_route(rte_nm, parent_rte_nm, parts, parentParts):
+    """ Returns the reversed routes found by testing the NP route rte_nm against its parent route """
+    # The middle vertex of each part, and the closest point to it on the parent route
+    midPoints = np.array([part[round(len(part) / 2), :2] for part in parts])
+    masterX, masterY, masterDistance, masterSideOfRoute = get_closest_points(midPoints, get_segments(parentParts))
+
+    # Which side of the route the parent route is located on
+    distance, sideOfRoute = get_closest_points(np.column_stack([masterX, masterY]), get_segments(parts))[2:]
+
+    # If sideOfRoute == True, the parent route is to the right of the NP route, as it should be.
+    # Otherwise the NP route is digitized backwards, and if the NP route is also to the right of
+    # the parent route, the parent route is digitized backwards too.
+    isReversed = (distance >= MIN_DISTANCE) & ~sideOfRoute
+
+    reversedRoutes = []
+    if isReversed.any():
+        reversedRoutes.append(rte_nm)
+    if (isReversed & masterSideOfRoute).any():
+        reversedRoutes.append(parent_rte_nm)
+
+    return reversedRoutes
+
+
+def check_routes(routes):
+    """ Checks a chunk of (rte_nm, parent_rte_nm, parts, parentParts).  Returns a list of
+        (rte_nm, reversed routes, error message) """
+    results = []
+    for rte_nm, parent_rte_nm, parts, parentParts in routes:
+        try:
+            results.append((rte_nm, check_route(rte_nm, parent_rte_nm, parts, parentParts), None))
+        except Exception as e:
+            results.append((rte_nm, [], str(e)))
+
+    return results
+
+
+def identify_reversed_routes(lrs, outputJSON=outputJSON, sqlTest=None, sqlGeomDict=None, workers=1, incremental=True):
+    """ Saves the sorted list of reversed routes to outputJSON.
+
+    Input:
+        lrs - the master LRS
+        sqlTest - to limit the routes to test
+        sqlGeomDict - to limit the LRS geometries to test against
+        workers - number of processes.  Routes are checked in chunks of workers * 4.
+        incremental - only re-check the routes whose geometry, parent route or parent
+                      geometry changed since the manifest of the last run, and the routes
+                      that had an error
+    Output:
+        the list of reversed routes
+    """
+    manifest, routeParts = build_lrs_manifest(lrs, sqlGeomDict)
+    testManifest, testParts = build_lrs_manifest(lrs, sqlTest) if sqlTest else (manifest, routeParts)
+
+    manifestPath = get_manifest_path(outputJSON)
+    previous = load_manifest(manifestPath) if incremental else None
+    if previous is None or previous.get('filters') != [sqlTest, sqlGeomDict]:
+        previous = {'routes': {}}
+
+    # Results of each tested route, with the geometry hashes they were found with
+    results = {}
+    routes = []
+    for rte_nm, record in testManifest.items():
+        if not is_np_route(rte_nm):
+            continue
+
+        parent_rte_nm = record['opposite']
+        result = {
+            'geometry': record['geometry'],
+            'parent': parent_rte_nm,
+            'parentGeometry': manifest[parent_rte_nm]['geometry'] if parent_rte_nm in manifest else None
+        }
+
+        previousResult = previous['routes'].get(rte_nm)
+        if previousResult is not None and 'error' not in previousResult and all(previousResult[key] == result[key] for key in result):
+            results[rte_nm] = previousResult
+            continue
+
+        results[rte_nm] = result
+        if parent_rte_nm not in routeParts:
+            print(f'Error on {rte_nm}: parent route {parent_rte_nm} not found')
+            result['reversed'] = []
+            result['error'] = 'parent route not found'
+            continue
+        if not testParts[rte_nm] or not routeParts[parent_rte_nm]:
+            result['reversed'] = []
+            continue
+
+        routes.append((rte_nm, parent_rte_nm, testParts[rte_nm], routeParts[parent_rte_nm]))
+
+    print(f'Checking {len(routes)} of {len(results)} NP routes')
+    if workers > 1 and len(routes) > workers:
+        chunkSize = math.ceil(len(routes) / (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            checked = [result for chunk in executor.map(check_routes, [routes[i:i + chunkSize] for i in range(0, len(routes), chunkSize)]) for result in chunk]
+    else:
+        checked = check_routes(routes)
+
+    for rte_nm, reversedRoutes, error in checked:
+        if error is not None:
+            print(f'Error on {rte_nm}: {error}')
+            results[rte_nm]['error'] = error
+        results[rte_nm]['reversed'] = reversedRoutes
+
+    # Each route is only listed once, even if it was found by several parts or routes
+    ReversedRoutes = sorted(set(route for result in results.values() for route in result['reversed']))
+
+    # Save list of reversed routes
+    with open(outputJSON, 'w') as file:
+        json.dump(ReversedRoutes, file)
+    save_manifest({'filters': [sqlTest, sqlGeomDict], 'routes': results}, manifestPath)
+
+    print(f'Reversed routes found: {len(ReversedRoutes)}')
+    print(f'List saved as {outputJSON}')
+
+    return ReversedRoutes
+
+
+if __name__ == '__main__':
+    identify_reversed_routes(MasterLRS, outputJSON, sqlTest, sqlGeomDict, workers=os.cpu_count() or 1)
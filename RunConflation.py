@@ -1,6 +1,7 @@
 import arcpy
 import os
-from xd_to_rns import run_conflation
+from xd_to_rns import run_conflation, run_incremental_conflation
+from event_table import make_event_table, write_event_feature_class
 import sys
 from datetime import datetime
 
@@ -14,8 +15,28 @@ conflationName = 'Batch_11'
 outputPath = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Output'
 xdFliter = "Batch = 11"
 
+# Pass the events between stages in memory and write the outputs at the end
+pipeline = True
 
-def start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflationName, outputPath, xdFliter):
+
+def start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflationName, outputPath, xdFliter, previousConflationName=None, previousMasterLRS=None, pipeline=False, snapshots=False, workers=1, qcWorkers=None):
+    """ Runs the conflation, flipRoutes and AutoQC for one batch.
+
+        If previousConflationName is given, only the XD segments that are new or changed
+        since that run, or that touch routes changed since previousMasterLRS, are
+        conflated, flipped and QC'd.  Everything else is carried forward from the
+        previous run's output CSVs.
+
+        If pipeline is True, the events are passed from one stage to the next in memory
+        (see event_table) instead of through route event feature classes.  The initial
+        conflation is still written and checkpointed as it runs, so a killed run resumes.
+        The other output CSVs and the final feature class are written once at the end, and
+        with snapshots the initial events are also saved as {conflationName}_initial for debugging.
+
+        workers is the number of processes for the conflation.  With 1 it runs in this
+        process and uses the LRS indexes already loaded here (see RunConflation_Batch).
+        qcWorkers is the number of processes for AutoQC, one per CPU by default.
+    """
     # Create output gdb
     if os.path.exists(outputPath):
         arcpy.env.overwriteOutput = True
@@ -24,13 +45,19 @@ def start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflati
             print('Creating output gdb')
             arcpy.CreateFileGDB_management(outputPath, f'{conflationName}.gdb')
 
-        
+    if pipeline:
+        run_pipeline(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflationName, outputGDBPath, xdFliter, previousConflationName, previousMasterLRS, snapshots, workers, qcWorkers)
+        return
 
     # Run initial conflation
     print('\n### Running initial conflation ###\n')
     
     outputCSV_initial = f'Output/{conflationName}_initial.csv'
-    run_conflation(conflationName, outputCSV_initial, inputXD, inputMasterLRS, inputIntersections, xdFliter, lrsFilter='', printProgress=False)
+    xdSegIDs = None
+    if previousConflationName:
+        xdSegIDs = run_incremental_conflation(conflationName, outputCSV_initial, f'Output/{previousConflationName}_initial.csv', inputXD, inputMasterLRS, inputIntersections, xdFliter, lrsFilter='', previousLRS=previousMasterLRS, workers=workers)
+    else:
+        run_conflation(conflationName, outputCSV_initial, inputXD, inputMasterLRS, inputIntersections, xdFliter, lrsFilter='', printProgress=False, workers=workers)
 
     # Create initial conflation event layer
     print('\n### Creating initial conflation event layer ###\n')
@@ -42,7 +69,8 @@ def start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflati
     from flipRoutes import run_flip_routes
     inputEvents = f'{outputPath}\{conflationName}.gdb\{conflationName}_initial'
     outputCSV_flipped = f'Output/{conflationName}_flipped.csv'
-    run_flip_routes(conflationName, inputEvents, outputCSV_flipped, inputXD, inputOverlapLRS)
+    previousCSV_flipped = f'Output/{previousConflationName}_flipped.csv' if previousConflationName else None
+    run_flip_routes(conflationName, inputEvents, outputCSV_flipped, inputXD, inputOverlapLRS, xdSegIDs, previousCSV_flipped)
 
 
 
@@ -55,7 +83,51 @@ def start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflati
     from AutoQC import run_AutoQC
     print('\n### AutoQC ###\n')
     outputCSV_QC = f'Output/{conflationName}_QC.csv'
-    run_AutoQC(conflationName, inputXD, f'{outputPath}\{conflationName}.gdb\{conflationName}', outputCSV_QC)
+    previousCSV_QC = f'Output/{previousConflationName}_QC.csv' if previousConflationName else None
+    run_AutoQC(conflationName, inputXD, f'{outputPath}\{conflationName}.gdb\{conflationName}', outputCSV_QC, xdSegIDs, previousCSV_QC, qcWorkers)
+
+
+def run_pipeline(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflationName, outputGDBPath, xdFliter, previousConflationName=None, previousMasterLRS=None, snapshots=False, workers=1, qcWorkers=None):
+    """ The pipeline mode of start.  Writes the same output CSVs, and a feature class with
+        the same fields as the route event layer of the flipped CSV (see event_table). """
+    from AutoQC import run_AutoQC
+    from flipRoutes import run_flip_routes
+
+    # Run initial conflation
+    print('\n### Running initial conflation ###\n')
+    outputCSV_initial = f'Output/{conflationName}_initial.csv'
+    events = []
+    xdSegIDs = None
+    if previousConflationName:
+        xdSegIDs = run_incremental_conflation(conflationName, outputCSV_initial, f'Output/{previousConflationName}_initial.csv', inputXD, inputMasterLRS, inputIntersections, xdFliter, lrsFilter='', previousLRS=previousMasterLRS, workers=workers, events=events)
+    else:
+        run_conflation(conflationName, outputCSV_initial, inputXD, inputMasterLRS, inputIntersections, xdFliter, lrsFilter='', printProgress=False, workers=workers, events=events)
+
+    print('\n### Locating initial conflation events ###\n')
+    initialEvents = make_event_table(events, inputMasterLRS)
+    if snapshots:
+        write_event_feature_class(initialEvents, outputGDBPath, f'{conflationName}_initial')
+
+    # Flip routes
+    print('\n### Flipping Routes ###\n')
+    previousCSV_flipped = f'Output/{previousConflationName}_flipped.csv' if previousConflationName else None
+    flipped = run_flip_routes(conflationName, initialEvents, None, inputXD, inputOverlapLRS, xdSegIDs, previousCSV_flipped)
+
+    print('\n### Locating flipped conflation events ###\n')
+    flippedEvents = make_event_table(flipped, inputOverlapLRS)
+
+    # Run autoQC
+    print('\n### AutoQC ###\n')
+    outputCSV_QC = f'Output/{conflationName}_QC.csv'
+    previousCSV_QC = f'Output/{previousConflationName}_QC.csv' if previousConflationName else None
+    scores = run_AutoQC(conflationName, inputXD, flippedEvents, outputCSV_QC, xdSegIDs, previousCSV_QC, qcWorkers)
+
+    # Write the flipped events that the next incremental run reads, and the final feature class
+    print('\n### Saving outputs ###\n')
+    flipped.to_csv(f'Output/{conflationName}_flipped.csv', index=False)
+
+    confidence = {int(score['XDSegID']): (score['confidence'],) for score in scores}
+    write_event_feature_class(flippedEvents, outputGDBPath, conflationName, [('confidence', 'SHORT')], confidence)
 
 
 if __name__ == '__main__':
@@ -70,10 +142,10 @@ if __name__ == '__main__':
         xdFliter = args[7]
 
         startTime = datetime.now()
-        start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflationName, outputPath, xdFliter)
+        start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflationName, outputPath, xdFliter, pipeline=pipeline)
         endTime = datetime.now()
 
         with open('test.txt', 'a') as file:
             file.write(f'{endTime - startTime}\n')
     else:
-        start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflationName, outputPath, xdFliter)
\ No newline at end of file
+        start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflationName, outputPath, xdFliter, pipeline=pipeline)
\ No newline at end of file
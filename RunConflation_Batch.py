@@ -1,9 +1,31 @@
-import smtplib
-from email.message import EmailMessage
-import json
+import argparse
+import os
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
 
 import RunConflation
-from datetime import datetime
+import xd_to_rns
+from xd_manifest import load_manifest, save_manifest
+
+"""
+Runs the conflation batches in parallel.
+
+The read-only LRS route and intersection indexes are built once before the
+batches start (the route intersection table is saved next to the LRS), and each
+worker process loads them once in its initializer and reuses them for every
+batch it runs.  Worker processes inherit the parent's indexes where processes
+are forked.  Batches run across a pool of up to one worker per CPU, and a batch
+that fails is queued again up to MAX_RETRIES times.  Each batch conflates in its
+worker process with the loaded indexes.  The CPUs left over when there are fewer
+batches than CPUs go to AutoQC, which gets cpu_count / pool size processes per
+batch instead of starting a pool per CPU of its own.
+
+The status, attempts, start time, duration and error of each batch are saved in
+a run manifest (batch_run.json in the output folder) as the batches finish.  A
+batch that completed in an earlier run with the same XDFilter is skipped, so an
+interrupted run picks up where it stopped.
+"""
 
 inputXD = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Data\ProjectedInput.gdb\USA_Virginia'
 inputMasterLRS = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Data\ProjectedInput.gdb\LRS'
@@ -35,56 +57,168 @@ batches = [
         "Name": "Test_5",
         "XDFilter": "XDSegID = '429100044'"
     },
-    
-]
-
-
-# For sending text alerts when each batch is complete
-with open('password.json', 'r') as file:
-    data = json.load(file)
-    email = data['email']
-    password = data['pw']
-    receiverEmail = data['receiverEmail']
-
-
-def send_txt(subject, message):
-    try:
-        smtp = smtplib.SMTP_SSL('mail.danielfourquet.com', 465)
-        smtp.login(email, password)
 
-        msg = EmailMessage()
-        msg.set_content(message)
-        msg['Subject'] = subject
-        msg['From'] = email
-        msg['To'] = receiverEmail
-
-        smtp.send_message(msg)
-    except Exception as e:
-        print('SEND TXT FAILED')
-        print(e)
+]
 
+# Number of times a failed batch is run again
+MAX_RETRIES = 2
 
 
+def get_run_manifest_path(outputPath):
+    return os.path.join(outputPath, 'batch_run.json')
 
 
-for batch in batches:
+def init_batch_worker(inputMasterLRS, inputIntersections):
+    """ Loads the LRS indexes once in each worker process.  If they can't be loaded here, the
+        batches load them and report the error. """
     try:
-        batchStart = datetime.now()
-        conflationName = batch['Name']
-        XDFilter = batch['XDFilter']
-
-        print(f'\n### Starting {conflationName} ###\n')
-        RunConflation.start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, conflationName, outputPath, XDFilter)
-        batchEnd = datetime.now()
-        with open('test.txt', 'a') as file:
-            file.write(f'{batchEnd - batchStart}\n')
-
-
+        xd_to_rns.load_lrs(inputMasterLRS, inputIntersections)
     except Exception as e:
-        print(f"Error processing batch {batch['Name']}")
-        print(e)
-        send_txt(batch['Name'], 'Failed')
+        print(f'Unable to load the LRS indexes: {e}')
+
+
+def run_batch(inputs, batch, qcWorkers=None):
+    """ Runs RunConflation.start for one batch.
+
+    Input:
+        inputs - (inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, outputPath)
+        batch - {"Name", "XDFilter"}
+        qcWorkers - number of processes for the batch's AutoQC.  The conflation runs in this process.
+    Output:
+        (started, seconds, error).  error is the traceback of a failed batch, or None.
+    """
+    inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, outputPath = inputs
+    start = datetime.now()
+    print(f'\n### Starting {batch["Name"]} ###\n')
+    try:
+        RunConflation.start(inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, batch['Name'], outputPath, batch['XDFilter'], pipeline=RunConflation.pipeline, workers=1, qcWorkers=qcWorkers)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+
+    return start.isoformat(timespec='seconds'), (datetime.now() - start).total_seconds(), error
+
+
+def start_batch(record):
+    record['status'] = 'running'
+    record['attempts'] += 1
+
+
+def finish_batch(name, record, result, retries):
+    """ Records the result of a run of a batch.  Returns True if the batch should run again. """
+    record['started'], record['seconds'], record['error'] = result
+    record['finished'] = datetime.now().isoformat(timespec='seconds')
+
+    if record['error'] is None:
+        record['status'] = 'complete'
+        print(f'\n### {name} complete in {record["seconds"]:.0f}s ###\n')
+        return False
+
+    retry = record['attempts'] <= retries
+    record['status'] = 'pending' if retry else 'failed'
+    print(f'\n### Error processing batch {name} (attempt {record["attempts"]}) ###\n{record["error"]}')
+    return retry
+
+
+def run_batches(batches, inputXD=inputXD, inputMasterLRS=inputMasterLRS, inputOverlapLRS=inputOverlapLRS, inputIntersections=inputIntersections, outputPath=outputPath, workers=None, retries=MAX_RETRIES):
+    """ Runs the batches in parallel and saves their progress to the run manifest.
+
+    Input:
+        batches - list of {"Name", "XDFilter"}
+        workers - number of processes.  Defaults to one per CPU, up to the number of batches.
+                  With 1, the batches run one after another in this process.
+        retries - number of times a failed batch is run again
+    Output:
+        the run manifest, {'batches': {Name: {XDFilter, status, attempts, started, finished, seconds, error}}}
+    """
+    runStart = datetime.now()
+    manifestPath = get_run_manifest_path(outputPath)
+    manifest = load_manifest(manifestPath) or {'batches': {}}
+    records = manifest['batches']
+
+    # Batches completed by an earlier run are skipped
+    queue = []
+    for batch in batches:
+        record = records.get(batch['Name'])
+        if record is not None and record['status'] == 'complete' and record['XDFilter'] == batch['XDFilter']:
+            print(f'Skipping {batch["Name"]}, completed {record["finished"]}')
+            continue
+
+        records[batch['Name']] = {'XDFilter': batch['XDFilter'], 'status': 'pending', 'attempts': 0, 'started': None, 'finished': None, 'seconds': None, 'error': None}
+        queue.append(batch)
+    save_manifest(manifest, manifestPath)
+
+    if not queue:
+        print('\n### All batches are already complete ###\n')
+        return manifest
+
+    # Build the indexes once, so the route intersection table is saved before the workers load it
+    xd_to_rns.load_lrs(inputMasterLRS, inputIntersections)
+
+    inputs = (inputXD, inputMasterLRS, inputOverlapLRS, inputIntersections, outputPath)
+    cpuCount = os.cpu_count() or 1
+    workers = min(workers or cpuCount, len(queue))
+    qcWorkers = max(1, cpuCount // workers)
+    print(f'Running {len(queue)} batches on {workers} workers, with {qcWorkers} AutoQC processes each')
 
-    
-    
-print(f'\n### Batch Conflation Complete ###\n')
\ No newline at end of file
+    try:
+        if workers == 1:
+            while queue:
+                batch = queue.pop(0)
+                start_batch(records[batch['Name']])
+                save_manifest(manifest, manifestPath)
+                if finish_batch(batch['Name'], records[batch['Name']], run_batch(inputs, batch, qcWorkers), retries):
+                    queue.append(batch)
+                save_manifest(manifest, manifestPath)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker, initargs=(inputMasterLRS, inputIntersections)) as executor:
+                running = {}
+                while queue or running:
+                    # Only as many batches as workers are submitted, so running batches are running
+                    while queue and len(running) < workers:
+                        batch = queue.pop(0)
+                        start_batch(records[batch['Name']])
+                        running[executor.submit(run_batch, inputs, batch, qcWorkers)] = batch
+                    save_manifest(manifest, manifestPath)
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        batch = running.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception:
+                            # The worker process died
+                            result = (None, None, traceback.format_exc())
+                        if finish_batch(batch['Name'], records[batch['Name']], result, retries):
+                            queue.append(batch)
+                    save_manifest(manifest, manifestPath)
+    finally:
+        save_manifest(manifest, manifestPath)
+
+    statuses = [records[batch['Name']]['status'] for batch in batches]
+    print(f'\n### Batch Conflation Complete ###\n')
+    print(f'Complete: {statuses.count("complete")}  Failed: {statuses.count("failed")}  Time: {datetime.now() - runStart}')
+    for batch in batches:
+        if records[batch['Name']]['status'] == 'failed':
+            print(f'  {batch["Name"]} failed after {records[batch["Name"]]["attempts"]} attempts')
+    print(f'Run manifest saved as {manifestPath}')
+
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the conflation batches in parallel')
+    parser.add_argument('--batch', nargs=2, action='append', metavar=('NAME', 'XDFILTER'), help='a batch to run.  Defaults to the batches in this file.')
+    parser.add_argument('--xd', default=inputXD)
+    parser.add_argument('--lrs', default=inputMasterLRS)
+    parser.add_argument('--overlap-lrs', default=inputOverlapLRS)
+    parser.add_argument('--intersections', default=inputIntersections)
+    parser.add_argument('--output', default=outputPath)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes.  Defaults to one per CPU.')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES, help='times to run a failed batch again')
+    args = parser.parse_args()
+
+    if args.batch:
+        batches = [{"Name": name, "XDFilter": XDFilter} for name, XDFilter in args.batch]
+
+    run_batches(batches, args.xd, args.lrs, args.overlap_lrs, args.intersections, args.output, args.workers, args.retries)
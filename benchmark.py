@@ -0,0 +1,163 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+try:
+    import resource
+except ImportError:
+    resource = None
+import AutoQC
+import metrics
+import xd_to_rns
+from flipRoutes import run_flip_routes
+from event_table import make_event_table
+from synthetic_network import generate_network
+
+"""
+End-to-end throughput benchmark on synthetic networks.  Runs on Linux without ArcGIS.
+
+For each scale, a network is generated with synthetic_network.generate_network and
+the XD segments are conflated with match_xd_to_lrs, flipped with run_flip_routes
+and scored with the AutoQC confidence score.  Each scale runs in a fresh process
+so that its peak memory can be measured on its own.  The report gives the
+segments per second of each stage at each scale, the peak memory, and the scaling
+exponent of each stage between the smallest and largest scale (1 is linear).
+
+run_AutoQC itself needs arcpy to add the confidence field, so the benchmark locates
+the flipped events on the overlap LRS and times AutoQC.dissolve_events and
+get_confidence_scores on them.
+
+    python benchmark.py --scales 4 8 16 --workers 1
+"""
+
+SCALES = [4, 8, 16]
+
+BENCHMARK_FOLDER = 'Output'
+
+STAGES = ['generate', 'conflation', 'flip', 'autoqc']
+
+
+def get_peak_memory():
+    """ Returns the peak resident memory (MB) of this process and its finished
+        children, or None where the resource module is not available """
+    if resource is None:
+        return None
+
+    # ru_maxrss is in KB on Linux
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / 1024, 1)
+
+
+def run_scale(gridSize, workers=1, seed=0):
+    """ Runs the pipeline on one synthetic network.  Returns a dict of the network
+        size, the time and segments per second of each stage, and the peak memory. """
+    os.makedirs('Logs', exist_ok=True)
+    os.makedirs(BENCHMARK_FOLDER, exist_ok=True)
+    conflationName = f'benchmark_{gridSize}'
+    metrics.ENABLED = True
+    metrics.reset()
+    seconds = {}
+
+    start = time.perf_counter()
+    network = generate_network(gridSize, seed)
+    seconds['generate'] = time.perf_counter() - start
+    segments = len(network['xd'])
+    print(f'Grid {gridSize}: {len(network["lrs"])} routes, {len(network["intersections"])} intersections, {segments} XD segments')
+
+    start = time.perf_counter()
+    events = xd_to_rns.match_xd_to_lrs(network['xd'], network['lrs'], network['intersections'], workers=workers)
+    seconds['conflation'] = time.perf_counter() - start
+
+    # The initial events are located on the master LRS for flipRoutes, like the event layer in RunConflation.start
+    initialEvents = make_event_table(events, network['lrs'])
+    flippedCSV = os.path.join(BENCHMARK_FOLDER, f'{conflationName}_flipped.csv')
+
+    start = time.perf_counter()
+    flipped = run_flip_routes(conflationName, initialEvents, flippedCSV, network['xd'], network['overlapLRS'])
+    seconds['flip'] = time.perf_counter() - start
+
+    flippedEvents = make_event_table(flipped, network['overlapLRS'])
+
+    start = time.perf_counter()
+    AutoQC.set_backend('numpy')
+    ConflationGeomDict = AutoQC.dissolve_events(flippedEvents)
+    XDs = list(ConflationGeomDict)
+    XDGeomDict = AutoQC.get_xd_geometries(network['xd'], XDs)
+    scores = AutoQC.get_confidence_scores(XDs, [XDGeomDict[XD] for XD in XDs], [ConflationGeomDict[XD] for XD in XDs], workers)
+    seconds['autoqc'] = time.perf_counter() - start
+
+    metrics.save_metrics(conflationName)
+
+    return {
+        'gridSize': gridSize,
+        'routes': len(network['lrs']),
+        'intersections': len(network['intersections']),
+        'segments': segments,
+        'events': len(events),
+        'errors': xd_to_rns.count_error,
+        'meanConfidence': round(sum(scores) / len(scores), 1) if scores else None,
+        'seconds': {stage: round(seconds[stage], 3) for stage in STAGES},
+        'segmentsPerSecond': {stage: round(segments / seconds[stage], 1) if seconds[stage] else None for stage in STAGES},
+        'peakMemoryMB': get_peak_memory()
+    }
+
+
+def get_scaling(results):
+    """ Returns the scaling exponent of each stage's time with the number of segments,
+        between the smallest and the largest scale """
+    if len(results) < 2:
+        return {}
+
+    first, last = results[0], results[-1]
+    scaling = {}
+    for stage in STAGES:
+        if first['seconds'][stage] > 0 and last['seconds'][stage] > 0 and last['segments'] != first['segments']:
+            scaling[stage] = round(math.log(last['seconds'][stage] / first['seconds'][stage]) / math.log(last['segments'] / first['segments']), 2)
+
+    return scaling
+
+
+def print_report(results, scaling):
+    print(f'\n{"grid":>5} {"segments":>9} {"peak MB":>8}  ' + '  '.join(f'{stage + " seg/s":>16}' for stage in STAGES))
+    for result in results:
+        rates = '  '.join(f'{result["segmentsPerSecond"][stage] or 0:>16,.0f}' for stage in STAGES)
+        print(f'{result["gridSize"]:>5} {result["segments"]:>9,} {result["peakMemoryMB"] or 0:>8,.0f}  {rates}')
+
+    if scaling:
+        print('\nScaling exponent (time ~ segments ^ n): ' + ', '.join(f'{stage} {n}' for stage, n in scaling.items()))
+
+
+def run_benchmark(scales=SCALES, workers=1, seed=0, outputPath=None):
+    """ Runs the benchmark at each scale and saves the report as JSON """
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for gridSize in sorted(scales):
+        # A fresh process for each scale, so that the peak memory is its own
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(executor.submit(run_scale, gridSize, workers, seed).result())
+
+    scaling = get_scaling(results)
+    print_report(results, scaling)
+
+    outputPath = outputPath or os.path.join(BENCHMARK_FOLDER, f'benchmark_{datetime.now():%Y%m%d_%H%M%S}.json')
+    os.makedirs(os.path.dirname(outputPath) or '.', exist_ok=True)
+    with open(outputPath, 'w') as file:
+        json.dump({'workers': workers, 'seed': seed, 'results': results, 'scaling': scaling}, file, indent=4)
+    print(f'\nSaved benchmark to {outputPath}')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the conflation pipeline on synthetic networks')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES, help='grid sizes to run (number of corridors each way)')
+    parser.add_argument('--workers', type=int, default=1, help='conflation worker processes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='path of the JSON report')
+    args = parser.parse_args()
+
+    run_benchmark(args.scales, args.workers, args.seed, args.output)
@@ -0,0 +1,94 @@
+import json
+import os
+
+"""
+Checkpoints for long conflation runs.  A checkpoint is an append-only JSON lines
+file that records which XD segments have had their events flushed to the output,
+so that a run killed part way through can be restarted with the same
+conflationName and pick up where it left off.
+"""
+
+CHECKPOINT_FOLDER = 'Checkpoints'
+
+
+class Checkpoint:
+    """ Records the XD segments whose events are safely in the output of a run.
+
+        The first line of the file describes the run: its output and the run settings
+        (inputs and filters), which must match for the run to resume.  Each following line is written
+        by EventWriter.flush after the events are on disk and holds the output position
+        (CSV size in bytes, or Parquet part count) and the (XDSegID, status) of every
+        segment in that flush.  When the run finishes a final complete line is added,
+        and the next run with the same name starts over.
+
+        On load, a torn last line from a killed run is ignored and the output is cut
+        back to the last recorded position by the EventWriter.
+    """
+
+    def __init__(self, conflationName, outputPath, resume=True, settings=None):
+        self.path = os.path.join(CHECKPOINT_FOLDER, f'{conflationName}.jsonl')
+        self.outputPath = outputPath
+        self.settings = settings or {}
+        self.done = set()        # XDSegIDs (as str) that were already in the output when the run resumed
+        self.segments = []       # (XDSegID, status) of those segments, in the order they were conflated
+        self.position = None     # Output position of the last flush, or None for a new run
+
+        if resume and self.load():
+            print(f'Resuming from checkpoint: {len(self.done)} XD segments already conflated')
+            return
+
+        os.makedirs(CHECKPOINT_FOLDER, exist_ok=True)
+        with open(self.path, 'w') as file:
+            file.write(json.dumps({'conflationName': conflationName, 'output': outputPath, 'settings': self.settings}) + '\n')
+
+
+    def load(self):
+        """ Reads an unfinished checkpoint for this run.  Returns False if there is
+            nothing to resume. """
+        if not os.path.exists(self.path):
+            return False
+
+        lines = []
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    lines.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+
+        if not lines or lines[0].get('output') != self.outputPath or lines[-1].get('complete') or not os.path.exists(self.outputPath):
+            return False
+
+        # A run with different inputs or filters starts over instead of adding to the old output
+        if lines[0].get('settings', {}) != self.settings:
+            print('Not resuming from checkpoint: the inputs or filters changed since the last run')
+            return False
+
+        for line in lines[1:]:
+            self.position = line['position']
+            for XDSegID, status in line['segments']:
+                self.done.add(str(XDSegID))
+                self.segments.append((XDSegID, status))
+
+        # Rewrite without the torn line so that new records start on a clean line
+        with open(self.path, 'w') as file:
+            for line in lines:
+                file.write(json.dumps(line) + '\n')
+
+        return self.position is not None
+
+
+    def save(self, position, segments):
+        """ Records that the events of segments are in the output up to position """
+        with open(self.path, 'a') as file:
+            file.write(json.dumps({'position': position, 'segments': segments}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.position = position
+
+
+    def complete(self):
+        """ Marks the run as finished """
+        with open(self.path, 'a') as file:
+            file.write(json.dumps({'complete': True}) + '\n')
@@ -4,20 +4,10 @@ set inputOverlapLRS="Data\ProjectedInput.gdb\LRS_OVERLAP"
 set inputIntersections="Data\ProjectedInput.gdb\LRS_intersections"
 set outputPath="Output"
 
-set conflationName="Batch_4"
-set xdFliter="Batch = 4"
-"C:\Program Files\ArcGIS\Pro\bin\Python\envs\arcgispro-py3\python.exe" RunConflation.py %inputXD% %inputMasterLRS% %inputOverlapLRS% %inputIntersections% %outputPath% %conflationName% %xdFliter%
-
-set conflationName="Batch_5"
-set xdFliter="Batch = 5"
-"C:\Program Files\ArcGIS\Pro\bin\Python\envs\arcgispro-py3\python.exe" RunConflation.py %inputXD% %inputMasterLRS% %inputOverlapLRS% %inputIntersections% %outputPath% %conflationName% %xdFliter%
-
-set conflationName="Batch_6"
-set xdFliter="Batch = 6"
-"C:\Program Files\ArcGIS\Pro\bin\Python\envs\arcgispro-py3\python.exe" RunConflation.py %inputXD% %inputMasterLRS% %inputOverlapLRS% %inputIntersections% %outputPath% %conflationName% %xdFliter%
-
-set conflationName="Batch_10"
-set xdFliter="Batch = 10"
-"C:\Program Files\ArcGIS\Pro\bin\Python\envs\arcgispro-py3\python.exe" RunConflation.py %inputXD% %inputMasterLRS% %inputOverlapLRS% %inputIntersections% %outputPath% %conflationName% %xdFliter%
+"C:\Program Files\ArcGIS\Pro\bin\Python\envs\arcgispro-py3\python.exe" RunConflation_Batch.py --xd %inputXD% --lrs %inputMasterLRS% --overlap-lrs %inputOverlapLRS% --intersections %inputIntersections% --output %outputPath% ^
+    --batch "Batch_4" "Batch = 4" ^
+    --batch "Batch_5" "Batch = 5" ^
+    --batch "Batch_6" "Batch = 6" ^
+    --batch "Batch_10" "Batch = 10"
 
 pause
\ No newline at end of file
@@ -0,0 +1,106 @@
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+import numpy as np
+import pandas as pd
+from geometry_backend import MemoryTable, get_backend, get_route_event, get_spatial_reference, get_vertex_arrays, search_cursor
+
+"""
+In-memory route event tables, for passing events between the stages of
+RunConflation.start without writing them to CSV and making route event layers.
+
+make_event_table locates [XDSegID, RTE_NM, BEGIN_MSR, END_MSR] events on an LRS
+like MakeRouteEventLayer and returns a MemoryTable, which flipRoutes and AutoQC
+read like a feature class.  write_event_feature_class saves the final events to
+a file geodatabase once at the end of the run, with the same fields as a route
+event layer made from the event CSV: a numeric XDSegID and LOC_ERROR.
+"""
+
+EVENT_FIELDS = ['XDSegID', 'RTE_NM', 'BEGIN_MSR', 'END_MSR', 'LOC_ERROR', 'SHAPE@']
+
+FEATURE_CLASS_FIELDS = [('XDSegID', 'LONG'), ('RTE_NM', 'TEXT'), ('BEGIN_MSR', 'DOUBLE'), ('END_MSR', 'DOUBLE'), ('LOC_ERROR', 'TEXT')]
+
+
+def get_location_error(route, beginMP, endMP, geom):
+    """ Returns the LOC_ERROR that MakeRouteEventLayer gives a line event """
+    if route is None:
+        return 'ROUTE NOT FOUND'
+    if beginMP is None or endMP is None or pd.isna(beginMP) or pd.isna(endMP):
+        return 'FIELD VALUE NULL'
+    if geom is None:
+        return 'ROUTE LOCATION NOT FOUND'
+
+    measures = np.concatenate([part[:, 2] for part in get_vertex_arrays(route)])
+    mMin, mMax = np.nanmin(measures), np.nanmax(measures)
+    isFromOff = not mMin <= beginMP <= mMax
+    isToOff = not mMin <= endMP <= mMax
+    if isFromOff and isToOff:
+        return 'PARTIAL MATCH FOR THE FROM-MEASURE AND TO-MEASURE'
+    if isFromOff:
+        return 'PARTIAL MATCH FOR THE FROM-MEASURE'
+    if isToOff:
+        return 'PARTIAL MATCH FOR THE TO-MEASURE'
+    return 'NO ERROR'
+
+
+def make_event_table(events, lrs):
+    """ Returns a MemoryTable of events with their geometry on the lrs, like MakeRouteEventLayer.
+
+    Input:
+        events - list of [XDSegID, RTE_NM, BEGIN_MSR, END_MSR], or a DataFrame with those columns
+        lrs - the routes to locate the events on
+    Output:
+        MemoryTable with EVENT_FIELDS.  Events that can't be located have no geometry,
+        and LOC_ERROR says why.
+    """
+    if isinstance(events, pd.DataFrame):
+        events = events[EVENT_FIELDS[:4]].astype(object)
+        events = events.where(events.notna(), None).values.tolist()
+
+    # Only the routes with events are kept
+    rte_nms = set(event[1] for event in events)
+    routes = {}
+    with search_cursor(lrs, ['RTE_NM', 'SHAPE@']) as cur:
+        for rte_nm, geom in cur:
+            if rte_nm in rte_nms:
+                routes[rte_nm] = geom
+
+    rows = []
+    for XDSegID, rte_nm, beginMP, endMP in events:
+        geom = None
+        if rte_nm in routes and beginMP is not None and endMP is not None and not (pd.isna(beginMP) or pd.isna(endMP)):
+            geom = get_route_event(routes[rte_nm], beginMP, endMP)
+        rows.append((XDSegID, rte_nm, beginMP, endMP, get_location_error(routes.get(rte_nm), beginMP, endMP, geom), geom))
+
+    return MemoryTable(EVENT_FIELDS, rows, get_spatial_reference(lrs))
+
+
+def write_event_feature_class(eventTable, outputGDBPath, name, extraFields=None, values=None):
+    """ Saves a MemoryTable from make_event_table as the feature class outputGDBPath\\name.
+
+    Input:
+        extraFields - list of (field name, field type) to add
+        values - {XDSegID (int): tuple of the extraFields values} for the events
+    """
+    extraFields = extraFields or []
+    values = values or {}
+    spatialReference = eventTable.spatialReference
+    if not hasattr(spatialReference, 'factoryCode'):
+        spatialReference = arcpy.SpatialReference(spatialReference)
+
+    arcpy.CreateFeatureclass_management(outputGDBPath, name, 'POLYLINE', has_m='ENABLED', spatial_reference=spatialReference)
+    outputFC = f'{outputGDBPath}\\{name}'
+    for field, fieldType in FEATURE_CLASS_FIELDS + extraFields:
+        arcpy.AddField_management(outputFC, field, fieldType)
+
+    backend = get_backend('arcpy')
+    empty = tuple(None for field in extraFields)
+    fields = [field for field, fieldType in FEATURE_CLASS_FIELDS + extraFields] + ['SHAPE@']
+    with arcpy.da.InsertCursor(outputFC, fields) as cur:
+        for XDSegID, rte_nm, beginMP, endMP, locError, geom in eventTable.search(EVENT_FIELDS):
+            if geom is not None:
+                geom = backend.Polyline(get_vertex_arrays(geom), spatialReference)
+            cur.insertRow((int(XDSegID), rte_nm, beginMP, endMP, locError) + values.get(int(XDSegID), empty) + (geom,))
+
+    return outputFC
@@ -0,0 +1,158 @@
+import glob
+import os
+import time
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+"""
+Streaming output for conflation events.  Events are buffered in small chunks and
+appended to the output as XD segments finish, so a statewide run keeps bounded
+memory and a killed run still leaves every flushed event on disk.
+"""
+
+EVENT_COLUMNS = ['XDSegID', 'RTE_NM', 'BEGIN_MSR', 'END_MSR']
+
+
+class EventWriter:
+    """ Appends [XDSegID, RTE_NM, BEGIN_MSR, END_MSR] events to a CSV file or to a
+        directory of Parquet files.
+
+        Paths ending in .parquet are written as a directory of part files, one per
+        flush, which can be read back with pd.read_parquet(path).  Anything else is
+        written as a CSV with a single header row.  The buffer is flushed every
+        chunkSize events or flushInterval seconds, whichever comes first.
+
+        If a checkpoint.Checkpoint is given, each flush is recorded in it along with the
+        XD segments that finished, and a checkpoint with a saved position resumes
+        the output from that position instead of starting over.
+
+        If events is a list, every event written is also added to it, starting with the
+        events already in the output when resuming, for the next stage of a pipeline.
+    """
+
+    def __init__(self, path, chunkSize=10000, flushInterval=30, format=None, checkpoint=None, events=None):
+        self.path = path
+        self.chunkSize = chunkSize
+        self.flushInterval = flushInterval
+        self.format = format or ('parquet' if path.lower().endswith('.parquet') else 'csv')
+        self.checkpoint = checkpoint
+        self.events = events
+        self.buffer = []
+        self.segments = []
+        self.count = 0
+        self.partCount = 0
+        self.lastFlush = time.time()
+
+        resumePosition = checkpoint.position if checkpoint else None
+
+        if self.format == 'parquet':
+            if pa is None:
+                raise ImportError('pyarrow is required to write Parquet output')
+
+            # Start a new run by removing the part files of any previous run.  When resuming,
+            # only parts written after the last checkpoint are removed
+            os.makedirs(path, exist_ok=True)
+            self.partCount = resumePosition or 0
+            for partPath in glob.glob(os.path.join(path, 'part-*.parquet*')):
+                partNumber = int(os.path.basename(partPath)[5:10])
+                if partNumber >= self.partCount or partPath.endswith('.tmp'):
+                    os.remove(partPath)
+
+            self.schema = pa.schema([
+                ('XDSegID', pa.string()),
+                ('RTE_NM', pa.string()),
+                ('BEGIN_MSR', pa.float64()),
+                ('END_MSR', pa.float64())
+            ])
+        elif resumePosition is not None:
+            # Drop any events written after the last checkpoint
+            with open(path, 'r+') as file:
+                file.truncate(resumePosition)
+        else:
+            # Write the header now so that an empty run still produces a valid CSV
+            pd.DataFrame(columns=EVENT_COLUMNS).to_csv(path, index=False)
+
+        if resumePosition is not None and events is not None:
+            events += read_events(path)
+
+
+    def write(self, events, segment=None):
+        """ Adds a list of events to the buffer, flushing it if it is full or stale.
+            segment is the (XDSegID, status) that the events belong to, for the checkpoint. """
+        self.buffer += events
+        if self.events is not None:
+            self.events += events
+        if segment is not None:
+            self.segments.append(segment)
+        if len(self.buffer) >= self.chunkSize or time.time() - self.lastFlush >= self.flushInterval:
+            self.flush()
+
+
+    def flush(self):
+        """ Appends the buffered events to the output """
+        self.lastFlush = time.time()
+        if not self.buffer and not self.segments:
+            return
+
+        if self.format == 'parquet':
+            if self.buffer:
+                columns = list(zip(*self.buffer))
+                table = pa.table([
+                    [None if value is None else str(value) for value in columns[0]],
+                    list(columns[1]),
+                    list(columns[2]),
+                    list(columns[3])
+                ], schema=self.schema)
+
+                # Write to a temporary file first so that a killed run never leaves a partial part
+                partPath = os.path.join(self.path, f'part-{self.partCount:05d}.parquet')
+                pq.write_table(table, partPath + '.tmp')
+                os.replace(partPath + '.tmp', partPath)
+                self.partCount += 1
+            position = self.partCount
+        else:
+            with open(self.path, 'a', newline='') as file:
+                pd.DataFrame(self.buffer, columns=EVENT_COLUMNS).to_csv(file, header=False, index=False)
+                position = file.tell()
+
+        if self.checkpoint:
+            self.checkpoint.save(position, self.segments)
+
+        self.count += len(self.buffer)
+        self.buffer = []
+        self.segments = []
+
+
+    def close(self):
+        """ Flushes the buffer and marks the checkpoint complete """
+        self.flush()
+        if self.checkpoint:
+            self.checkpoint.complete()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # Keep the checkpoint open if the run failed so that it can be resumed
+        if exc_type is None:
+            self.close()
+        else:
+            self.flush()
+
+
+def read_events(path):
+    """ Reads the events written by an EventWriter back into a list of
+        [XDSegID, RTE_NM, BEGIN_MSR, END_MSR], with None for missing values """
+    if path.lower().endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, dtype={'XDSegID': str, 'RTE_NM': str})
+
+    df = df[EVENT_COLUMNS].astype(object)
+    return df.where(df.notna(), None).values.tolist()
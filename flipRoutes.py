@@ -1,6 +1,15 @@
-import arcpy, pandas as pd
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+import pandas as pd
 import logging
 import json
+import os
+import numpy as np
+import metrics
+from geometry_backend import MemoryTable, get_backend, get_xy, search_cursor
+from lrs_index import RouteStore
 
 inputEventLayer = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Data\ArcGIS\Default.gdb\ScaryRamps2'
 idField = 'XDSegID'
@@ -13,13 +22,14 @@ outputEventCSV = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Output\Sca
 overlapLRS = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Data\ProjectedInput.gdb\LRS_OVERLAP'
 inputXD = r'C:\Users\daniel.fourquet\Documents\Tasks\XD-to-LRS\Data\ProjectedInput.gdb\USA_Virginia'
 
-outputEvents = []
-
 countFlipped = 0
 countNotFlipped = 0
 countError = 0
 errorList = []
 
+# (overlap LRS, RouteStore) of the last run, reused by later runs in the same process
+loadedRoutes = None
+
 LRS_RTE_ERRORS__REVERSED_MP = [
     'R-VA000SC06624NB'
 ]
@@ -31,88 +41,151 @@ except Exception as e:
     print(e)
 
 
+# Per-event messages are logged at DEBUG.  The default level only logs the run summary.
 log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG) # Set the debug level here
-fileHandler = logging.FileHandler(f'flipRoutes.log', mode='w')
+log.setLevel(logging.INFO) # Set the debug level here
+fileHandler = logging.FileHandler(f'flipRoutes.log', mode='w', delay=True)
 log.addHandler(fileHandler)
 
-def add_to_event_table(id, rte_nm, begin_mp, end_mp):
-    event = {
-        idField: id,
-        rte_nmField: rte_nm,
-        begin_mpField: begin_mp,
-        end_mpField: end_mp
-    }
+# Flip decisions
+KEEP = 0
+FLIP = 1
+ERROR = 2
 
-    outputEvents.append(event)
 
-
-def get_msr(inputPolyline, lrs, rte_nm):
-    """ Locates the begin and end MP values of an input line along the LRS
-        ** The spatial reference of the input must match the spatial reference
+@metrics.timed('flipRoutes.get_msrs')
+def get_msrs(inputPolylines, lrs, rte_nms):
+    """ Locates the begin and end MP values of many input lines along the LRS in
+        a single vectorized pass.  See RouteStore.locate_points.
+        ** The spatial reference of the inputs must match the spatial reference
            of the lrs! **
     Input:
-        inputPolyline - an arcpy Polyline object
-        lrs - a reference to the lrs layer
-        rte_nm - the lrs rte_nm that the polyline will be placed on
+        inputPolylines - a list of arcpy Polyline objects
+        lrs - a RouteStore of the lrs layer
+        rte_nms - the lrs rte_nm that each polyline will be placed on
     Output:
-        (beginMP, endMP)
+        a list of (beginMP, endMP), with (None, None) where a line could not be located
     """
+    if not inputPolylines:
+        return []
 
     try:
-        # Get the geometry for the LRS route
-        RouteGeom = None
-        
-        try:
-            RouteGeom = lrs[rte_nm]
-        except:
-            log.debug(f'  Route "{rte_nm}" not found')
-            return None, None
-
-        if not RouteGeom:
-            log.debug(f'  Route "{rte_nm}" not found')
-            return None, None
-
-        
-
-        def get_mp_from_point(route, point):
-            """ Returns the m-value along the input route geometry
-                given an input point geometry """
-
-            # Check for multipart geometry.  If multipart, find closest part to
-            # ensure that the correct MP is returned
-            if route.isMultipart:
-                # Get list of parts
-                parts = [arcpy.Polyline(route[i], has_m=True) for i in range(route.partCount)]
-
-                # Get distances from inputPolyline's mid-point to each route part
-                partDists = {point.distanceTo(part):part for part in parts}
-
-                # Replace RouteGeom with closest polyline part
-                route = partDists[min(partDists)]
-
-            rteMeasure = route.measureOnLine(point)
-            rtePosition = route.positionAlongLine(rteMeasure)
-            mp = rtePosition.firstPoint.M
-            return mp
-
-        beginPt = arcpy.PointGeometry(inputPolyline.firstPoint)
-        beginMP = get_mp_from_point(RouteGeom, beginPt)
-
-        endPt = arcpy.PointGeometry(inputPolyline.lastPoint)
-        endMP = get_mp_from_point(RouteGeom, endPt)
-
-        return round(beginMP, 3), round(endMP, 3)
+        for rte_nm in set(rte_nms):
+            if rte_nm not in lrs:
+                log.debug(f'  Route "{rte_nm}" not found')
+
+        # Begin points first, then end points.  Lines without a geometry get NaN, so only
+        # their own measures are left null.
+        ends = []
+        for line in inputPolylines:
+            try:
+                ends.append((get_xy(line.firstPoint), get_xy(line.lastPoint)))
+            except (AttributeError, IndexError, TypeError):
+                ends.append(((np.nan, np.nan), (np.nan, np.nan)))
+        points = np.array([begin for begin, end in ends] + [end for begin, end in ends], dtype=float)
+        rte_nms = list(rte_nms) * 2
+
+        # Located on the closest part of each route
+        measures = np.full(len(points), np.nan)
+        isValid = ~np.isnan(points).any(axis=1)
+        if isValid.any():
+            measures[isValid] = lrs.locate_points(points[isValid], [rte_nm for rte_nm, valid in zip(rte_nms, isValid) if valid])[0]
+
+        msrs = []
+        for beginMP, endMP in zip(measures[:len(inputPolylines)], measures[len(inputPolylines):]):
+            if np.isnan(beginMP) or np.isnan(endMP):
+                msrs.append((None, None))
+            else:
+                msrs.append((round(float(beginMP), 3), round(float(endMP), 3)))
+
+        return msrs
 
     except Exception as e:
         print(e)
-        return None, None
-
+        return [(None, None)] * len(inputPolylines)
 
 
+def get_msr(inputPolyline, lrs, rte_nm):
+    """ Locates the begin and end MP values of an input line along the LRS
+        ** The spatial reference of the input must match the spatial reference
+           of the lrs! **
+    Input:
+        inputPolyline - an arcpy Polyline object
+        lrs - a RouteStore of the lrs layer
+        rte_nm - the lrs rte_nm that the polyline will be placed on
+    Output:
+        (beginMP, endMP)
+    """
+    return get_msrs([inputPolyline], lrs, [rte_nm])[0]
 
 
-def run_flip_routes(conflationName, inputEvents, outputEventCSV, XDs, overlap_LRS):
+def get_flip_decisions(events, oppRteDict):
+    """ Decides which events need to be moved to the opposite direction route.  The rules
+        are evaluated in order over the whole event table at once, and the first rule that
+        matches an event decides it.  Events that match no rule are flipped.
+    Input:
+        events - a DataFrame with rte_nm, begin_mp and end_mp columns
+        oppRteDict - {rte_nm: opposite direction rte_nm} for the routes that have one
+    Output:
+        (decisions, reasons) - arrays with KEEP, FLIP or ERROR for each event, and the
+        rule that decided it
+    """
+    rte_nm = events['rte_nm']
+    hasName = rte_nm.map(lambda value: isinstance(value, str)).to_numpy(bool)
+    names = rte_nm.where(hasName, '').astype(str)
+    beginMP = pd.to_numeric(events['begin_mp'], errors='coerce')
+    endMP = pd.to_numeric(events['end_mp'], errors='coerce')
+
+    # MP comparisons fail for events without MPs, the same as comparing None
+    missing = (beginMP.isna() | endMP.isna()).to_numpy()
+    ascending = (beginMP <= endMP).to_numpy()
+    descending = (beginMP >= endMP).to_numpy()
+
+    hasOpposite = rte_nm.isin(list(oppRteDict)).to_numpy()
+    reversedMP = rte_nm.isin(LRS_RTE_ERRORS__REVERSED_MP).to_numpy()
+    isSVA = names.str.startswith('S-VA').to_numpy()
+    isRVA = names.str.startswith('R-VA').to_numpy()
+    routeType = names.str[7:9].to_numpy()
+    isRamp = names.str.contains('RMP', regex=False).to_numpy()
+    isPA = names.str.contains('PA', regex=False).to_numpy()
+    isPrime = (names.str.contains('NB', regex=False) | names.str.contains('EB', regex=False)).to_numpy()
+    isNonPrime = (names.str.contains('SB', regex=False) | names.str.contains('WB', regex=False)).to_numpy()
+
+    # S-VA PR routes have ascending MPs and NP routes descending, unless the route is digitized backwards
+    primeSVA = isSVA & ascending & (routeType == 'PR')
+    nonPrimeSVA = isSVA & descending & (routeType == 'NP')
+
+    rules = [
+        ('no opposite route', ~hasOpposite, KEEP),
+        ('no rte_nm', ~hasName, ERROR),
+        ('missing MP', isSVA & missing, ERROR),
+        ('PR with ascending MP', primeSVA & ~reversedMP, KEEP),
+        ('NP with descending MP', nonPrimeSVA & ~reversedMP, KEEP),
+        ('digitized backwards', reversedMP & ~primeSVA & ~nonPrimeSVA, KEEP),
+        ('ramp', isRamp, KEEP),
+        ('PA route', isRVA & isPA, KEEP),
+        ('missing MP', isRVA & missing, ERROR),
+        ('NB or EB with ascending MP', isRVA & ascending & isPrime, KEEP),
+        ('SB or WB with descending MP', isRVA & descending & isNonPrime, KEEP)
+    ]
+
+    conditions = [condition for name, condition, decision in rules]
+    decisions = np.select(conditions, [decision for name, condition, decision in rules], default=FLIP)
+    reasons = np.select(conditions, [name for name, condition, decision in rules], default='flipped')
+
+    return decisions, reasons
+
+
+def run_flip_routes(conflationName, inputEvents, outputEventCSV, XDs, overlap_LRS, xdSegIDs=None, previousCSV=None):
+    """ Flips the events in inputEvents onto the correct direction route and saves them to outputEventCSV.
+
+        If xdSegIDs is given, only the events of those XD segments are flipped.  The
+        events of the other XD segments are carried forward from previousCSV, the
+        outputEventCSV of a previous run.  See xd_to_rns.run_incremental_conflation.
+
+        Returns the flipped events as a DataFrame of XDSegID, RTE_NM, BEGIN_MSR and END_MSR.
+        If outputEventCSV is None they are only returned, for the next stage of a pipeline.
+    """
     global inputEventLayer
     global inputXD
     global overlapLRS
@@ -120,249 +193,108 @@ def run_flip_routes(conflationName, inputEvents, outputEventCSV, XDs, overlap_LR
     global countNotFlipped
     global countError
     global errorList
-    global outputEvents
+    global loadedRoutes
 
-    outputEvents = []
+    timer = metrics.StageTimer('run_flip_routes')
 
-    fileHandler = logging.FileHandler(f'Logs/{conflationName}_flipRoutes.log', mode='w')
+    fileHandler = logging.FileHandler(os.path.join('Logs', f'{conflationName}_flipRoutes.log'), mode='w')
     log.addHandler(fileHandler)
 
     inputEventLayer = inputEvents
     inputXD = XDs
     overlapLRS = overlap_LRS
 
-    # Create a dictionary of opposite direction routes
-    print('Creating opposite direction route dict')
-    inputRoutes = set([row[0] for row in arcpy.da.SearchCursor(inputEventLayer, rte_nmField)])
-    oppRteDict = {}
-    with arcpy.da.SearchCursor(overlapLRS, ['RTE_NM', 'RTE_OPPOSITE_DIRECTION_RTE_NM']) as cur:
-        for rte_nm, opp_rte_nm in cur:
-            if rte_nm in inputRoutes:
-                oppRteDict[rte_nm] = opp_rte_nm
+    print('Loading events')
+    with search_cursor(inputEventLayer, [idField, rte_nmField, begin_mpField, end_mpField, 'SHAPE@', 'XDSegID']) as cur:
+        events = pd.DataFrame(list(cur), columns=['id', 'rte_nm', 'begin_mp', 'end_mp', 'geom', 'XDSegID'], dtype=object)
 
-    # Create dictionary for XD Geometries to save time on search cursors
-    # print('Creating XD geometry dict')
-    # XDGeomDict = {int(row[0]):row[1] for row in arcpy.da.SearchCursor(inputXD, ['XDSegID','SHAPE@'])}
+    # Load the LRS geometries once as vertex arrays to save time on search cursors.  Batches
+    # run one after another in the same process share the store of the same overlap LRS.
+    if loadedRoutes is not None and (loadedRoutes[0] == overlapLRS if isinstance(overlapLRS, str) else loadedRoutes[0] is overlapLRS):
+        print('Using the loaded LRS route store')
+        LRSRoutes = loadedRoutes[1]
+    else:
+        print('Creating LRS route store')
+        LRSRoutes = RouteStore(overlapLRS, get_backend('numpy') if isinstance(overlapLRS, MemoryTable) else None, parentField=None)
+        loadedRoutes = (overlapLRS, LRSRoutes)
 
-    # Create dictionary for LRS Geometries to save time on search cursors
-    print('Creating LRS geometry dict')
-    LRSGeomDict = {row[0]:row[1] for row in arcpy.da.SearchCursor(overlapLRS, ['RTE_NM','SHAPE@'])}
+    # Create a dictionary of opposite direction routes
+    print('Creating opposite direction route dict')
+    inputRoutes = set(events['rte_nm'])
+    oppRteDict = {rte_nm: opp_rte_nm for rte_nm, opp_rte_nm in LRSRoutes.opposite.items() if rte_nm in inputRoutes}
+
+    # Events of unchanged XD segments are carried forward from the previous run, in the
+    # position of the XD segment's first event
+    XDSegIDs = events['XDSegID'].map(str)
+    carried = np.zeros(len(events), dtype=bool)
+    previous = pd.DataFrame(columns=[idField, rte_nmField, begin_mpField, end_mpField])
+    if xdSegIDs is not None:
+        xdSegIDs = set(str(XDSegID) for XDSegID in xdSegIDs)
+    if xdSegIDs is not None and os.path.exists(previousCSV or ''):
+        previous = pd.read_csv(previousCSV, dtype={idField: str, rte_nmField: str})[[idField, rte_nmField, begin_mpField, end_mpField]].astype(object)
+        previous = previous.where(previous.notna(), None)
+        carried = (~XDSegIDs.isin(xdSegIDs) & XDSegIDs.isin(set(previous[idField]))).to_numpy()
+
+    firstRows = pd.Series(np.flatnonzero(carried), index=XDSegIDs[carried]).groupby(level=0).min()
+    previous = previous[previous[idField].isin(firstRows.index)].copy()
+    previous['order'] = previous[idField].map(firstRows)
+    timer.lap('load')
 
     print('Flipping Routes...')
-    # For each record in input layer, if the begin_mp > end_mp, move to the opposite route.  Otherwise, keep the same
-    with arcpy.da.SearchCursor(inputEventLayer, [idField, rte_nmField, begin_mpField, end_mpField, 'SHAPE@', 'XDSegID']) as cur:
-        for id, rte_nm, begin_mp, end_mp, geom, XDSegID in cur:
-            log.debug(f'\nProcessing {id}')
-            try:
-                needsFlip = False
-                if rte_nm not in oppRteDict.keys():
-                    log.debug(f"  '{rte_nm}' does not have an opposite route and doesn't need to be flipped")
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-
-                    continue
-
-                if rte_nm.startswith('S-VA') and (begin_mp < end_mp or begin_mp == end_mp) and (rte_nm[7:9] == 'PR'):
-                    if rte_nm in LRS_RTE_ERRORS__REVERSED_MP:
-                        log.debug(f"  rte_nm '{rte_nm}' is digitized backwards and needs to be flipped")
-                        needsFlip = True
-                    else:
-                        add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                        countNotFlipped += 1
-                        log.debug(f"  rte_nm '{rte_nm}' is a PR with ascending MP and does not need to be flipped")
-
-                        continue
-
-                if rte_nm.startswith('S-VA') and (begin_mp > end_mp or begin_mp == end_mp) and (rte_nm[7:9] == 'NP'):
-                    if rte_nm in LRS_RTE_ERRORS__REVERSED_MP:
-                        log.debug(f"  rte_nm '{rte_nm}' is digitized backwards and needs to be flipped")
-                        needsFlip = True
-                    else:
-                        add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                        countNotFlipped += 1
-                        log.debug(f"  rte_nm '{rte_nm}' is a NP with descending MP and does not need to be flipped")
-
-                        continue
-
-
-                if rte_nm in LRS_RTE_ERRORS__REVERSED_MP and needsFlip == False:
-                    log.debug(f"  rte_nm '{rte_nm}' is digitized backwards and does not needs to be flipped")
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-
-                    continue
-
-                if 'RMP' in rte_nm:
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' is a ramp and does not need to be flipped")
-
-                    continue
-
-                if rte_nm.startswith('R-VA') and ('PA' in rte_nm):
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' is a PA route and does not need to be flipped")
-
-                    continue
-
-                if rte_nm.startswith('R-VA') and (begin_mp < end_mp or begin_mp == end_mp) and ('NB' in rte_nm or 'EB' in rte_nm):
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' does not need to be flipped")
-
-                    continue
-
-                if rte_nm.startswith('R-VA') and (begin_mp > end_mp or begin_mp == end_mp) and ('SB' in rte_nm or 'WB' in rte_nm):
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' does not need to be flipped")
-
-                    continue
-
-
-                log.debug(f"  rte_nm '{rte_nm}' needs to be flipped - begin_msr = {begin_mp}  end_msr = {end_mp}")
-                new_rte_nm = oppRteDict[rte_nm]
-                log.debug(f"    New rte_nm: '{new_rte_nm}'")
-                new_begin_mp, new_end_mp = get_msr(geom, LRSGeomDict, new_rte_nm)
-                log.debug(f"    New begin and end msr: {new_begin_mp}, {new_end_mp}")
-                add_to_event_table(id, new_rte_nm, new_begin_mp, new_end_mp)
-                countFlipped += 1
-
-            except Exception as e:
-                log.debug(e)
-                log.debug(f'  Error processing {id}')
-                add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                countError += 1
-                errorList.append(id)
+    # If the begin_mp > end_mp, move to the opposite route.  Otherwise, keep the same
+    flipEvents = events[~carried].copy()
+    flipEvents['order'] = np.flatnonzero(~carried)
+    decisions, reasons = get_flip_decisions(flipEvents, oppRteDict)
+    flipped = decisions == FLIP
+
+    if log.isEnabledFor(logging.DEBUG):
+        for id, rte_nm, begin_mp, end_mp, reason in zip(flipEvents['id'], flipEvents['rte_nm'], flipEvents['begin_mp'], flipEvents['end_mp'], reasons):
+            log.debug(f"{id} '{rte_nm}' ({begin_mp} - {end_mp}): {reason}")
+    timer.lap('rules')
+
+    # Locate every flipped event on its new route at once
+    print('Locating flipped routes...')
+    new_rte_nms = flipEvents['rte_nm'][flipped].map(oppRteDict)
+    msrs = get_msrs(list(flipEvents['geom'][flipped]), LRSRoutes, list(new_rte_nms))
+    flipEvents.loc[flipped, 'rte_nm'] = new_rte_nms
+    flipEvents.loc[flipped, 'begin_mp'] = pd.Series([msr[0] for msr in msrs], index=new_rte_nms.index, dtype=object)
+    flipEvents.loc[flipped, 'end_mp'] = pd.Series([msr[1] for msr in msrs], index=new_rte_nms.index, dtype=object)
+    timer.lap('locate')
+
+    countFlipped = int(flipped.sum())
+    countNotFlipped = int((decisions == KEEP).sum())
+    countError = int((decisions == ERROR).sum())
+    errorList = list(flipEvents['id'][decisions == ERROR])
+    countCarried = len(previous)
 
     totalSegments = sum([countNotFlipped, countFlipped, countError])
-    log.debug(f'Flip Complete\n-------------')
-    log.debug(f'    Total Segments: {totalSegments}')
-    log.debug(f'        Not Flipped: {countNotFlipped}, {round(countNotFlipped/totalSegments*100)}%')
-    log.debug(f'        Flipped: {countFlipped}, {round(countFlipped/totalSegments*100)}%')
-    log.debug(f'        Errors: {countError}, {round(countError/totalSegments*100)}%')
-    log.debug(f'        Error List: {errorList}')
-
-    df = pd.DataFrame(outputEvents)
-    df.to_csv(outputEventCSV, index=False)
+    log.info(f'Flip Complete\n-------------')
+    log.info(f'    Total Segments: {totalSegments}')
+    if totalSegments:
+        log.info(f'        Not Flipped: {countNotFlipped}, {round(countNotFlipped/totalSegments*100)}%')
+        log.info(f'        Flipped: {countFlipped}, {round(countFlipped/totalSegments*100)}%')
+        log.info(f'        Errors: {countError}, {round(countError/totalSegments*100)}%')
+    for reason, n in pd.Series(reasons, dtype=object).value_counts().items():
+        log.info(f'          {reason}: {n}')
+    log.info(f'        Error List: {errorList}')
+    if xdSegIDs is not None:
+        log.info(f'    Carried forward from {previousCSV}: {countCarried}')
+
+    flipEvents = flipEvents[['id', 'rte_nm', 'begin_mp', 'end_mp', 'order']]
+    flipEvents.columns = [idField, rte_nmField, begin_mpField, end_mpField, 'order']
+    df = pd.concat([flipEvents, previous])
+    df = df.sort_values('order', kind='stable')[[idField, rte_nmField, begin_mpField, end_mpField]]
+    if outputEventCSV is not None:
+        df.to_csv(outputEventCSV, index=False)
+    timer.lap('write')
+    timer.total()
+
+    metrics.count('flip.events', len(df))
+    metrics.count('flip.flipped', countFlipped)
+    metrics.save_metrics(conflationName)
+
+    return df
 
 
 if __name__ == '__main__':
-
-    # Create a dictionary of opposite direction routes
-    print('Creating opposite direction route dict')
-    inputRoutes = set([row[0] for row in arcpy.da.SearchCursor(inputEventLayer, rte_nmField)])
-    oppRteDict = {}
-    with arcpy.da.SearchCursor(overlapLRS, ['RTE_NM', 'RTE_OPPOSITE_DIRECTION_RTE_NM']) as cur:
-        for rte_nm, opp_rte_nm in cur:
-            if rte_nm in inputRoutes:
-                oppRteDict[rte_nm] = opp_rte_nm
-
-    # Create dictionary for XD Geometries to save time on search cursors
-    # print('Creating XD geometry dict')
-    # XDGeomDict = {int(row[0]):row[1] for row in arcpy.da.SearchCursor(inputXD, ['XDSegID','SHAPE@'])}
-
-    # Create dictionary for LRS Geometries to save time on search cursors
-    print('Creating LRS geometry dict')
-    LRSGeomDict = {row[0]:row[1] for row in arcpy.da.SearchCursor(overlapLRS, ['RTE_NM','SHAPE@'])}
-
-    
-    print('Flipping Routes...')
-    # For each record in input layer, if the begin_mp > end_mp, move to the opposite route.  Otherwise, keep the same
-    with arcpy.da.SearchCursor(inputEventLayer, [idField, rte_nmField, begin_mpField, end_mpField, 'SHAPE@', 'XDSegID']) as cur:
-        for id, rte_nm, begin_mp, end_mp, geom, XDSegID in cur:
-            log.debug(f'\nProcessing {id}')
-            try:
-                needsFlip = False
-                if rte_nm not in oppRteDict.keys():
-                    log.debug(f"  '{rte_nm}' does not have an opposite route and doesn't need to be flipped")
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-
-                    continue
-
-                if rte_nm.startswith('S-VA') and (begin_mp < end_mp or begin_mp == end_mp) and (rte_nm[7:9] == 'PR'):
-                    if rte_nm in LRS_RTE_ERRORS__REVERSED_MP:
-                        log.debug(f"  rte_nm '{rte_nm}' is digitized backwards and needs to be flipped")
-                        needsFlip = True
-                    else:
-                        add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                        countNotFlipped += 1
-                        log.debug(f"  rte_nm '{rte_nm}' is a PR with ascending MP and does not need to be flipped")
-
-                        continue
-
-                if rte_nm.startswith('S-VA') and (begin_mp > end_mp or begin_mp == end_mp) and (rte_nm[7:9] == 'NP'):
-                    if rte_nm in LRS_RTE_ERRORS__REVERSED_MP:
-                        log.debug(f"  rte_nm '{rte_nm}' is digitized backwards and needs to be flipped")
-                        needsFlip = True
-                    else:
-                        add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                        countNotFlipped += 1
-                        log.debug(f"  rte_nm '{rte_nm}' is a NP with descending MP and does not need to be flipped")
-
-                        continue
-
-
-                if rte_nm in LRS_RTE_ERRORS__REVERSED_MP and needsFlip == False:
-                    log.debug(f"  rte_nm '{rte_nm}' is digitized backwards and does not needs to be flipped")
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-
-                    continue
-
-                if 'RMP' in rte_nm:
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' is a ramp and does not need to be flipped")
-
-                    continue
-
-                if rte_nm.startswith('R-VA') and ('PA' in rte_nm):
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' is a PA route and does not need to be flipped")
-
-                    continue
-
-                if rte_nm.startswith('R-VA') and (begin_mp < end_mp or begin_mp == end_mp) and ('NB' in rte_nm or 'EB' in rte_nm):
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' does not need to be flipped")
-
-                    continue
-
-                if rte_nm.startswith('R-VA') and (begin_mp > end_mp or begin_mp == end_mp) and ('SB' in rte_nm or 'WB' in rte_nm):
-                    add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                    countNotFlipped += 1
-                    log.debug(f"  rte_nm '{rte_nm}' does not need to be flipped")
-
-                    continue
-
-
-                log.debug(f"  rte_nm '{rte_nm}' needs to be flipped - begin_msr = {begin_mp}  end_msr = {end_mp}")
-                new_rte_nm = oppRteDict[rte_nm]
-                log.debug(f"    New rte_nm: '{new_rte_nm}'")
-                new_begin_mp, new_end_mp = get_msr(geom, LRSGeomDict, new_rte_nm)
-                log.debug(f"    New begin and end msr: {new_begin_mp}, {new_end_mp}")
-                add_to_event_table(id, new_rte_nm, new_begin_mp, new_end_mp)
-                countFlipped += 1
-
-            except Exception as e:
-                log.debug(e)
-                log.debug(f'  Error processing {id}')
-                add_to_event_table(id, rte_nm, begin_mp, end_mp)
-                countError += 1
-                errorList.append(id)
-
-    totalSegments = sum([countNotFlipped, countFlipped, countError])
-    log.debug(f'Flip Complete\n-------------')
-    log.debug(f'    Total Segments: {totalSegments}')
-    log.debug(f'        Not Flipped: {countNotFlipped}, {round(countNotFlipped/totalSegments*100)}%')
-    log.debug(f'        Flipped: {countFlipped}, {round(countFlipped/totalSegments*100)}%')
-    log.debug(f'        Errors: {countError}, {round(countError/totalSegments*100)}%')
-    log.debug(f'        Error List: {errorList}')
-
-    df = pd.DataFrame(outputEvents)
-    df.to_csv(outputEventCSV, index=False)
\ No newline at end of file
+    run_flip_routes('flipRoutes', inputEventLayer, outputEventCSV, inputXD, overlapLRS)
@@ -0,0 +1,675 @@
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+import numpy as np
+from metrics import count
+
+"""
+Geometry backends for the conflation engine.
+
+The engine only uses a small part of the arcpy geometry API (points, point
+geometries and M-aware polylines with positionAlongLine, measureOnLine,
+distanceTo and getLength).  The numpy backend implements that same API on
+NumPy vertex arrays, so the engine runs without ArcGIS (eg. on Linux batch
+nodes) and without the per-call overhead of arcpy geometry methods.
+
+Use get_backend('arcpy') or get_backend('numpy').  Feature classes can be
+replaced by a MemoryTable when running without arcpy.
+"""
+
+# GRS 1980 ellipsoid
+ELLIPSOID_A = 6378137.0
+ELLIPSOID_F = 1 / 298.257222101
+ELLIPSOID_E2 = ELLIPSOID_F * (2 - ELLIPSOID_F)
+
+# Lambert conformal conic (2SP) parameters by spatial reference factory code:
+# (standard parallel 1, standard parallel 2, latitude of origin, central meridian, false easting, false northing)
+LAMBERT_CONFORMAL_CONIC = {
+    3968: (37, 39.5, 36, -79.5, 0, 0),  # NAD83 / Virginia Lambert
+    3969: (37, 39.5, 36, -79.5, 0, 0),  # NAD83(HARN) / Virginia Lambert
+    3970: (37, 39.5, 36, -79.5, 0, 0)   # NAD83(NSRS2007) / Virginia Lambert
+}
+
+GEOGRAPHIC = (4269, 4326)
+
+LINEAR_UNITS = {
+    'METERS': 1.0,
+    'KILOMETERS': 1000.0,
+    'FEET': 0.3048,
+    'MILES': 1609.344
+}
+
+
+def get_vertex_arrays(geom):
+    """ Returns a list of (n, 3) arrays of X, Y, M values, one for each part
+        of the input polyline """
+    if isinstance(geom, MPolyline):
+        return geom.parts
+
+    parts = []
+    for part in geom:
+        coords = [(point.X, point.Y, point.M if point.M is not None else np.nan) for point in part if point]
+        if coords:
+            parts.append(np.array(coords, dtype=float))
+
+    return parts
+
+
+def point_to_segment_distance(x, y, x0, y0, x1, y1):
+    """ Returns the planar distance from the point (x, y) to each of the
+        segments described by the arrays x0, y0, x1, y1 """
+    dx = x1 - x0
+    dy = y1 - y0
+    segLenSq = dx * dx + dy * dy
+
+    # Zero length segments are treated as points
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((x - x0) * dx + (y - y0) * dy) / segLenSq
+    t = np.where(segLenSq > 0, np.clip(t, 0, 1), 0)
+
+    return np.hypot(x0 + t * dx - x, y0 + t * dy - y)
+
+
+def get_factory_code(spatialReference):
+    """ Returns the factory code of an arcpy SpatialReference, or the input if it is already a code """
+    return getattr(spatialReference, 'factoryCode', spatialReference)
+
+
+def to_geographic(x, y, spatialReference):
+    """ Converts projected coordinates to (latitude, longitude) in radians """
+    code = get_factory_code(spatialReference)
+    if code in GEOGRAPHIC:
+        return np.radians(y), np.radians(x)
+
+    if code not in LAMBERT_CONFORMAL_CONIC:
+        raise ValueError(f'Geodesic measurements are not supported for spatial reference {code}')
+
+    lat1, lat2, lat0, lon0, falseEasting, falseNorthing = np.radians(LAMBERT_CONFORMAL_CONIC[code][:4]).tolist() + list(LAMBERT_CONFORMAL_CONIC[code][4:])
+    e = np.sqrt(ELLIPSOID_E2)
+
+    def m(lat):
+        return np.cos(lat) / np.sqrt(1 - ELLIPSOID_E2 * np.sin(lat) ** 2)
+
+    def t(lat):
+        return np.tan(np.pi / 4 - lat / 2) / ((1 - e * np.sin(lat)) / (1 + e * np.sin(lat))) ** (e / 2)
+
+    n = (np.log(m(lat1)) - np.log(m(lat2))) / (np.log(t(lat1)) - np.log(t(lat2)))
+    F = m(lat1) / (n * t(lat1) ** n)
+    rF = ELLIPSOID_A * F * t(lat0) ** n
+
+    dx = np.asarray(x, dtype=float) - falseEasting
+    dy = rF - (np.asarray(y, dtype=float) - falseNorthing)
+    r = np.sign(n) * np.hypot(dx, dy)
+    theta = np.arctan2(dx, dy)
+    tPrime = (r / (ELLIPSOID_A * F)) ** (1 / n)
+
+    lat = np.pi / 2 - 2 * np.arctan(tPrime)
+    for i in range(10):
+        lat = np.pi / 2 - 2 * np.arctan(tPrime * ((1 - e * np.sin(lat)) / (1 + e * np.sin(lat))) ** (e / 2))
+    lon = theta / n + lon0
+
+    return lat, lon
+
+
+def geodesic_distance(lat1, lon1, lat2, lon2):
+    """ Returns the ellipsoidal distance in meters between arrays of points given
+        in radians.  Uses the meridional and prime vertical radii of curvature at
+        the mid-latitude of each pair, which is accurate to well under a millimeter
+        for the vertex spacing of road centerlines. """
+    latMid = (lat1 + lat2) / 2
+    sinLat = np.sin(latMid)
+    w = np.sqrt(1 - ELLIPSOID_E2 * sinLat ** 2)
+    meridionalRadius = ELLIPSOID_A * (1 - ELLIPSOID_E2) / w ** 3
+    primeVerticalRadius = ELLIPSOID_A / w
+
+    dLon = (lon2 - lon1 + np.pi) % (2 * np.pi) - np.pi
+    return np.hypot(meridionalRadius * (lat2 - lat1), primeVerticalRadius * np.cos(latMid) * dLon)
+
+
+class MPoint:
+    """ NumPy backend stand-in for arcpy.Point """
+
+    def __init__(self, X=None, Y=None, Z=None, M=None):
+        self.X = X
+        self.Y = Y
+        self.Z = Z
+        self.M = M
+
+
+    def __repr__(self):
+        return f'<MPoint {self.X}, {self.Y}, M={self.M}>'
+
+
+def get_xy(geom):
+    """ Returns (x, y) for a point or point geometry from either backend """
+    point = getattr(geom, 'firstPoint', geom)
+    return point.X, point.Y
+
+
+class MPointGeometry:
+    """ NumPy backend stand-in for arcpy.PointGeometry """
+
+    def __init__(self, point, spatialReference=None):
+        self.firstPoint = point
+        self.lastPoint = point
+        self.spatialReference = spatialReference
+        self.centroid = point
+
+
+    def distanceTo(self, other):
+        if isinstance(other, MPolyline):
+            return other.distanceTo(self)
+
+        x, y = get_xy(self)
+        ox, oy = get_xy(other)
+        return float(np.hypot(ox - x, oy - y))
+
+
+    def angleAndDistanceTo(self, other, method='PLANAR'):
+        """ Returns (angle, distance), with the angle in degrees clockwise from north """
+        x, y = get_xy(self)
+        ox, oy = get_xy(other)
+        return float(np.degrees(np.arctan2(ox - x, oy - y))), float(np.hypot(ox - x, oy - y))
+
+
+class MPolyline:
+    """ NumPy backend stand-in for an M-aware arcpy.Polyline.  parts is a list of
+        (n, 3) arrays of X, Y, M values.
+
+        Distances along the line are planar and run continuously from the first
+        part to the last, the same as arcpy.
+    """
+
+    def __init__(self, parts, spatialReference=None):
+        self.parts = [np.asarray(part, dtype=float).reshape(-1, 3) for part in parts if len(part)]
+        self.spatialReference = spatialReference
+
+        # Segment arrays for every part, in order, with the distance along the line at each segment start
+        segments = []
+        for part in self.parts:
+            if len(part) == 1:
+                part = np.concatenate([part, part])
+            segments.append(np.column_stack([part[:-1], part[1:]]))
+        self.segments = np.concatenate(segments) if segments else np.empty((0, 6))
+        self.segmentLengths = np.hypot(self.segments[:, 3] - self.segments[:, 0], self.segments[:, 4] - self.segments[:, 1])
+        self.segmentStarts = np.concatenate([[0], np.cumsum(self.segmentLengths)[:-1]]) if len(self.segments) else np.empty(0)
+        self.length = float(self.segmentLengths.sum())
+
+
+    def __bool__(self):
+        return len(self.parts) > 0
+
+
+    def __iter__(self):
+        for i in range(self.partCount):
+            yield self.getPart(i)
+
+
+    def __getitem__(self, i):
+        return self.getPart(i)
+
+
+    def __repr__(self):
+        return f'<MPolyline {self.partCount} parts, {round(self.length, 2)}m>'
+
+
+    @property
+    def partCount(self):
+        return len(self.parts)
+
+
+    @property
+    def isMultipart(self):
+        return len(self.parts) > 1
+
+
+    @property
+    def pointCount(self):
+        return sum(len(part) for part in self.parts)
+
+
+    @property
+    def firstPoint(self):
+        return MPoint(*self.parts[0][0, :2].tolist(), M=self.parts[0][0, 2])
+
+
+    @property
+    def lastPoint(self):
+        return MPoint(*self.parts[-1][-1, :2].tolist(), M=self.parts[-1][-1, 2])
+
+
+    @property
+    def centroid(self):
+        """ The length weighted center of the line's segments """
+        if self.length == 0:
+            return self.firstPoint
+        midX = (self.segments[:, 0] + self.segments[:, 3]) / 2
+        midY = (self.segments[:, 1] + self.segments[:, 4]) / 2
+        return MPoint(float((midX * self.segmentLengths).sum() / self.length), float((midY * self.segmentLengths).sum() / self.length))
+
+
+    def getPart(self, i):
+        return [MPoint(x, y, M=m) for x, y, m in self.parts[i].tolist()]
+
+
+    def getLength(self, measurement_type='PLANAR', units='METERS'):
+        if measurement_type.upper() == 'GEODESIC':
+            lat, lon = to_geographic(self.segments[:, [0, 3]], self.segments[:, [1, 4]], self.spatialReference)
+            length = float(geodesic_distance(lat[:, 0], lon[:, 0], lat[:, 1], lon[:, 1]).sum())
+        else:
+            length = self.length
+
+        return length / LINEAR_UNITS[units.upper()]
+
+
+    def positionAlongLine(self, value, use_percentage=False):
+        """ Returns the point geometry at a distance (or fraction of the length) along the line """
+        distance = value * self.length if use_percentage else value
+        distance = min(max(distance, 0), self.length)
+
+        i = int(np.searchsorted(self.segmentStarts, distance, side='right') - 1)
+        i = min(max(i, 0), len(self.segments) - 1)
+        x0, y0, m0, x1, y1, m1 = self.segments[i].tolist()
+        segLen = float(self.segmentLengths[i])
+        t = float(distance - self.segmentStarts[i]) / segLen if segLen > 0 else 0
+        t = min(max(t, 0), 1)
+
+        point = MPoint(x0 + t * (x1 - x0), y0 + t * (y1 - y0), M=m0 + t * (m1 - m0))
+        return MPointGeometry(point, self.spatialReference)
+
+
+    def locate(self, x, y):
+        """ Returns (segment index, t, distance) of the closest point on the line to (x, y) """
+        seg = self.segments
+        dx = seg[:, 3] - seg[:, 0]
+        dy = seg[:, 4] - seg[:, 1]
+        segLenSq = dx * dx + dy * dy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = ((x - seg[:, 0]) * dx + (y - seg[:, 1]) * dy) / segLenSq
+        t = np.where(segLenSq > 0, np.clip(t, 0, 1), 0)
+        dists = np.hypot(seg[:, 0] + t * dx - x, seg[:, 1] + t * dy - y)
+
+        i = int(np.argmin(dists))
+        return i, float(t[i]), float(dists[i])
+
+
+    def measureOnLine(self, in_point, as_percentage=False):
+        """ Returns the distance along the line to the closest point on the line to in_point """
+        i, t, dist = self.locate(*get_xy(in_point))
+        distance = float(self.segmentStarts[i] + t * self.segmentLengths[i])
+        if as_percentage:
+            return distance / self.length if self.length else 0
+        return distance
+
+
+    def queryPointAndDistance(self, in_point, as_percentage=False):
+        """ Returns (point geometry, distance along, distance from, right side) like arcpy """
+        x, y = get_xy(in_point)
+        i, t, dist = self.locate(x, y)
+        x0, y0, m0, x1, y1, m1 = self.segments[i].tolist()
+        point = MPoint(x0 + t * (x1 - x0), y0 + t * (y1 - y0), M=m0 + t * (m1 - m0))
+        distance = float(self.segmentStarts[i] + t * self.segmentLengths[i])
+        if as_percentage:
+            distance = distance / self.length if self.length else 0
+        rightSide = (x1 - x0) * (y - y0) - (y1 - y0) * (x - x0) < 0
+
+        return MPointGeometry(point, self.spatialReference), distance, dist, bool(rightSide)
+
+
+    def distanceTo(self, other):
+        """ Returns the planar distance to a point or another polyline """
+        if not isinstance(other, MPolyline):
+            x, y = get_xy(other)
+            return self.locate(x, y)[2]
+
+        return float(polyline_distance(self.segments, other.segments))
+
+
+def segments_intersect(a, b):
+    """ Returns True for each pair of segments in a and b (broadcast) that cross or touch """
+    def orientation(px, py, qx, qy, rx, ry):
+        return np.sign((qx - px) * (ry - py) - (qy - py) * (rx - px))
+
+    ax0, ay0, ax1, ay1 = a[..., 0], a[..., 1], a[..., 3], a[..., 4]
+    bx0, by0, bx1, by1 = b[..., 0], b[..., 1], b[..., 3], b[..., 4]
+    o1 = orientation(ax0, ay0, ax1, ay1, bx0, by0)
+    o2 = orientation(ax0, ay0, ax1, ay1, bx1, by1)
+    o3 = orientation(bx0, by0, bx1, by1, ax0, ay0)
+    o4 = orientation(bx0, by0, bx1, by1, ax1, ay1)
+
+    return (o1 != o2) & (o3 != o4)
+
+
+def polyline_distance(segmentsA, segmentsB, chunkSize=1000000):
+    """ Returns the minimum planar distance between two sets of (n, 6) segments """
+    closest = np.inf
+    chunk = max(1, chunkSize // max(len(segmentsB), 1))
+    for start in range(0, len(segmentsA), chunk):
+        a = segmentsA[start:start + chunk][:, None, :]
+        b = segmentsB[None, :, :]
+        if segments_intersect(a, b).any():
+            return 0.0
+
+        dists = np.minimum.reduce([
+            point_to_segment_distance(a[..., 0], a[..., 1], b[..., 0], b[..., 1], b[..., 3], b[..., 4]),
+            point_to_segment_distance(a[..., 3], a[..., 4], b[..., 0], b[..., 1], b[..., 3], b[..., 4]),
+            point_to_segment_distance(b[..., 0], b[..., 1], a[..., 0], a[..., 1], a[..., 3], a[..., 4]),
+            point_to_segment_distance(b[..., 3], b[..., 4], a[..., 0], a[..., 1], a[..., 3], a[..., 4])
+        ])
+        closest = min(closest, float(dists.min()))
+
+    return closest
+
+
+def get_route_event(geom, beginMP, endMP, spatialReference=None):
+    """ Returns the part of a route between two measures as an MPolyline, like a line
+        event from MakeRouteEventLayer.  The line runs from beginMP to endMP, so it is
+        reversed when beginMP > endMP.  Returns None if no part of the route is
+        between the measures.
+    Input:
+        geom - an M-aware route polyline whose measures change monotonically along each part
+    """
+    mLo, mHi = min(beginMP, endMP), max(beginMP, endMP)
+
+    pieces = []
+    for part in get_vertex_arrays(geom):
+        if len(part) < 2 or np.isnan(part[:, 2]).any():
+            continue
+        if part[-1, 2] < part[0, 2]:
+            part = part[::-1]
+
+        m = part[:, 2]
+        if m[-1] < mLo or m[0] > mHi:
+            continue
+
+        # Interpolate the end points and keep the vertices in between
+        lo, hi = max(mLo, m[0]), min(mHi, m[-1])
+        inside = part[(m > lo) & (m < hi)]
+        ends = [np.array([[np.interp(value, m, part[:, 0]), np.interp(value, m, part[:, 1]), value]]) for value in (lo, hi)]
+        pieces.append(np.concatenate([ends[0], inside, ends[1]]))
+
+    if not pieces:
+        return None
+
+    if beginMP > endMP:
+        pieces = [piece[::-1] for piece in pieces[::-1]]
+
+    return MPolyline(pieces, spatialReference if spatialReference is not None else getattr(geom, 'spatialReference', None))
+
+
+class ArcpyBackend:
+    """ Creates geometries with arcpy """
+
+    name = 'arcpy'
+
+    def Point(self, X, Y, M=None):
+        return arcpy.Point(X, Y, None, M)
+
+
+    def PointGeometry(self, point, spatialReference=None):
+        return arcpy.PointGeometry(point, spatialReference)
+
+
+    def SpatialReference(self, code):
+        return arcpy.SpatialReference(code)
+
+
+    def Polyline(self, parts, spatialReference=None):
+        """ Returns an M-aware polyline from a list of (n, 3) arrays of X, Y, M values """
+        array = arcpy.Array([
+            arcpy.Array([arcpy.Point(x, y, None, None if np.isnan(m) else m) for x, y, m in part.tolist()])
+            for part in parts
+        ])
+        return arcpy.Polyline(array, spatialReference, False, True)
+
+
+    def split_parts(self, geom):
+        """ Returns a list of single part polylines """
+        if geom.isMultipart:
+            return [arcpy.Polyline(geom[i], has_m=True) for i in range(geom.partCount)]
+        return [geom]
+
+
+    def buffer_intersect(self, geom1, geom2, distance):
+        """ Returns the part of geom2 within distance of geom1 """
+        return geom1.buffer(distance).intersect(geom2, 2)
+
+
+class NumpyBackend:
+    """ Creates NumPy geometries that implement the arcpy geometry methods used by the engine """
+
+    name = 'numpy'
+
+    def Point(self, X, Y, M=None):
+        return MPoint(X, Y, M=M)
+
+
+    def PointGeometry(self, point, spatialReference=None):
+        return MPointGeometry(point, spatialReference)
+
+
+    def SpatialReference(self, code):
+        return code
+
+
+    def Polyline(self, parts, spatialReference=None):
+        return MPolyline(parts, spatialReference)
+
+
+    def split_parts(self, geom):
+        """ Returns a list of single part polylines """
+        if geom.isMultipart:
+            return [MPolyline([part], geom.spatialReference) for part in geom.parts]
+        return [geom]
+
+
+    def buffer_intersect(self, geom1, geom2, distance):
+        """ Returns the part of geom2 within distance of geom1.
+
+            The buffer of geom1 is the union of a capsule around each of its segments.  A
+            segment of geom2 crosses a capsule over a single interval of its length, found
+            from where it crosses the capsule's two end circles and its rectangle, so
+            segments that pass through the buffer without a vertex inside it are clipped
+            too.  Returns an empty MPolyline if no part of geom2 is within distance. """
+        segmentsA = geom1.segments
+        ax0, ay0, ax1, ay1 = segmentsA[:, 0], segmentsA[:, 1], segmentsA[:, 3], segmentsA[:, 4]
+        aLength = np.hypot(ax1 - ax0, ay1 - ay0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ux = np.where(aLength > 0, (ax1 - ax0) / aLength, 0)
+            uy = np.where(aLength > 0, (ay1 - ay0) / aLength, 0)
+
+        def circle_interval(px, py, dx, dy, cx, cy):
+            """ The t range of each line P + tD inside the circles around (cx, cy) """
+            a = dx * dx + dy * dy
+            b = dx * (px - cx) + dy * (py - cy)
+            c = (px - cx) ** 2 + (py - cy) ** 2 - distance * distance
+            root = np.sqrt(np.maximum(b * b - a * c, 0))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                lo, hi = (-b - root) / a, (-b + root) / a
+            isHit = (b * b - a * c >= 0) & (a > 0)
+            return np.where(isHit, lo, np.inf), np.where(isHit, hi, -np.inf)
+
+        def slab_interval(alpha, beta, lo, hi):
+            """ The t range where lo <= alpha + t * beta <= hi """
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t0, t1 = (lo - alpha) / beta, (hi - alpha) / beta
+            isFlat = beta == 0
+            isInside = (alpha >= lo) & (alpha <= hi)
+            return (np.where(isFlat, np.where(isInside, -np.inf, np.inf), np.minimum(t0, t1)),
+                    np.where(isFlat, np.where(isInside, np.inf, -np.inf), np.maximum(t0, t1)))
+
+        xMin, yMin = segmentsA[:, [0, 3]].min() - distance, segmentsA[:, [1, 4]].min() - distance
+        xMax, yMax = segmentsA[:, [0, 3]].max() + distance, segmentsA[:, [1, 4]].max() + distance
+
+        pieces = []
+        for part in geom2.parts:
+            if len(part) < 2 or not len(segmentsA):
+                continue
+
+            # Only the segments that overlap the extent of the buffer are clipped
+            rows = np.flatnonzero(
+                (np.minimum(part[:-1, 0], part[1:, 0]) <= xMax) & (np.maximum(part[:-1, 0], part[1:, 0]) >= xMin) &
+                (np.minimum(part[:-1, 1], part[1:, 1]) <= yMax) & (np.maximum(part[:-1, 1], part[1:, 1]) >= yMin)
+            )
+            p0, p1 = part[rows], part[rows + 1]
+            px, py = p0[:, 0:1], p0[:, 1:2]
+            dx, dy = p1[:, 0:1] - px, p1[:, 1:2] - py
+
+            # Intervals of each segment of the part (rows) inside each capsule (columns)
+            lo1, hi1 = circle_interval(px, py, dx, dy, ax0, ay0)
+            lo2, hi2 = circle_interval(px, py, dx, dy, ax1, ay1)
+            sLo, sHi = slab_interval(ux * (px - ax0) + uy * (py - ay0), ux * dx + uy * dy, 0, aLength)
+            hLo, hHi = slab_interval(ux * (py - ay0) - uy * (px - ax0), ux * dy - uy * dx, -distance, distance)
+            rectLo = np.where(aLength > 0, np.maximum(sLo, hLo), np.inf)
+            rectHi = np.where(aLength > 0, np.minimum(sHi, hHi), -np.inf)
+            rectLo, rectHi = np.where(rectLo <= rectHi, rectLo, np.inf), np.where(rectLo <= rectHi, rectHi, -np.inf)
+
+            # A capsule is convex, so the pieces inside its circles and rectangle form one interval
+            lo = np.clip(np.minimum(np.minimum(lo1, lo2), rectLo), 0, 1)
+            hi = np.clip(np.maximum(np.maximum(hi1, hi2), rectHi), 0, 1)
+            isHit = (np.minimum(np.minimum(lo1, lo2), rectLo) <= 1) & (np.maximum(np.maximum(hi1, hi2), rectHi) >= 0) & (lo <= hi)
+
+            # Merge the intervals of each segment and join pieces that continue onto the next segment
+            runs = []
+            for i in np.flatnonzero(isHit.any(axis=1)):
+                intervals = sorted(zip(lo[i][isHit[i]], hi[i][isHit[i]]))
+                merged = [list(intervals[0])]
+                for t0, t1 in intervals[1:]:
+                    if t0 <= merged[-1][1]:
+                        merged[-1][1] = max(merged[-1][1], t1)
+                    else:
+                        merged.append([t0, t1])
+
+                for t0, t1 in merged:
+                    start = p0[i] + (p1[i] - p0[i]) * t0
+                    end = p0[i] + (p1[i] - p0[i]) * t1
+                    if runs and t0 <= 1e-9 and runs[-1][1] == rows[i] - 1 and runs[-1][2] >= 1 - 1e-9:
+                        runs[-1][0].append(end)
+                        runs[-1][1:] = [rows[i], t1]
+                    else:
+                        runs.append([[start, end], rows[i], t1])
+            pieces += [np.array(points) for points, i, t1 in runs]
+
+        return MPolyline([piece for piece in pieces if len(piece) > 1], geom2.spatialReference)
+
+
+class MemoryTable:
+    """ An in-memory stand-in for a feature class, for running the conflation without arcpy.
+
+        rows is a list of tuples in the order of fields.  Search cursors support the
+        'OID@' token (1-based row position), 'SHAPE@' and 'SHAPE@XY', and where
+        clauses given as functions of a {field: value} dict instead of SQL.
+    """
+
+    OIDFieldName = 'OBJECTID'
+
+    def __init__(self, fields, rows, spatialReference=None):
+        self.fields = list(fields)
+        self.rows = list(rows)
+        self.spatialReference = spatialReference
+        self.shapeField = next((field for field in self.fields if field.upper() in ('SHAPE@', 'SHAPE')), None)
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def get_value(self, oid, row, field):
+        if field in ('OID@', self.OIDFieldName):
+            return oid
+        if field in ('SHAPE@', 'SHAPE'):
+            return row[self.fields.index(self.shapeField)]
+        if field == 'SHAPE@XY':
+            return get_xy(row[self.fields.index(self.shapeField)])
+        return row[self.fields.index(field)]
+
+
+    def search(self, fields, where=None):
+        """ Returns a MemoryCursor over the rows that match where """
+        if isinstance(fields, str):
+            fields = [fields]
+        if isinstance(where, str) and where.strip():
+            raise ValueError('MemoryTable where clauses must be functions of a {field: value} dict, not SQL')
+
+        records = []
+        for oid, row in enumerate(self.rows, start=1):
+            if callable(where):
+                rowDict = dict(zip(self.fields, row))
+                rowDict[self.OIDFieldName] = oid
+                if not where(rowDict):
+                    continue
+            records.append(tuple(self.get_value(oid, row, field) for field in fields))
+
+        return MemoryCursor(records)
+
+
+class MemoryCursor(list):
+    """ A list of rows that can be used like an arcpy search cursor """
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        return False
+
+
+class RangeFilter:
+    """ A picklable MemoryTable where clause: lo <= field <= hi, combined with an optional other clause """
+
+    def __init__(self, field, lo, hi, where=None):
+        self.field = field
+        self.lo = lo
+        self.hi = hi
+        self.where = where
+
+
+    def __call__(self, row):
+        return self.lo <= row[self.field] <= self.hi and (not callable(self.where) or self.where(row))
+
+
+class ValueFilter:
+    """ A picklable MemoryTable where clause: field == value, combined with an optional other clause """
+
+    def __init__(self, field, value, where=None):
+        self.field = field
+        self.value = value
+        self.where = where
+
+
+    def __call__(self, row):
+        return row[self.field] == self.value and (not callable(self.where) or self.where(row))
+
+
+def search_cursor(source, fields, where=None):
+    """ Returns a search cursor over a feature class, layer or MemoryTable """
+    count('search_cursor')
+    if isinstance(source, MemoryTable):
+        return source.search(fields, where)
+
+    return arcpy.da.SearchCursor(source, fields, where)
+
+
+def get_spatial_reference(source):
+    if isinstance(source, MemoryTable):
+        return source.spatialReference
+
+    return arcpy.Describe(source).spatialReference
+
+
+backends = {
+    'arcpy': ArcpyBackend,
+    'numpy': NumpyBackend
+}
+
+
+def get_backend(name=None):
+    """ Returns the named geometry backend.  Defaults to arcpy if it is installed. """
+    if name is None:
+        name = 'arcpy' if arcpy is not None else 'numpy'
+
+    if name == 'arcpy' and arcpy is None:
+        raise ImportError('The arcpy geometry backend requires ArcGIS Pro')
+
+    return backends[name]()
@@ -0,0 +1,185 @@
+import numpy as np
+from geometry_backend import get_vertex_arrays, point_to_segment_distance
+
+"""
+Vectorized Hausdorff distance between polylines, shared by xd_to_rns and AutoQC.
+
+Geometries are converted to NumPy vertex arrays once and every vertex is scored
+against every segment of the other geometry in bulk, rather than building a
+PointGeometry and calling distanceTo for each vertex.
+"""
+
+# Maximum number of point-segment distances computed at once.  Keeps the
+# distance matrix for long freeway routes to a few MB.
+CHUNK_SIZE = 1000000
+
+
+def get_points(geom):
+    """ Returns an (n, 2) array of every vertex in the input geometry.  geom can
+        be an arcpy polyline, a list of vertex arrays or an array of points. """
+    if isinstance(geom, np.ndarray):
+        return geom[:, :2]
+
+    parts = geom if isinstance(geom, list) else get_vertex_arrays(geom)
+    if not parts:
+        return np.empty((0, 2))
+
+    return np.concatenate([part[:, :2] for part in parts])
+
+
+def get_segments(geom):
+    """ Returns an (n, 4) array of x0, y0, x1, y1 for every segment in the input
+        geometry.  Single vertex parts are kept as zero length segments. """
+    parts = geom if isinstance(geom, list) else get_vertex_arrays(geom)
+    segments = []
+    for part in parts:
+        if len(part) == 1:
+            part = np.concatenate([part, part])
+        segments.append(np.column_stack([part[:-1, 0], part[:-1, 1], part[1:, 0], part[1:, 1]]))
+
+    if not segments:
+        return np.empty((0, 4))
+
+    return np.concatenate(segments)
+
+
+def iter_point_distances(points, segments):
+    """ Yields the distance from each point to the closest segment, in chunks
+        of points """
+    chunk = max(1, CHUNK_SIZE // max(len(segments), 1))
+    x0, y0, x1, y1 = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    for start in range(0, len(points), chunk):
+        pts = points[start:start + chunk]
+        dists = point_to_segment_distance(pts[:, 0:1], pts[:, 1:2], x0, y0, x1, y1)
+        yield dists.min(axis=1)
+
+
+def point_distances(points, geom):
+    """ Returns the distance from each of the input (n, 2) points to geom """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    segments = get_segments(geom)
+    if len(points) == 0:
+        return np.empty(0)
+
+    return np.concatenate(list(iter_point_distances(points, segments)))
+
+
+def directed_hausdorff(geom1, geom2, normalized=False, threshold=None):
+    """ Returns the largest distance from a vertex of geom1 to geom2.
+
+    Input:
+        geom1, geom2 - arcpy polylines, lists of vertex arrays, or (n, 2) point arrays for geom1
+        normalized - reduce each distance by the minimum distance.  This will "move" the
+                     closest parts of geom1 and geom2 together to better compare geometry shape
+        threshold - stop as soon as the result is known to be larger than threshold.  The
+                    returned value is then a lower bound that is still larger than threshold.
+    Output:
+        hausdorff distance
+    """
+    points = get_points(geom1)
+    segments = get_segments(geom2)
+    if len(points) == 0 or len(segments) == 0:
+        raise ValueError('Cannot compute hausdorff distance of an empty geometry')
+
+    maxDist = -np.inf
+    minDist = np.inf
+    for dists in iter_point_distances(points, segments):
+        maxDist = max(maxDist, dists.max())
+        minDist = min(minDist, dists.min())
+
+        hausdorff = maxDist - minDist if normalized else maxDist
+        if threshold is not None and hausdorff > threshold:
+            break
+
+    return float(maxDist - minDist if normalized else maxDist)
+
+
+def hausdorff_distance(geom1, geom2, normalized=False, threshold=None):
+    """ Returns the directed hausdorff distance both ways as (geom1 to geom2, geom2 to geom1) """
+    return (
+        directed_hausdorff(geom1, geom2, normalized, threshold),
+        directed_hausdorff(geom2, geom1, normalized, threshold)
+    )
+
+
+def get_pair_distances(points, segments):
+    """ Returns the distance from each point to the closest of its own segments, for a
+        batch of geometry pairs.
+    Input:
+        points - list of (n, 2) point arrays, one for each pair
+        segments - list of (m, 4) segment arrays, one for each pair
+    Output:
+        (distances, pointCounts) - the distances of every point, in order, and the number of points in each pair
+    """
+    pointCounts = np.array([len(pts) for pts in points])
+    segmentCounts = np.array([len(segs) for segs in segments])
+    allPoints = np.concatenate(points)
+    allSegments = np.concatenate(segments)
+
+    # Every combination of a point with a segment of the same pair, grouped by point
+    pointPair = np.repeat(np.arange(len(points)), pointCounts)
+    counts = segmentCounts[pointPair]
+    groupStarts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    pointIndex = np.repeat(np.arange(len(allPoints)), counts)
+    segmentStarts = np.concatenate([[0], np.cumsum(segmentCounts)[:-1]])
+    segmentIndex = np.repeat(segmentStarts[pointPair] - groupStarts, counts) + np.arange(counts.sum())
+
+    pts = allPoints[pointIndex]
+    segs = allSegments[segmentIndex]
+    dists = point_to_segment_distance(pts[:, 0], pts[:, 1], segs[:, 0], segs[:, 1], segs[:, 2], segs[:, 3])
+
+    return np.minimum.reduceat(dists, groupStarts), pointCounts
+
+
+def directed_hausdorff_pairs(geoms1, geoms2):
+    """ Bulk version of directed_hausdorff for many pairs of geometries.  Small pairs are
+        batched into one distance calculation of up to CHUNK_SIZE point-segment distances.
+
+    Input:
+        geoms1, geoms2 - equal length lists of geometries (arcpy polylines or lists of vertex arrays)
+    Output:
+        (maxDistances, minDistances) - arrays of the largest and smallest distance from a vertex
+        of each geom1 to its geom2.  The hausdorff distance is maxDistances, and the normalized
+        hausdorff distance is maxDistances - minDistances.
+    """
+    maxDistances = np.empty(len(geoms1))
+    minDistances = np.empty(len(geoms1))
+
+    def score_batch(batch, points, segments):
+        dists, pointCounts = get_pair_distances(points, segments)
+        pairStarts = np.concatenate([[0], np.cumsum(pointCounts)[:-1]])
+        maxDistances[batch] = np.maximum.reduceat(dists, pairStarts)
+        minDistances[batch] = np.minimum.reduceat(dists, pairStarts)
+
+    batch, points, segments, size = [], [], [], 0
+    for i, (geom1, geom2) in enumerate(zip(geoms1, geoms2)):
+        pts = get_points(geom1)
+        segs = get_segments(geom2)
+        if len(pts) == 0 or len(segs) == 0:
+            raise ValueError('Cannot compute hausdorff distance of an empty geometry')
+
+        # Pairs too large for a batch are chunked by point on their own
+        if len(pts) * len(segs) > CHUNK_SIZE:
+            dists = np.concatenate(list(iter_point_distances(pts, segs)))
+            maxDistances[i], minDistances[i] = dists.max(), dists.min()
+            continue
+
+        if size + len(pts) * len(segs) > CHUNK_SIZE:
+            score_batch(batch, points, segments)
+            batch, points, segments, size = [], [], [], 0
+
+        batch.append(i)
+        points.append(pts)
+        segments.append(segs)
+        size += len(pts) * len(segs)
+
+    if batch:
+        score_batch(batch, points, segments)
+
+    return maxDistances, minDistances
+
+
+def hausdorff_distance_pairs(geoms1, geoms2):
+    """ Bulk version of hausdorff_distance.  Returns the (maxDistances, minDistances) of
+        directed_hausdorff_pairs both ways, as (geoms1 to geoms2, geoms2 to geoms1). """
+    return directed_hausdorff_pairs(geoms1, geoms2), directed_hausdorff_pairs(geoms2, geoms1)
@@ -1,62 +1,94 @@
-def compare_lengths(XDLayer, ConflationLayer):
-    # Get XD Lengths in Miles and put in dictionary
-    print('Creating XDLenDict')
-    XDLenDict = {}
-    with arcpy.da.SearchCursor(XDLayer, ['XDSegID','SHAPE@']) as cur:
-        for row in cur:
-            len = row[1].getLength('GEODESIC', 'MILES')
-            XDLenDict[int(row[0])] = len
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+import numpy as np
+import pandas as pd
+from geometry_backend import LINEAR_UNITS, geodesic_distance, get_spatial_reference, get_vertex_arrays, search_cursor, to_geographic
 
-    # Add fields to ConflationLayer
-    fields = arcpy.ListFields(ConflationLayer)
-    if 'XDLen' not in fields:
-        print(f'Adding field XDLen')
-        arcpy.AddField_management(ConflationLayer, 'XDLen', 'DOUBLE')
-    if 'ConflationLen' not in fields:
-        print(f'Adding field ConflationLen')
-        arcpy.AddField_management(ConflationLayer, 'ConflationLen', 'DOUBLE')
-    if 'ConflationTotalLen' not in fields:
-        print(f'Adding field ConflationTotalLen')
-        arcpy.AddField_management(ConflationLayer, 'ConflationTotalLen', 'DOUBLE')
-    if 'LenDiff' not in fields:
-        print(f'Adding field LenDiff')
-        arcpy.AddField_management(ConflationLayer, 'LenDiff', 'DOUBLE')
-
-    # Calculate conflation layer lengths
-    print('Calcualting conflation layer lengths')
-    with arcpy.da.UpdateCursor(ConflationLayer, ['XDSegID', 'ConflationLen', 'SHAPE@']) as cur:
+"""
+Compares the geodesic length of each XD segment with the total length of its
+conflation events.
+
+Each layer is read once.  The segments of every geometry are collected as arrays
+while reading, and their geodesic lengths are computed together with the
+ellipsoidal formula in geometry_backend instead of calling getLength('GEODESIC')
+for each row.  The conflation lengths are totalled by XDSegID with a group-by, and
+XDLen, ConflationLen, ConflationTotalLen and LenDiff are written in one update pass.
+"""
+
+LENGTH_FIELDS = ['XDLen', 'ConflationLen', 'ConflationTotalLen', 'LenDiff']
+
+
+def read_lengths(layer, fields, units='MILES'):
+    """ Reads fields and the geodesic length of each row's geometry in one pass over layer.
+
+    Output:
+        DataFrame of fields and 'length'.  Rows without a geometry have a NaN length.
+    """
+    rows = []
+    segments = []
+    rowIndex = []
+    geoms = []
+    with search_cursor(layer, fields + ['SHAPE@']) as cur:
         for row in cur:
-            try:
-                len = row[2].getLength('GEODESIC', 'MILES')
-                row[1] = len
-                cur.updateRow(row)
-            except:
+            rows.append(tuple(row[:-1]))
+            geoms.append(row[-1])
+            if row[-1] is None:
                 continue
 
-    print('Adding conflation total lengths')
-    XDTotalDicts = {int(row[0]):[] for row in arcpy.da.SearchCursor(XDLayer, 'XDSegID')}
-    with arcpy.da.SearchCursor(ConflationLayer, ['XDSegID', 'ConflationLen']) as cur:
-        for row in cur:
-            if row[1] is not None:
-                XDTotalDicts[row[0]].append(row[1])
-    
-    with arcpy.da.UpdateCursor(ConflationLayer, ['XDSegID', 'ConflationTotalLen']) as cur:
-        for row in cur:
-            row[1] = sum(XDTotalDicts[row[0]])
-            cur.updateRow(row)
+            for part in get_vertex_arrays(row[-1]):
+                segments.append(np.column_stack([part[:-1, :2], part[1:, :2]]))
+                rowIndex.append(np.full(len(part) - 1, len(rows) - 1))
 
+    df = pd.DataFrame(rows, columns=fields)
+    hasGeometry = np.array([geom is not None for geom in geoms], dtype=bool)
+    if not segments:
+        df['length'] = np.where(hasGeometry, 0.0, np.nan)
+        return df
 
-    # Add XD Lengths
-    print('Adding XD Lengths')
-    with arcpy.da.UpdateCursor(ConflationLayer, ['XDSegID', 'XDLen']) as cur:
-        for row in cur:
-            row[1] = XDLenDict[row[0]]
-            cur.updateRow(row)
+    segments = np.concatenate(segments)
+    rowIndex = np.concatenate(rowIndex)
+    try:
+        lat, lon = to_geographic(segments[:, [0, 2]], segments[:, [1, 3]], get_spatial_reference(layer))
+    except ValueError:
+        # Spatial references that to_geographic doesn't support use each geometry's own geodesic length
+        df['length'] = [geom.getLength('GEODESIC', units) if geom is not None else np.nan for geom in geoms]
+        return df
+
+    lengths = geodesic_distance(lat[:, 0], lon[:, 0], lat[:, 1], lon[:, 1]) / LINEAR_UNITS[units]
+    df['length'] = np.where(hasGeometry, np.bincount(rowIndex, weights=lengths, minlength=len(df)), np.nan)
+    return df
+
+
+def compare_lengths(XDLayer, ConflationLayer):
+    # Get XD Lengths in Miles
+    print('Reading XD lengths')
+    XDLengths = read_lengths(XDLayer, ['XDSegID'])
+    XDLenDict = dict(zip(XDLengths['XDSegID'].astype(int), XDLengths['length']))
+
+    # Add fields to ConflationLayer
+    fields = [field.name for field in arcpy.ListFields(ConflationLayer)]
+    for field in LENGTH_FIELDS:
+        if field not in fields:
+            print(f'Adding field {field}')
+            arcpy.AddField_management(ConflationLayer, field, 'DOUBLE')
 
+    # Calculate conflation layer lengths and their totals by XDSegID
+    print('Calculating conflation layer lengths')
+    conflation = read_lengths(ConflationLayer, ['OID@', 'XDSegID'])
+    conflation['XDSegID'] = conflation['XDSegID'].astype(int)
+    conflation['total'] = conflation.groupby('XDSegID')['length'].transform('sum')
+    conflation['XDLen'] = conflation['XDSegID'].map(XDLenDict)
+    conflation['diff'] = (conflation['total'] - conflation['XDLen']).abs()
 
-    # Calculate len differences
-    print('Calculating len difference')
-    with arcpy.da.UpdateCursor(ConflationLayer, ['ConflationTotalLen', 'XDLen', 'LenDiff']) as cur:
+    # Write every length field in one pass
+    print('Writing lengths')
+    values = {
+        oid: [None if pd.isna(value) else float(value) for value in row]
+        for oid, *row in conflation[['OID@', 'XDLen', 'length', 'total', 'diff']].itertuples(index=False)
+    }
+    with arcpy.da.UpdateCursor(ConflationLayer, ['OID@'] + LENGTH_FIELDS) as cur:
         for row in cur:
-            row[2] = abs(row[0] - row[1])
-            cur.updateRow(row)
\ No newline at end of file
+            if row[0] in values:
+                cur.updateRow([row[0]] + values[row[0]])
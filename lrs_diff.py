@@ -0,0 +1,163 @@
+import hashlib
+import json
+import numpy as np
+from geometry_backend import get_vertex_arrays, search_cursor
+from lrs_index import RouteIndex
+
+"""
+Route by route comparison of two versions of the LRS.  When the LRS is
+republished, only the XD segments whose previous events or candidate
+neighborhoods touch a changed route need to be conflated, flipped and QC'd again.
+"""
+
+LRS_FIELDS = ['RTE_NM', 'SHAPE@', 'RTE_OPPOSITE_DIRECTION_RTE_NM', 'RTE_PARENT_RTE_NM']
+
+# Vertices are rounded to mm and measures (miles) to 6 decimals before hashing
+COORDINATE_DECIMALS = 3
+MEASURE_DECIMALS = 6
+
+# XD segments within this distance (m) of a changed route are re-conflated.  This covers
+# the 20m rerun search distance of the first iteration and the 20m buffer in is_similar_shape.
+SEARCH_DISTANCE = 25
+
+# Distance (m) between the points tested along each XD segment
+SAMPLE_DISTANCE = 10
+
+
+def build_lrs_manifest(lrs, lrsFilter=''):
+    """ Returns {rte_nm: {'geometry', 'mRange', 'opposite', 'parent'}} for every route in lrs,
+        and {rte_nm: parts} with the vertex arrays of each route """
+    manifest = {}
+    routeParts = {}
+    with search_cursor(lrs, LRS_FIELDS, lrsFilter) as cur:
+        for rte_nm, geom, opp_rte_nm, parent_rte_nm in cur:
+            parts = get_vertex_arrays(geom) if geom else []
+            md5 = hashlib.md5()
+            for part in parts:
+                md5.update(np.round(part[:, :2], COORDINATE_DECIMALS).tobytes())
+                md5.update(np.round(part[:, 2], MEASURE_DECIMALS).tobytes())
+                md5.update(b'|')
+
+            measures = np.concatenate([part[:, 2] for part in parts]) if parts else np.empty(0)
+            measures = measures[~np.isnan(measures)]
+            mRange = [round(float(measures.min()), MEASURE_DECIMALS), round(float(measures.max()), MEASURE_DECIMALS)] if len(measures) else None
+
+            manifest[rte_nm] = {
+                'geometry': md5.hexdigest(),
+                'mRange': mRange,
+                'opposite': opp_rte_nm,
+                'parent': parent_rte_nm
+            }
+            routeParts[rte_nm] = parts
+
+    return manifest, routeParts
+
+
+def diff_lrs_manifests(previous, current):
+    """ Compares two LRS manifests.
+    Output:
+        {rte_nm: [reasons]} for every route that was added, removed or changed.  Reasons
+        are 'added', 'removed', 'geometry', 'mRange', 'opposite' and 'parent'.
+    """
+    changes = {}
+    for rte_nm in previous.keys() | current.keys():
+        if rte_nm not in current:
+            changes[rte_nm] = ['removed']
+        elif rte_nm not in previous:
+            changes[rte_nm] = ['added']
+        else:
+            reasons = [key for key in ('geometry', 'mRange', 'opposite', 'parent') if previous[rte_nm][key] != current[rte_nm][key]]
+            if reasons:
+                changes[rte_nm] = reasons
+
+    return changes
+
+
+def get_affected_routes(changes, previous, current):
+    """ Returns the changed routes plus the routes whose opposite direction route changed,
+        since flipRoutes moves events onto the opposite route """
+    affected = set(changes)
+    for manifest in (previous, current):
+        for rte_nm, route in manifest.items():
+            if route['opposite'] in changes:
+                affected.add(rte_nm)
+
+    return affected
+
+
+def sample_points(geom, step=SAMPLE_DISTANCE):
+    """ Returns an (n, 2) array of the vertices of geom plus points at most step apart along it """
+    points = []
+    for part in get_vertex_arrays(geom) if geom else []:
+        xy = part[:, :2]
+        if len(xy) == 1:
+            points.append(xy)
+            continue
+
+        lengths = np.hypot(*np.diff(xy, axis=0).T)
+        counts = np.maximum(np.ceil(lengths / step).astype(np.int64), 1)
+        segment = np.repeat(np.arange(len(lengths)), counts)
+        t = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) / np.repeat(counts, counts)
+        points.append(xy[segment] + (xy[segment + 1] - xy[segment]) * t[:, None])
+        points.append(xy[-1:])
+
+    if not points:
+        return np.empty((0, 2))
+
+    return np.concatenate(points)
+
+
+def find_lrs_affected_segments(previousLRS, lrs, xd, previousEvents, xdFilter='', lrsFilter='', searchDistance=SEARCH_DISTANCE, blockSize=10000):
+    """ Finds the XD segments that need to be re-conflated after the LRS is republished.
+    Input:
+        previousLRS, lrs - the LRS used by the previous run and the new LRS
+        previousEvents - the [XDSegID, RTE_NM, BEGIN_MSR, END_MSR] events of the previous run
+    Output:
+        (changes, affectedSegments) - changes is the output of diff_lrs_manifests and
+        affectedSegments is a set of XDSegIDs (as str) whose previous events are on an
+        affected route or that are within searchDistance of the old or new geometry
+        of a changed route
+    """
+    print('Comparing LRS versions')
+    previous, previousParts = build_lrs_manifest(previousLRS, lrsFilter)
+    current, currentParts = build_lrs_manifest(lrs, lrsFilter)
+    changes = diff_lrs_manifests(previous, current)
+    affectedRoutes = get_affected_routes(changes, previous, current)
+    print(f'  {len(changes)} changed routes, {len(affectedRoutes)} affected including opposite direction routes')
+
+    affectedSegments = {str(event[0]) for event in previousEvents if event[1] in affectedRoutes}
+    if not changes:
+        return changes, affectedSegments
+
+    # Index the old and new geometry of every changed route
+    routeIndex = RouteIndex(
+        [(rte_nm, previousParts.get(rte_nm, [])) for rte_nm in sorted(changes)] +
+        [(rte_nm, currentParts.get(rte_nm, [])) for rte_nm in sorted(changes)]
+    )
+
+    block = []
+
+    def test_block():
+        points = [sample_points(geom) for XDSegID, geom in block]
+        segmentIndexes = np.repeat(np.arange(len(block)), [len(p) for p in points])
+        points = np.concatenate(points) if points else np.empty((0, 2))
+        pointIndexes, routeIds = routeIndex.query_many(points[:, 0], points[:, 1], searchDistance)
+        for i in np.unique(segmentIndexes[pointIndexes]):
+            affectedSegments.add(str(block[i][0]))
+
+    with search_cursor(xd, ['XDSegID', 'SHAPE@'], xdFilter) as cur:
+        for row in cur:
+            block.append(row)
+            if len(block) == blockSize:
+                test_block()
+                block = []
+    if block:
+        test_block()
+
+    return changes, affectedSegments
+
+
+def save_lrs_changes(changes, path):
+    """ Saves the output of diff_lrs_manifests as JSON for review """
+    with open(path, 'w') as file:
+        json.dump(dict(sorted(changes.items())), file, indent=4)
@@ -0,0 +1,567 @@
+import hashlib
+import json
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+from geometry_backend import get_backend, get_spatial_reference, get_vertex_arrays, point_to_segment_distance, search_cursor
+
+"""
+In-memory indexes over the LRS used by the conflation engine.  These are built
+once per run and replace the per-point geoprocessing calls (select by location
+and search cursors) that used to dominate the run time.
+"""
+
+
+class RouteIndex:
+    """ A packed STR-tree (sort-tile-recursive R-tree) over the straight segments
+        of every LRS route part.
+
+        Leaves are the route segments themselves.  Each node covers a contiguous
+        range of rows in the level below, so a query only has to walk down the
+        levels with vectorized bounding box tests before refining the surviving
+        segments with an exact point-to-segment distance.
+    """
+
+    def __init__(self, routes, nodeSize=16):
+        """ routes is an iterable of (rte_nm, parts) where parts is a list of
+            vertex arrays as returned by get_vertex_arrays.  The order of routes
+            is kept so that query results come back in the same order as a
+            search cursor on the LRS layer. """
+        self.nodeSize = nodeSize
+        self.rte_nms = []
+
+        segments = []
+        routeIds = []
+        for routeId, (rte_nm, parts) in enumerate(routes):
+            self.rte_nms.append(rte_nm)
+            for part in parts:
+                if len(part) < 2:
+                    continue
+                segments.append(np.column_stack([part[:-1, 0], part[:-1, 1], part[1:, 0], part[1:, 1]]))
+                routeIds.append(np.full(len(part) - 1, routeId, dtype=np.int64))
+
+        if segments:
+            segments = np.concatenate(segments)
+            routeIds = np.concatenate(routeIds)
+        else:
+            segments = np.empty((0, 4))
+            routeIds = np.empty(0, dtype=np.int64)
+
+        # Sort the segments into STR order so that each leaf node is spatially compact
+        bboxes = np.column_stack([
+            np.minimum(segments[:, 0], segments[:, 2]),
+            np.minimum(segments[:, 1], segments[:, 3]),
+            np.maximum(segments[:, 0], segments[:, 2]),
+            np.maximum(segments[:, 1], segments[:, 3])
+        ])
+        order = self._str_order(bboxes)
+        self.segments = segments[order]
+        self.routeIds = routeIds[order]
+
+        # Build the node levels from the leaves up.  levels[0] is the level directly
+        # above the segments, levels[-1] is the root level.
+        self.levels = []
+        childBoxes = bboxes[order]
+        while len(childBoxes) > nodeSize or not self.levels:
+            starts = np.arange(0, len(childBoxes), nodeSize)
+            ends = np.minimum(starts + nodeSize, len(childBoxes))
+            if len(childBoxes):
+                nodeBoxes = np.column_stack([
+                    np.minimum.reduceat(childBoxes[:, 0], starts),
+                    np.minimum.reduceat(childBoxes[:, 1], starts),
+                    np.maximum.reduceat(childBoxes[:, 2], starts),
+                    np.maximum.reduceat(childBoxes[:, 3], starts)
+                ])
+            else:
+                nodeBoxes = np.empty((0, 4))
+
+            # Sort the nodes of this level into STR order before grouping them into parents
+            nodeOrder = self._str_order(nodeBoxes)
+            nodeBoxes = nodeBoxes[nodeOrder]
+            self.levels.append((nodeBoxes, starts[nodeOrder], ends[nodeOrder]))
+            childBoxes = nodeBoxes
+
+        self.levels.reverse()
+
+
+    def _str_order(self, bboxes):
+        """ Returns the sort-tile-recursive ordering of the input bounding boxes """
+        count = len(bboxes)
+        if count == 0:
+            return np.arange(0)
+
+        cx = (bboxes[:, 0] + bboxes[:, 2]) / 2
+        cy = (bboxes[:, 1] + bboxes[:, 3]) / 2
+
+        nodeCount = int(np.ceil(count / self.nodeSize))
+        sliceCount = int(np.ceil(np.sqrt(nodeCount)))
+        sliceSize = sliceCount * self.nodeSize
+
+        byX = np.argsort(cx, kind='stable')
+        sliceNumber = np.empty(count, dtype=np.int64)
+        sliceNumber[byX] = np.arange(count) // sliceSize
+
+        return np.lexsort((cy, sliceNumber))
+
+
+    def _candidate_segments(self, x, y, distance):
+        """ Walks down the tree and returns the indexes of all segments whose
+            bounding box is within distance of (x, y) """
+        candidates = np.arange(len(self.levels[0][0]))
+        for boxes, starts, ends in self.levels:
+            boxes = boxes[candidates]
+            hit = (
+                (boxes[:, 0] - distance <= x) & (x <= boxes[:, 2] + distance) &
+                (boxes[:, 1] - distance <= y) & (y <= boxes[:, 3] + distance)
+            )
+            candidates = candidates[hit]
+            if len(candidates) == 0:
+                return candidates
+
+            # Expand the surviving nodes into the rows of the level below
+            counts = ends[candidates] - starts[candidates]
+            offsets = np.repeat(starts[candidates] - np.cumsum(counts) + counts, counts)
+            candidates = offsets + np.arange(counts.sum())
+
+        return candidates
+
+
+    def query(self, x, y, distance):
+        """ Returns a list of (rte_nm, distance) for every route within distance
+            of the point (x, y), in LRS layer order """
+        candidates = self._candidate_segments(x, y, distance)
+        if len(candidates) == 0:
+            return []
+
+        seg = self.segments[candidates]
+        dists = point_to_segment_distance(x, y, seg[:, 0], seg[:, 1], seg[:, 2], seg[:, 3])
+        routeIds = self.routeIds[candidates]
+
+        # Keep the closest segment of each route
+        order = np.lexsort((dists, routeIds))
+        routeIds = routeIds[order]
+        dists = dists[order]
+        first = np.ones(len(routeIds), dtype=bool)
+        first[1:] = routeIds[1:] != routeIds[:-1]
+
+        return [(self.rte_nms[routeId], float(dist)) for routeId, dist in zip(routeIds[first], dists[first]) if dist <= distance]
+
+
+    def query_many(self, x, y, distances, chunkSize=20000):
+        """ Batch version of query for many points at once.  The tree is walked for
+            every point together, one level at a time, using (point, node) pairs.
+        Input:
+            x, y - arrays of point coordinates
+            distances - the search distance of each point, or a single distance for all
+        Output:
+            (pointIndexes, routeIds) - one row for every route within distance of a
+            point, sorted by point and then LRS order.  self.rte_nms[routeId] is the route.
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        distances = np.broadcast_to(np.asarray(distances, dtype=float), x.shape)
+        routeCount = max(len(self.rte_nms), 1)
+        rootCount = len(self.levels[0][0])
+
+        pointIndexes = []
+        routeIds = []
+        for start in range(0, len(x), chunkSize):
+            points = np.arange(start, min(start + chunkSize, len(x)))
+            nodes = np.tile(np.arange(rootCount), len(points))
+            points = np.repeat(points, rootCount)
+
+            for boxes, starts, ends in self.levels:
+                boxes = boxes[nodes]
+                px, py, d = x[points], y[points], distances[points]
+                hit = (
+                    (boxes[:, 0] - d <= px) & (px <= boxes[:, 2] + d) &
+                    (boxes[:, 1] - d <= py) & (py <= boxes[:, 3] + d)
+                )
+                points = points[hit]
+                nodes = nodes[hit]
+
+                # Expand the surviving nodes into the rows of the level below
+                counts = ends[nodes] - starts[nodes]
+                offsets = np.repeat(starts[nodes] - np.cumsum(counts) + counts, counts)
+                nodes = offsets + np.arange(counts.sum())
+                points = np.repeat(points, counts)
+
+            seg = self.segments[nodes]
+            dists = point_to_segment_distance(x[points], y[points], seg[:, 0], seg[:, 1], seg[:, 2], seg[:, 3])
+            within = dists <= distances[points]
+
+            # One row per point and route
+            keys = np.unique(points[within] * routeCount + self.routeIds[nodes[within]])
+            pointIndexes.append(keys // routeCount)
+            routeIds.append(keys % routeCount)
+
+        if not pointIndexes:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        return np.concatenate(pointIndexes), np.concatenate(routeIds)
+
+
+    @classmethod
+    def from_store(cls, routeStore):
+        """ Builds the index from the routes loaded in a RouteStore """
+        return cls((rte_nm, routeStore.vertices[rte_nm]) for rte_nm in routeStore.rte_nms)
+
+
+class RouteStore:
+    """ Every LRS route keyed by RTE_NM, loaded with a single search cursor.
+
+        Multipart routes are split into single part polylines up front so that
+        the closest part to a point can be found without rebuilding them on
+        every call.  lrs can be a layer, feature class or MemoryTable, and where
+        is an optional filter on the routes (SQL, or a function for a MemoryTable).
+        Set parentField to None for route layers without RTE_PARENT_RTE_NM.
+    """
+
+    def __init__(self, lrs, backend=None, where=None, parentField='RTE_PARENT_RTE_NM'):
+        backend = backend or get_backend()
+
+        self.rte_nms = []   # Routes in LRS layer order
+        self.order = {}     # rte_nm: position in LRS layer order
+        self.geoms = {}     # rte_nm: Polyline
+        self.parts = {}     # rte_nm: list of single part Polylines
+        self.vertices = {}  # rte_nm: list of (n, 3) X, Y, M arrays
+        self.segments = {}  # rte_nm: (n, 7) segment array, built on first use by get_segments
+        self.opposite = {}  # rte_nm: RTE_OPPOSITE_DIRECTION_RTE_NM
+        self.parent = {}    # rte_nm: RTE_PARENT_RTE_NM
+
+        fields = ['RTE_NM', 'SHAPE@', 'RTE_OPPOSITE_DIRECTION_RTE_NM']
+        if parentField:
+            fields.append(parentField)
+
+        with search_cursor(lrs, fields, where or None) as cur:
+            for row in cur:
+                rte_nm, geom, opp_rte_nm = row[:3]
+                parent_rte_nm = row[3] if parentField else None
+                if rte_nm not in self.order:
+                    self.order[rte_nm] = len(self.rte_nms)
+                    self.rte_nms.append(rte_nm)
+
+                self.opposite[rte_nm] = opp_rte_nm
+                self.parent[rte_nm] = parent_rte_nm
+                self.geoms[rte_nm] = geom
+
+                if not geom:
+                    self.parts[rte_nm] = []
+                    self.vertices[rte_nm] = []
+                    continue
+
+                self.parts[rte_nm] = backend.split_parts(geom)
+                self.vertices[rte_nm] = get_vertex_arrays(geom)
+
+
+    def __contains__(self, rte_nm):
+        return rte_nm in self.geoms
+
+
+    def get(self, rte_nm):
+        """ Returns the geometry of rte_nm, or None if it is not in the LRS """
+        return self.geoms.get(rte_nm)
+
+
+    def get_routes(self, rte_nms):
+        """ Returns a list of (rte_nm, geom) for the input routes that exist in
+            the LRS, in LRS layer order """
+        found = sorted((rte_nm for rte_nm in set(rte_nms) if rte_nm in self.order), key=self.order.get)
+        return [(rte_nm, self.geoms[rte_nm]) for rte_nm in found]
+
+
+    def closest_part(self, rte_nm, pointGeometry):
+        """ Returns the part of rte_nm closest to the input point geometry.  For
+            single part routes this is the route geometry itself. """
+        parts = self.parts[rte_nm]
+        if len(parts) == 1:
+            return parts[0]
+
+        closestPart = None
+        closestDist = None
+        for part in parts:
+            dist = pointGeometry.distanceTo(part)
+            if closestDist is None or dist <= closestDist:
+                closestPart = part
+                closestDist = dist
+
+        return closestPart
+
+
+    def get_segments(self, rte_nm):
+        """ Returns an (n, 7) array of x0, y0, m0, x1, y1, m1, part index for every
+            segment of rte_nm """
+        if rte_nm not in self.segments:
+            segments = []
+            for partIndex, part in enumerate(self.vertices[rte_nm]):
+                if len(part) == 1:
+                    part = np.concatenate([part, part])
+                segments.append(np.column_stack([part[:-1], part[1:], np.full(len(part) - 1, partIndex)]))
+            self.segments[rte_nm] = np.concatenate(segments) if segments else np.empty((0, 7))
+
+        return self.segments[rte_nm]
+
+
+    def locate_points(self, points, rte_nms, intersectionIndex=None, snapDistance=10, chunkSize=1000000):
+        """ Locates many points on their routes in one pass.  This is the batch
+            version of xd_to_rns.get_point_mp: each point is located on the closest
+            part of its route, and if intersectionIndex is given, positions within
+            snapDistance of an intersection are moved to the intersection and located
+            again on the same part.
+        Input:
+            points - (n, 2) array of x, y
+            rte_nms - the route each point will be placed on
+        Output:
+            (measures, positions, partIndexes) - the m-values, the (n, 2) located
+            positions and the index of the route part used for each point.  Points
+            whose route is not in the LRS get NaN and a part index of -1.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        measures = np.full(len(points), np.nan)
+        positions = np.full((len(points), 2), np.nan)
+        partIndexes = np.full(len(points), -1, dtype=np.int64)
+
+        groups = {}
+        for i, rte_nm in enumerate(rte_nms):
+            groups.setdefault(rte_nm, []).append(i)
+
+        def locate(rows, segments, parts=None):
+            """ Finds the closest point on segments for each of the input rows.  If
+                parts is given, only segments on that part are used for each row. """
+            chunk = max(1, chunkSize // max(len(segments), 1))
+            for start in range(0, len(rows), chunk):
+                chunkRows = rows[start:start + chunk]
+                x = points[chunkRows, 0:1]
+                y = points[chunkRows, 1:2]
+                dx = segments[:, 3] - segments[:, 0]
+                dy = segments[:, 4] - segments[:, 1]
+                segLenSq = dx * dx + dy * dy
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    t = ((x - segments[:, 0]) * dx + (y - segments[:, 1]) * dy) / segLenSq
+                t = np.where(segLenSq > 0, np.clip(t, 0, 1), 0)
+                dists = np.hypot(segments[:, 0] + t * dx - x, segments[:, 1] + t * dy - y)
+                if parts is not None:
+                    dists = np.where(segments[:, 6] == parts[start:start + chunk, None], dists, np.inf)
+
+                closest = np.argmin(dists, axis=1)
+                t = t[np.arange(len(chunkRows)), closest]
+                seg = segments[closest]
+                positions[chunkRows, 0] = seg[:, 0] + t * (seg[:, 3] - seg[:, 0])
+                positions[chunkRows, 1] = seg[:, 1] + t * (seg[:, 4] - seg[:, 1])
+                measures[chunkRows] = seg[:, 2] + t * (seg[:, 5] - seg[:, 2])
+                partIndexes[chunkRows] = seg[:, 6]
+
+        for rte_nm, rows in groups.items():
+            if rte_nm not in self.geoms or not self.vertices[rte_nm]:
+                continue
+            locate(np.array(rows), self.get_segments(rte_nm))
+
+        if intersectionIndex is None:
+            return measures, positions, partIndexes
+
+        # Snap to the closest intersection and locate the intersection on the same route part
+        valid = np.nonzero(partIndexes >= 0)[0]
+        oids, dists, coords = intersectionIndex.nearest_within(positions[valid], snapDistance)
+        moved = valid[oids != -1]
+        points = points.copy()
+        points[moved] = coords[oids != -1]
+
+        movedGroups = {}
+        for i in moved.tolist():
+            movedGroups.setdefault(rte_nms[i], []).append(i)
+        for rte_nm, rows in movedGroups.items():
+            rows = np.array(rows)
+            locate(rows, self.get_segments(rte_nm), partIndexes[rows])
+
+        return measures, positions, partIndexes
+
+
+class IntersectionIndex:
+    """ The LRS intersection points loaded into a coordinate array with a KD-tree
+        for radius queries and a dictionary for OBJECTID lookups. """
+
+    def __init__(self, intersections, backend=None):
+        self.backend = backend or get_backend()
+        self.spatialReference = get_spatial_reference(intersections)
+
+        rows = [(oid, xy) for oid, xy in search_cursor(intersections, ['OID@', 'SHAPE@XY']) if xy[0] is not None]
+        self.oids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.coords = np.array([row[1] for row in rows], dtype=float).reshape(-1, 2)
+        self.rowByOid = {oid: i for i, oid in enumerate(self.oids.tolist())}
+        self.tree = cKDTree(self.coords)
+
+
+    def __contains__(self, oid):
+        return oid in self.rowByOid
+
+
+    def nearest_within(self, points, radius):
+        """ Finds the closest intersection to each of the input (n, 2) points that
+            is within radius.
+        Output:
+            (oids, dists, coords) - oids is -1 and dists is inf where there is
+            no intersection within radius
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if len(self.oids) == 0:
+            return np.full(len(points), -1, dtype=np.int64), np.full(len(points), np.inf), np.full((len(points), 2), np.nan)
+
+        # The upper bound is exclusive, so nudge it to include points exactly at radius
+        dists, rows = self.tree.query(points, k=1, distance_upper_bound=np.nextafter(radius, np.inf))
+
+        # cKDTree returns len(coords) for points with no neighbour within radius
+        found = rows < len(self.oids)
+        oids = np.where(found, self.oids[np.minimum(rows, len(self.oids) - 1)], -1)
+        coords = np.where(found[:, None], self.coords[np.minimum(rows, len(self.oids) - 1)], np.nan)
+
+        return oids, dists, coords
+
+
+    def within(self, x, y, radius):
+        """ Returns the OBJECTIDs of all intersections within radius of (x, y) """
+        return sorted(self.oids[self.tree.query_ball_point((x, y), radius)].tolist())
+
+
+    def get_xy(self, oid):
+        """ Returns the (x, y) coordinates of the intersection with the input OBJECTID """
+        return tuple(self.coords[self.rowByOid[oid]].tolist())
+
+
+    def get_point(self, oid):
+        """ Returns the intersection with the input OBJECTID as a PointGeometry """
+        x, y = self.get_xy(oid)
+        return self.backend.PointGeometry(self.backend.Point(x, y), self.spatialReference)
+
+
+    def near_polyline(self, geom, distance):
+        """ Returns the sorted OBJECTIDs of all intersections within distance of the
+            input polyline """
+        found = set()
+        for part in get_vertex_arrays(geom):
+            if len(part) == 1:
+                part = np.concatenate([part, part])
+            x0, y0, x1, y1 = part[:-1, 0], part[:-1, 1], part[1:, 0], part[1:, 1]
+
+            # Any intersection within distance of a segment is within this radius of its midpoint
+            radii = np.hypot(x1 - x0, y1 - y0) / 2 + distance
+            for i, rows in enumerate(self.tree.query_ball_point(np.column_stack([(x0 + x1) / 2, (y0 + y1) / 2]), radii)):
+                if not rows:
+                    continue
+                coords = self.coords[rows]
+                dists = point_to_segment_distance(coords[:, 0], coords[:, 1], x0[i], y0[i], x1[i], y1[i])
+                found.update(self.oids[rows][dists <= distance].tolist())
+
+        return sorted(found)
+
+
+class RouteIntersectionTable:
+    """ The intersections that touch each route (within searchDistance of the route
+        geometry) and the routes that touch each intersection.  This replaces two
+        select by location calls per route pair when looking for a common
+        intersection.
+
+        Building the table requires one route index query per intersection, so it
+        is saved as JSON next to the LRS and reused for as long as the routes and
+        intersections are unchanged.
+    """
+
+    def __init__(self, routeInts, signature=None):
+        self.signature = signature
+        self.routeInts = {rte_nm: set(oids) for rte_nm, oids in routeInts.items()}
+        self.intRoutes = {}
+        for rte_nm, oids in self.routeInts.items():
+            for oid in oids:
+                self.intRoutes.setdefault(oid, set()).add(rte_nm)
+
+
+    def get_ints(self, rte_nm):
+        """ Returns the set of intersection OBJECTIDs that touch rte_nm """
+        return self.routeInts.get(rte_nm, set())
+
+
+    def get_routes(self, oid):
+        """ Returns the set of routes that touch the intersection """
+        return self.intRoutes.get(oid, set())
+
+
+    def common_ints(self, rteA, rteB):
+        """ Returns a sorted list of the intersection OBJECTIDs shared by both routes """
+        return sorted(self.get_ints(rteA) & self.get_ints(rteB))
+
+
+    @staticmethod
+    def get_signature(routeStore, intersectionIndex, searchDistance):
+        """ Returns a hash of the inputs used to build the table so that a saved
+            table can be checked against the current LRS """
+        md5 = hashlib.md5()
+        md5.update(str(searchDistance).encode())
+        for rte_nm in routeStore.rte_nms:
+            md5.update(rte_nm.encode())
+            for part in routeStore.vertices[rte_nm]:
+                md5.update(np.ascontiguousarray(part[:, :2]).tobytes())
+        md5.update(intersectionIndex.oids.tobytes())
+        md5.update(np.ascontiguousarray(intersectionIndex.coords).tobytes())
+
+        return md5.hexdigest()
+
+
+    @classmethod
+    def build(cls, routeIndex, intersectionIndex, searchDistance=5, signature=None):
+        routeInts = {}
+        for oid, (x, y) in zip(intersectionIndex.oids.tolist(), intersectionIndex.coords.tolist()):
+            for rte_nm, dist in routeIndex.query(x, y, searchDistance):
+                routeInts.setdefault(rte_nm, []).append(oid)
+
+        return cls(routeInts, signature)
+
+
+    @staticmethod
+    def get_path(lrsPath):
+        """ Returns the path of the saved table for the input LRS feature class.
+            Feature classes in a file gdb are saved next to the gdb. """
+        folder, name = os.path.split(lrsPath)
+        if folder.lower().endswith('.gdb'):
+            folder = os.path.dirname(folder)
+
+        return os.path.join(folder, f'{name}_route_intersections.json')
+
+
+    def save(self, path):
+        data = {
+            'signature': self.signature,
+            'routes': {rte_nm: sorted(oids) for rte_nm, oids in self.routeInts.items()}
+        }
+
+        # Write to a temporary file first so that parallel workers never read a partial table
+        tempPath = f'{path}.{os.getpid()}.tmp'
+        with open(tempPath, 'w') as file:
+            json.dump(data, file)
+        os.replace(tempPath, path)
+
+
+    @classmethod
+    def load_or_build(cls, lrsPath, routeStore, routeIndex, intersectionIndex, searchDistance=5):
+        """ Loads the saved table for lrsPath if it matches the current routes and
+            intersections.  Otherwise the table is built and saved. """
+        if not isinstance(lrsPath, str):
+            # In-memory LRS tables are not saved
+            return cls.build(routeIndex, intersectionIndex, searchDistance)
+
+        path = cls.get_path(lrsPath)
+        signature = cls.get_signature(routeStore, intersectionIndex, searchDistance)
+
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+            if data['signature'] == signature:
+                return cls(data['routes'], signature)
+        except (OSError, ValueError, KeyError):
+            pass
+
+        table = cls.build(routeIndex, intersectionIndex, searchDistance, signature)
+        try:
+            table.save(path)
+        except OSError as e:
+            print(f'Unable to save route intersection table: {e}')
+
+        return table
@@ -1,38 +1,203 @@
-import arcpy
+import numpy as np
 import pandas as pd
+from geometry_backend import MPolyline, get_factory_code, get_spatial_reference, get_vertex_arrays, search_cursor
 
-def count_mileage_XD(districts, layer):
-    output = []
-
-    with arcpy.da.SearchCursor(districts, ['DISTRICT_N', 'SHAPE@']) as cur:
-        for row in cur:
-            arcpy.management.SelectLayerByLocation(layer, 'INTERSECT', row[1])
-            lengths = []
-            with arcpy.da.SearchCursor(layer, ['BEGIN_MSR','END_MSR']) as cur:
-                for begin, end in cur:
-                    if begin and end:
-                        length = abs(end-begin)
-                        lengths.append(length)
-            output.append((row[0], round(sum(lengths))))
-    
-    df = pd.DataFrame(output, columns=['District','Miles'])
-    df = df.sort_values(by=['Miles'], ascending=False)
+"""
+Event mileage by district, in one pass over the event layer.
+
+Every segment of every event is located in the district polygons at once with a
+PolygonIndex, and the mileage (the measure length of each event) is added up by
+district with one aggregation.  By default each event counts once, in the district
+that holds most of its length, so events that cross a district border are no
+longer counted in both districts.  With split=True the mileage of each event is
+shared between districts by the portion of its length inside each of them.
+
+A segment is in the district that contains its mid-point, so the split of an
+event at a border is accurate to the length of the segment that crosses it.
+"""
+
+# Number of horizontal strips that the PolygonIndex divides the polygon edges into
+STRIP_COUNT = 256
+
+# Maximum number of point-edge tests in PolygonIndex.contains at once
+CHUNK_SIZE = 1000000
+
+
+class PolygonIndex:
+    """ Point in polygon tests against a set of polygons.  The polygon edges are bucketed
+        into horizontal strips, so each point is only tested against the edges that
+        cross its strip.  Holes and multipart polygons use the even-odd rule. """
+
+    def __init__(self, polygons, stripCount=STRIP_COUNT):
+        """ polygons is a list with a list of (n, 2) ring arrays for each polygon """
+        self.count = len(polygons)
+
+        edges = []
+        for i, rings in enumerate(polygons):
+            for ring in rings:
+                if len(ring) < 2:
+                    continue
+                if not np.array_equal(ring[0], ring[-1]):
+                    ring = np.concatenate([ring, ring[:1]])
+                edges.append(np.column_stack([ring[:-1], ring[1:], np.full(len(ring) - 1, i)]))
+        edges = np.concatenate(edges) if edges else np.empty((0, 5))
+
+        # Horizontal edges never cross a ray to the right
+        edges = edges[edges[:, 1] != edges[:, 3]]
+
+        self.yMin = edges[:, [1, 3]].min() if len(edges) else 0
+        yMax = edges[:, [1, 3]].max() if len(edges) else 0
+        self.stripCount = stripCount
+        self.stripHeight = max((yMax - self.yMin) / stripCount, 1e-9)
+
+        # Each edge is listed in every strip it crosses
+        first = self.get_strips(np.minimum(edges[:, 1], edges[:, 3]))
+        last = self.get_strips(np.maximum(edges[:, 1], edges[:, 3]))
+        counts = last - first + 1
+        edgeIndex = np.repeat(np.arange(len(edges)), counts)
+        strips = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        order = np.argsort(strips, kind='stable')
+        self.edges = edges[edgeIndex[order]]
+        self.stripStarts = np.searchsorted(strips[order], np.arange(stripCount + 1))
+
+
+    def get_strips(self, y):
+        return np.clip(((y - self.yMin) // self.stripHeight).astype(int), 0, self.stripCount - 1)
+
+
+    def contains(self, x, y):
+        """ Returns an (n, polygons) boolean array of which polygons contain each point """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        inside = np.zeros((len(x), self.count), dtype=bool)
+
+        strips = self.get_strips(y)
+        for strip in np.unique(strips):
+            edges = self.edges[self.stripStarts[strip]:self.stripStarts[strip + 1]]
+            if not len(edges):
+                continue
+
+            x0, y0, x1, y1 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+            polygons = edges[:, 4].astype(int)
+
+            # The points of a strip are tested in chunks to bound the size of the crossing matrix
+            stripPoints = np.flatnonzero(strips == strip)
+            chunk = max(1, CHUNK_SIZE // len(edges))
+            for start in range(0, len(stripPoints), chunk):
+                points = stripPoints[start:start + chunk]
+                px, py = x[points, None], y[points, None]
+
+                # Edges crossed by a ray from each point to the right
+                crosses = ((y0 > py) != (y1 > py)) & (px < x0 + (py - y0) * (x1 - x0) / (y1 - y0))
+
+                # An odd number of crossings of a polygon's edges is inside it
+                pointIndex, edgeIndex = np.nonzero(crosses)
+                crossings = np.bincount(pointIndex * self.count + polygons[edgeIndex], minlength=len(points) * self.count)
+                inside[points] = (crossings.reshape(len(points), self.count) % 2 == 1)
+
+        return inside
+
+
+def get_rings(geom):
+    """ Returns the rings of a polygon as a list of (n, 2) arrays.  For the NumPy backend,
+        polygons are MPolylines with a closed part for each ring. """
+    if isinstance(geom, MPolyline):
+        return [part[:, :2] for part in geom.parts]
+
+    # arcpy polygon parts separate their rings with None
+    rings = []
+    for part in geom:
+        ring = []
+        for point in part:
+            if point is None:
+                rings.append(ring)
+                ring = []
+            else:
+                ring.append((point.X, point.Y))
+        rings.append(ring)
+
+    return [np.array(ring, dtype=float) for ring in rings if ring]
+
+
+def load_districts(districts, spatialReference=None):
+    """ Returns (names, PolygonIndex) for the district polygons, projected to spatialReference """
+    names = []
+    polygons = []
+    with search_cursor(districts, ['DISTRICT_N', 'SHAPE@']) as cur:
+        for name, geom in cur:
+            if geom is None:
+                continue
+            if spatialReference is not None and hasattr(geom, 'projectAs') and get_factory_code(geom.spatialReference) != get_factory_code(spatialReference):
+                geom = geom.projectAs(spatialReference)
+            names.append(name)
+            polygons.append(get_rings(geom))
+
+    return names, PolygonIndex(polygons)
+
+
+def count_mileage(districts, layer, beginField, endField, split=False):
+    """ Returns a DataFrame of the event mileage in each district, in one pass over layer.
+
+    Input:
+        districts - district polygons with DISTRICT_N
+        layer - events with beginField, endField and their geometry
+        split - share the mileage of each event between districts by the portion of its
+                length in each.  Otherwise each event counts in the district that holds
+                most of its length.
+    Output:
+        DataFrame of District and Miles, largest first
+    """
+    names, index = load_districts(districts, get_spatial_reference(layer))
+
+    # Segment mid-points and lengths of every event, with the event they belong to
+    miles = []
+    midX, midY, lengths, eventIndex = [], [], [], []
+    with search_cursor(layer, [beginField, endField, 'SHAPE@']) as cur:
+        for begin, end, geom in cur:
+            if begin is None or end is None or geom is None:
+                continue
+
+            for part in get_vertex_arrays(geom):
+                if len(part) == 1:
+                    part = np.concatenate([part, part])
+                midX.append((part[:-1, 0] + part[1:, 0]) / 2)
+                midY.append((part[:-1, 1] + part[1:, 1]) / 2)
+                lengths.append(np.hypot(np.diff(part[:, 0]), np.diff(part[:, 1])))
+                eventIndex.append(np.full(len(part) - 1, len(miles)))
+            miles.append(abs(end - begin))
+
+    if not miles or not midX:
+        return pd.DataFrame({'District': names, 'Miles': 0})
+
+    miles = np.array(miles, dtype=float)
+    lengths = np.concatenate(lengths)
+    eventIndex = np.concatenate(eventIndex)
+    inside = index.contains(np.concatenate(midX), np.concatenate(midY))
+
+    # Portion of each event's length in each district.  Zero length events are shared by vertex count.
+    totals = np.bincount(eventIndex, weights=lengths, minlength=len(miles))
+    weights = np.where(totals[eventIndex] > 0, lengths, 1)
+    shares = np.column_stack([np.bincount(eventIndex, weights=weights * inside[:, i], minlength=len(miles)) for i in range(len(names))])
+    shares /= np.maximum(np.bincount(eventIndex, weights=weights, minlength=len(miles)), 1e-12)[:, None]
+
+    if not split:
+        largest = shares.argmax(axis=1)
+        isInDistrict = shares[np.arange(len(miles)), largest] > 0
+        shares = np.zeros_like(shares)
+        shares[np.flatnonzero(isInDistrict), largest[isInDistrict]] = 1
+
+    df = pd.DataFrame({'District': names, 'Miles': np.round(miles @ shares).astype(int)})
+    return df.sort_values(by=['Miles'], ascending=False)
+
+
+def count_mileage_XD(districts, layer, split=False):
+    df = count_mileage(districts, layer, 'BEGIN_MSR', 'END_MSR', split)
     print(df)
+    return df
 
-def count_mileage_TMC(districts, layer):
-    output = []
-
-    with arcpy.da.SearchCursor(districts, ['DISTRICT_N', 'SHAPE@']) as cur:
-        for row in cur:
-            arcpy.management.SelectLayerByLocation(layer, 'INTERSECT', row[1])
-            lengths = []
-            with arcpy.da.SearchCursor(layer, ['STARTMILEP','ENDMILEPOI']) as cur:
-                for begin, end in cur:
-                    if begin and end:
-                        length = abs(end-begin)
-                        lengths.append(length)
-            output.append((row[0], round(sum(lengths))))
-    
-    df = pd.DataFrame(output, columns=['District','Miles'])
-    df = df.sort_values(by=['Miles'], ascending=False)
-    print(df)
\ No newline at end of file
+
+def count_mileage_TMC(districts, layer, split=False):
+    df = count_mileage(districts, layer, 'STARTMILEP', 'ENDMILEPOI', split)
+    print(df)
+    return df
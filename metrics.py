@@ -0,0 +1,134 @@
+import json
+import os
+import time
+from datetime import datetime
+from functools import wraps
+
+"""
+Lightweight timing and call-count instrumentation for the conflation pipeline.
+
+Functions decorated with @timed and the laps of a StageTimer add their wall time
+and call count to a process-wide registry, and count(name) keeps simple counters
+such as cursor opens.  Times are inclusive, so a stage that calls another
+timed stage includes its time.  save_metrics writes the registry as JSON to
+Logs/{conflationName}_metrics.json.
+"""
+
+METRICS_FOLDER = 'Logs'
+
+# Off by default, so the decorators only cost a flag check.  Turned on by
+# xd_to_rns.run_conflation(profile=True) or by setting it to True.
+ENABLED = False
+
+# stage name: [calls, seconds]
+stages = {}
+
+# counter name: count
+counters = {}
+
+
+def reset():
+    """ Clears the registry at the start of a run """
+    stages.clear()
+    counters.clear()
+
+
+def add_time(name, seconds, calls=1):
+    record = stages.setdefault(name, [0, 0.0])
+    record[0] += calls
+    record[1] += seconds
+
+
+def count(name, n=1):
+    """ Adds n to the counter name """
+    if ENABLED:
+        counters[name] = counters.get(name, 0) + n
+
+
+def timed(name=None):
+    """ Decorator that adds the wall time and call count of a function to the registry """
+    def decorator(function):
+        stageName = name or function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(stageName, time.perf_counter() - start)
+
+        return wrapper
+    return decorator
+
+
+class StageTimer:
+    """ Times consecutive stages of a long function without re-indenting it.  Each call
+        to lap(name) records the time since the previous lap as '{prefix}.{name}'. """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.start = time.perf_counter()
+        self.last = self.start
+
+
+    def lap(self, name):
+        now = time.perf_counter()
+        if ENABLED:
+            add_time(f'{self.prefix}.{name}', now - self.last)
+        self.last = now
+
+
+    def total(self):
+        """ Records the time since the timer was created as the prefix stage """
+        if ENABLED:
+            add_time(self.prefix, time.perf_counter() - self.start)
+
+
+def get_metrics():
+    """ Returns a picklable copy of the registry, eg. to send back from a worker process """
+    return {'stages': {name: list(record) for name, record in stages.items()}, 'counters': dict(counters)}
+
+
+def merge(snapshot):
+    """ Adds a snapshot from get_metrics (eg. from a worker process) to the registry """
+    for name, (calls, seconds) in snapshot['stages'].items():
+        add_time(name, seconds, calls)
+    for name, n in snapshot['counters'].items():
+        counters[name] = counters.get(name, 0) + n
+
+
+def save_metrics(conflationName, path=None):
+    """ Writes the registry to Logs/{conflationName}_metrics.json.  Counters are also
+        given per XD segment, using the 'segments' counter.  Nothing is written while
+        the instrumentation is off. """
+    if not ENABLED:
+        return None
+
+    path = path or os.path.join(METRICS_FOLDER, f'{conflationName}_metrics.json')
+    segments = counters.get('segments', 0)
+
+    output = {
+        'conflationName': conflationName,
+        'saved': datetime.now().isoformat(timespec='seconds'),
+        'segments': segments,
+        'stages': {
+            name: {
+                'calls': calls,
+                'seconds': round(seconds, 6),
+                'meanMs': round(seconds / calls * 1000, 6) if calls else None
+            }
+            for name, (calls, seconds) in sorted(stages.items(), key=lambda item: -item[1][1])
+        },
+        'counters': dict(sorted(counters.items())),
+        'perSegment': {name: round(n / segments, 6) for name, n in sorted(counters.items()) if segments and name != 'segments'}
+    }
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(output, file, indent=4)
+
+    return output
@@ -0,0 +1,218 @@
+import numpy as np
+from geometry_backend import MemoryTable, MPoint, MPointGeometry, MPolyline
+
+"""
+Synthetic LRS networks and matching XD segments, for benchmarking the conflation
+without the production file geodatabases or ArcGIS.
+
+The network is a grid of corridors.  Even corridors are divided routes, with an
+NB/SB (or EB/WB) pair of 'R-VA' carriageways that name each other as opposite
+direction routes, and odd corridors are undivided 'S-VA' routes with overlapping
+PR and NP routes.  Every third undivided route is multipart.  A ramp joins the
+NB and EB carriageways at each crossing of two divided routes, and there is an
+intersection point wherever two routes cross or a ramp meets a carriageway.
+
+Routes are digitized in their prime direction (north or east) with measures in
+miles, the same as the VDOT LRS, so XD segments travelling in the non-prime
+direction are located with descending measures.  XD segments follow the routes
+in their direction of travel at a small offset with vertex noise, and are broken
+at random lengths so that some of them cross intersections.  A few turn from one
+route onto another at a crossing.
+"""
+
+SPATIAL_REFERENCE = 3969
+METERS_PER_MILE = 1609.344
+
+# Distance (m) between the corridors of the grid
+CORRIDOR_SPACING = 3000
+
+# Distance (m) from the center of a divided route to each carriageway
+MEDIAN_OFFSET = 15
+
+# Distance (m) between route vertices
+VERTEX_SPACING = 100
+
+# Radius (m) of the ramps between divided routes
+RAMP_RADIUS = 185
+
+# Length (m) of the gap in the middle of a multipart route
+MULTIPART_GAP = 200
+
+# Range of XD segment lengths (m), their offset (m) to the right of the route and
+# the standard deviation (m) of the noise added to their vertices
+XD_LENGTH = (300, 1500)
+XD_OFFSET = 3
+XD_NOISE = 1
+
+LRS_FIELDS = ['RTE_NM', 'SHAPE@', 'RTE_OPPOSITE_DIRECTION_RTE_NM', 'RTE_PARENT_RTE_NM']
+XD_FIELDS = ['XDSegID', 'RoadNumber', 'RoadName', 'SlipRoad', 'SHAPE@']
+INTERSECTION_FIELDS = ['SHAPE@']
+
+
+def densify(points, spacing=VERTEX_SPACING):
+    """ Returns an (n, 2) array of points with extra vertices at most spacing apart """
+    points = np.asarray(points, dtype=float)
+    output = [points[:1]]
+    for start, end in zip(points[:-1], points[1:]):
+        steps = max(1, int(np.ceil(np.hypot(*(end - start)) / spacing)))
+        t = np.arange(1, steps + 1)[:, None] / steps
+        output.append(start + (end - start) * t)
+
+    return np.concatenate(output)
+
+
+def add_measures(xy, beginMP=0):
+    """ Returns an (n, 3) array of X, Y, M with M in miles along xy from beginMP """
+    distances = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))])
+    return np.column_stack([xy, beginMP + distances / METERS_PER_MILE])
+
+
+def make_route(xy, gap=None):
+    """ Returns a route polyline along xy.  If gap is given as (start, end) distances
+        along the line, that stretch is left out and the route is multipart, with
+        measures continuing across the gap. """
+    part = add_measures(densify(xy))
+    if gap is None:
+        return MPolyline([part], SPATIAL_REFERENCE)
+
+    distances = part[:, 2] * METERS_PER_MILE
+    return MPolyline([part[distances <= gap[0]], part[distances >= gap[1]]], SPATIAL_REFERENCE)
+
+
+def offset_line(xy, distance):
+    """ Offsets a polyline to the right of its direction by distance """
+    direction = np.gradient(xy, axis=0)
+    direction /= np.hypot(direction[:, 0], direction[:, 1])[:, None]
+    return xy + np.column_stack([direction[:, 1], -direction[:, 0]]) * distance
+
+
+def make_xd_segments(xy, rng):
+    """ Splits a line, given in its direction of travel, into XD segment geometries """
+    xy = densify(xy, VERTEX_SPACING / 2)
+    distances = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))])
+
+    breaks = [0.0]
+    while distances[-1] - breaks[-1] > XD_LENGTH[1]:
+        breaks.append(breaks[-1] + rng.uniform(*XD_LENGTH))
+    breaks.append(float(distances[-1]))
+
+    geoms = []
+    for start, end in zip(breaks[:-1], breaks[1:]):
+        inside = (distances > start) & (distances < end)
+        points = np.concatenate([
+            [[np.interp(start, distances, xy[:, 0]), np.interp(start, distances, xy[:, 1])]],
+            xy[inside],
+            [[np.interp(end, distances, xy[:, 0]), np.interp(end, distances, xy[:, 1])]]
+        ])
+        points = offset_line(points, XD_OFFSET) + rng.normal(0, XD_NOISE, points.shape)
+        geoms.append(MPolyline([np.column_stack([points, np.full(len(points), np.nan)])], SPATIAL_REFERENCE))
+
+    return geoms
+
+
+def get_route_names(i, axis, divided):
+    """ Returns (prime, nonprime, RoadNumber, RoadName) for corridor i """
+    if divided:
+        number = 2 * i + (95 if axis == 'x' else 64)
+        prefix, roadName = ('IS', f'I-{number}') if i % 4 == 0 else ('US', f'US-{number}')
+        prime, nonprime = ('NB', 'SB') if axis == 'x' else ('EB', 'WB')
+        return f'R-VA   {prefix}{number:05d}{prime}', f'R-VA   {prefix}{number:05d}{nonprime}', str(number), roadName
+
+    number = 600 + 2 * i + (0 if axis == 'x' else 1)
+    county = 1 + i % 99
+    return f'S-VA{county:03d}PR{number:05d}', f'S-VA{county:03d}NP{number:05d}', str(number), f'SR-{number}'
+
+
+def generate_network(gridSize, seed=0, spacing=CORRIDOR_SPACING):
+    """ Generates a synthetic LRS and matching XD segments.
+    Input:
+        gridSize - the number of north-south and of east-west corridors.  The number of XD
+                   segments grows with gridSize ** 2.
+        seed - the random seed for the XD segment breaks and vertex noise
+    Output:
+        a dict of MemoryTables:
+            'lrs' - the master LRS, without the NP routes
+            'overlapLRS' - every route, for flipRoutes
+            'intersections' - the LRS intersection points
+            'xd' - the XD segments
+    """
+    rng = np.random.default_rng(seed)
+    low, high = -spacing / 2, (gridSize - 0.5) * spacing
+    centers = np.arange(gridSize) * spacing
+
+    routes = []     # (rte_nm, geom, opp_rte_nm, parent_rte_nm, inMasterLRS)
+    xds = []        # (RoadNumber, RoadName, SlipRoad, geom)
+    lines = {'x': [], 'y': []}  # Carriageway coordinates, for the intersections
+
+    def corridor(axis, center, offset=0):
+        """ Returns the (2, 2) end points of a line in the prime direction, offset to the right """
+        if axis == 'x':
+            return np.array([[center + offset, low], [center + offset, high]])
+        return np.array([[low, center - offset], [high, center - offset]])
+
+    for axis in ('x', 'y'):
+        for i, center in enumerate(centers):
+            divided = i % 2 == 0
+            prime, nonprime, RoadNumber, RoadName = get_route_names(i, axis, divided)
+
+            if divided:
+                primeLine = corridor(axis, center, MEDIAN_OFFSET)
+                nonprimeLine = corridor(axis, center, -MEDIAN_OFFSET)
+                routes.append((prime, make_route(primeLine), nonprime, prime, True))
+                routes.append((nonprime, make_route(nonprimeLine), prime, prime, True))
+                lines[axis] += [center + MEDIAN_OFFSET, center - MEDIAN_OFFSET]
+
+                xds += [(RoadNumber, RoadName, '0', geom) for geom in make_xd_segments(primeLine, rng)]
+                xds += [(RoadNumber, RoadName, '0', geom) for geom in make_xd_segments(nonprimeLine[::-1], rng)]
+                continue
+
+            # Every third undivided route is multipart, with a gap in the middle
+            line = corridor(axis, center)
+            length = high - low
+            gap = ((length - MULTIPART_GAP) / 2, (length + MULTIPART_GAP) / 2) if i % 6 == 1 else None
+            geom = make_route(line, gap)
+            routes.append((prime, geom, nonprime, prime, True))
+            routes.append((nonprime, geom, prime, prime, False))
+            lines[axis].append(center)
+
+            for part in geom.parts:
+                xds += [(RoadNumber, RoadName, '0', xd) for xd in make_xd_segments(part[:, :2], rng)]
+                xds += [(RoadNumber, RoadName, '0', xd) for xd in make_xd_segments(part[::-1, :2], rng)]
+
+    # Intersection points where the carriageways cross
+    points = [(x, y) for x in lines['x'] for y in lines['y']]
+
+    # A ramp from the NB to the EB carriageway at each crossing of two divided routes
+    angles = np.radians(np.linspace(180, 90, 16))
+    rampNumber = 0
+    for i, x in enumerate(centers[::2]):
+        for j, y in enumerate(centers[::2]):
+            rampNumber += 1
+            nb = get_route_names(2 * i, 'x', True)[0]
+            center = np.array([x + MEDIAN_OFFSET + RAMP_RADIUS, y - MEDIAN_OFFSET - RAMP_RADIUS])
+            xy = center + RAMP_RADIUS * np.column_stack([np.cos(angles), np.sin(angles)])
+            rte_nm = f'{nb}RMP{rampNumber:03d}'
+            routes.append((rte_nm, make_route(xy), None, None, True))
+            points += [tuple(xy[0]), tuple(xy[-1])]
+
+            xds += [('', '', '1', geom) for geom in make_xd_segments(xy, rng)]
+
+    # An XD segment that turns from the north-south to the east-west route at each crossing
+    # of two single part undivided routes, so that it has to be split between the routes
+    for i, x in enumerate(centers):
+        for j, y in enumerate(centers):
+            if i % 2 == 1 and j % 2 == 1 and i % 6 != 1 and j % 6 != 1:
+                RoadNumber, RoadName = get_route_names(i, 'x', False)[2:]
+                xds += [(RoadNumber, RoadName, '0', geom) for geom in make_xd_segments([(x, y - 500), (x, y), (x + 500, y)], rng)]
+
+    lrs = MemoryTable(LRS_FIELDS, [route[:4] for route in routes if route[4]], SPATIAL_REFERENCE)
+    overlapLRS = MemoryTable(LRS_FIELDS, [route[:4] for route in routes], SPATIAL_REFERENCE)
+    intersections = MemoryTable(INTERSECTION_FIELDS, [(MPointGeometry(MPoint(x, y), SPATIAL_REFERENCE),) for x, y in points], SPATIAL_REFERENCE)
+    xd = MemoryTable(XD_FIELDS, [(1000000000 + i, *record) for i, record in enumerate(xds)], SPATIAL_REFERENCE)
+
+    return {
+        'lrs': lrs,
+        'overlapLRS': overlapLRS,
+        'intersections': intersections,
+        'xd': xd
+    }
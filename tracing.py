@@ -0,0 +1,129 @@
+import json
+import os
+import queue
+import threading
+import time
+
+"""
+Structured decision tracing for the conflation.
+
+Instead of formatting debug messages for every point and candidate route, the
+conflation records compact per-segment decisions (the iteration reached,
+candidate route counts, the routes chosen and any fallbacks taken) as records
+like {"XDSegID": 123, "event": "first_iteration", "routes": {...}, ...}.
+
+Tracing is off unless start() is called, and can be limited to a list of
+XDSegIDs.  Call sites check tracing.active before building a record:
+
+    if tracing.active:
+        tracing.trace('first_iteration', routes=dict(routes), result=rte_nm)
+
+so a run without tracing, or a segment that isn't selected, costs one attribute
+lookup per call site.  Records are put on a queue and written as JSON lines by
+a background thread, so the conflation never waits on the disk.
+"""
+
+TRACE_FOLDER = 'Logs'
+
+# True while the current XD segment is being traced.  Checked by every call site.
+active = False
+
+# Set by start and stop
+enabled = False
+selected = None         # XDSegIDs (as str) to trace, or None for every segment
+path = None
+currentSegment = None
+startTime = None
+records = None          # queue.SimpleQueue of (time, XDSegID, event, fields), a flush Event or None to stop
+writerThread = None
+
+
+def get_trace_path(conflationName):
+    return os.path.join(TRACE_FOLDER, f'{conflationName}_trace.jsonl')
+
+
+def write_records(file, records):
+    """ Background thread.  Writes records as JSON lines until it gets None. """
+    while True:
+        record = records.get()
+        if record is None:
+            break
+        if isinstance(record, threading.Event):
+            file.flush()
+            record.set()
+            continue
+
+        t, XDSegID, event, fields = record
+        file.write(json.dumps({'t': round(t, 6), 'XDSegID': XDSegID, 'event': event, **fields}, default=str) + '\n')
+
+    file.close()
+
+
+def start(tracePath, xdSegIDs=None):
+    """ Starts writing trace records to tracePath.
+    Input:
+        xdSegIDs - if given, only these XD segments are traced
+    """
+    global enabled, selected, path, startTime, records, writerThread
+
+    stop()
+    os.makedirs(os.path.dirname(tracePath) or '.', exist_ok=True)
+
+    enabled = True
+    selected = set(str(XDSegID) for XDSegID in xdSegIDs) if xdSegIDs is not None else None
+    path = tracePath
+    startTime = time.perf_counter()
+    records = queue.SimpleQueue()
+    writerThread = threading.Thread(target=write_records, args=(open(tracePath, 'w'), records), daemon=True)
+    writerThread.start()
+
+
+def stop():
+    """ Stops tracing and waits for the queued records to be written """
+    global enabled, active, writerThread
+
+    if writerThread is not None:
+        records.put(None)
+        writerThread.join()
+        writerThread = None
+
+    enabled = False
+    active = False
+
+
+def flush():
+    """ Waits until every queued record is on disk.  Worker processes call this before
+        returning results, since they can exit without stopping the writer thread. """
+    if writerThread is not None:
+        done = threading.Event()
+        records.put(done)
+        done.wait()
+
+
+def get_settings():
+    """ Returns (path, xdSegIDs) for starting the same trace in a worker process, or None """
+    if not enabled:
+        return None
+
+    return path, selected
+
+
+def begin_segment(XDSegID):
+    """ Sets the XD segment that the following records belong to.  Records are only
+        kept for the selected segments. """
+    global active, currentSegment
+
+    currentSegment = XDSegID
+    active = enabled and (selected is None or str(XDSegID) in selected)
+
+
+def end_segment():
+    global active, currentSegment
+
+    currentSegment = None
+    active = False
+
+
+def trace(event, **fields):
+    """ Records a decision for the current XD segment.  Only call this when active is True. """
+    records.put((time.perf_counter() - startTime, currentSegment, event, fields))
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+import numpy as np
+from geometry_backend import get_vertex_arrays, search_cursor
+
+"""
+Manifests of the XD segments used in a conflation run.  A manifest maps each
+XDSegID to a hash of its attributes and geometry, so the next XD map release can
+be compared against it and only the new or changed segments re-conflated.
+"""
+
+# The XD fields that affect the conflation of a segment
+MANIFEST_FIELDS = ['XDSegID', 'RoadNumber', 'RoadName', 'SlipRoad', 'SHAPE@']
+
+# Vertex coordinates are rounded to this many decimals (mm in Virginia Lambert) before
+# hashing, so that re-projecting or copying a layer doesn't flag every segment as changed
+COORDINATE_DECIMALS = 3
+
+
+def get_manifest_path(outputPath):
+    """ Returns the path of the manifest saved next to a conflation output """
+    return f'{os.path.splitext(outputPath)[0]}_manifest.json'
+
+
+def hash_segment(RoadNumber, RoadName, SlipRoad, geom):
+    """ Returns an md5 hex digest of the attributes and vertices of an XD segment """
+    md5 = hashlib.md5(json.dumps([RoadNumber, RoadName, SlipRoad], default=str).encode())
+    for part in get_vertex_arrays(geom) if geom else []:
+        md5.update(np.round(part[:, :2], COORDINATE_DECIMALS).tobytes())
+        md5.update(b'|')
+
+    return md5.hexdigest()
+
+
+def build_manifest(xd, xdFilter=''):
+    """ Returns {XDSegID: hash} for the XD segments in xd, in search cursor order """
+    manifest = {}
+    with search_cursor(xd, MANIFEST_FIELDS, xdFilter) as cur:
+        for XDSegID, RoadNumber, RoadName, SlipRoad, geom in cur:
+            manifest[str(XDSegID)] = hash_segment(RoadNumber, RoadName, SlipRoad, geom)
+
+    return manifest
+
+
+def load_manifest(path):
+    """ Returns the manifest saved at path, or None if there isn't one """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_manifest(manifest, path):
+    """ Saves a manifest.  It is written to a temporary file first so that a killed
+        run never leaves a partial manifest behind. """
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(path + '.tmp', path)
+
+
+def diff_manifests(previous, current):
+    """ Compares the manifest of the previous run with the current XD segments.
+    Output:
+        (new, changed, unchanged, removed) - sets of XDSegIDs
+    """
+    previous = previous or {}
+    new = {XDSegID for XDSegID in current if XDSegID not in previous}
+    changed = {XDSegID for XDSegID in current if XDSegID in previous and previous[XDSegID] != current[XDSegID]}
+    unchanged = set(current) - new - changed
+    removed = set(previous) - set(current)
+
+    return new, changed, unchanged, removed
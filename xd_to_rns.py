@@ -1,16 +1,37 @@
-import arcpy
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
+import math
+import numpy as np
+import os
 import pandas as pd
 from datetime import datetime
 from difflib import SequenceMatcher
 import traceback
-
+from checkpoint import Checkpoint
+from event_writer import EventWriter, read_events
+from xd_manifest import build_manifest, diff_manifests, get_manifest_path, load_manifest, save_manifest
+from geometry_backend import MemoryTable, RangeFilter, ValueFilter, get_backend, get_xy, search_cursor
+from hausdorff import directed_hausdorff
+import metrics
+from metrics import count, timed
+import tracing
+from lrs_diff import find_lrs_affected_segments, save_lrs_changes
+from lrs_index import IntersectionIndex, RouteIndex, RouteIntersectionTable, RouteStore
+
+# Per-segment decisions are recorded with the tracing module.  The log only gets the run summary.
 log = logging.getLogger(__name__)
-log.setLevel(logging.DEBUG) # Set the debug level here
-fileHandler = logging.FileHandler(f'Logs\XD.log', mode='w')
+log.setLevel(logging.INFO) # Set the debug level here
+fileHandler = logging.FileHandler(os.path.join('Logs', 'XD.log'), mode='w', delay=True)
 log.addHandler(fileHandler)
 
+# Geometry backend used to create points and polylines.  See set_backend
+backend = get_backend()
+
 count_firstIteration = 0
 count_secondIteration = 0
 count_error = 0
@@ -19,6 +40,19 @@ error_list = []
 # A dictionary of route: opposite route from the LRS
 dict_LRS_Route_Opposite = {}
 
+# Route geometries keyed by RTE_NM and a spatial index over them, built once in match_xd_to_lrs
+routeStore = None
+routeIndex = None
+
+# KD-tree over the LRS intersection points and the intersections touching each
+# route, built once in match_xd_to_lrs
+intersectionIndex = None
+routeIntersections = None
+
+# The (lrs, intersections, lrsFilter, backend name) that the indexes above were built
+# from, so that later runs in the same process on the same LRS reuse them
+loadedLRS = None
+
 # This is a list of routes where the MP is backwards than expected
 # It should be used to correct invalid results and updated with
 # new versions LRS if they are corrected
@@ -26,6 +60,12 @@ LRS_RTE_ERRORS__REVERSED_MP = [
     'R-VA000SC06624NB'
 ]
 
+XDFields = ['XDSegID','RoadNumber','RoadName','SlipRoad','SHAPE@']
+
+# Number of XD segments read at a time for the bulk first iteration
+FIRST_PASS_BLOCK_SIZE = 10000
+
+
 class XDSegment:
     def __init__(self, record):
         self.XDSegID = record[0]
@@ -34,8 +74,8 @@ class XDSegment:
         self.SlipRoad = record[3]
         self.Geom = record[4]
 
-        self.BeginPoint = arcpy.PointGeometry(self.Geom.firstPoint,arcpy.SpatialReference(3969))
-        self.EndPoint = arcpy.PointGeometry(self.Geom.lastPoint,arcpy.SpatialReference(3969))
+        self.BeginPoint = backend.PointGeometry(self.Geom.firstPoint,backend.SpatialReference(3969))
+        self.EndPoint = backend.PointGeometry(self.Geom.lastPoint,backend.SpatialReference(3969))
         self.MidPoint = self.Geom.positionAlongLine(0.5, True)
 
 
@@ -46,27 +86,19 @@ class MatchedRoute:
         self.geom, self.geomOpposite = self.get_geom(lrs)
         self.XDSegGeom = XDSeg.Geom
         self.distanceFromXDSeg = self.get_distance_from_XD_Seg(XDSeg.BeginPoint)
-        self.beginPoint = arcpy.PointGeometry(arcpy.Point(0,0))
-        self.endPoint = arcpy.PointGeometry(arcpy.Point(0,0))
+        self.beginPoint = backend.PointGeometry(backend.Point(0,0))
+        self.endPoint = backend.PointGeometry(backend.Point(0,0))
         self.intersections = None
         self.distanceToClosestIntersection = None
         self.matchOrder = None
 
 
     def get_geom(self, lrs):
-        try:
-            arcpy.management.SelectLayerByAttribute(lrs,'CLEAR_SELECTION')
-            geoms = {row[0]: row[1] for row in arcpy.da.SearchCursor(lrs, ['RTE_NM','SHAPE@'], f"RTE_NM in ('{self.rte_nm}', '{self.rte_nm_opposite}')")}
-            geom = geoms[self.rte_nm]
-            try:
-                geomOpposite = geoms[self.rte_nm_opposite]
-            except:
-                geomOpposite = None
-
-            return geom, geomOpposite
-        except:
+        if self.rte_nm not in routeStore:
             return None, None
 
+        return routeStore.get(self.rte_nm), routeStore.get(self.rte_nm_opposite)
+
 
     def get_distance_from_XD_Seg(self, XDBeginPoint):
         try:
@@ -77,9 +109,7 @@ class MatchedRoute:
     
     def get_distance_to_closest_intersection(self, lyrIntersections, XDSeg):
         BeginPoint = XDSeg.BeginPoint
-        arcpy.management.SelectLayerByAttribute(lyrIntersections,'CLEAR_SELECTION')
-        arcpy.SelectLayerByLocation_management(lyrIntersections, 'WITHIN_A_DISTANCE', self.geom, '5 METERS', 'NEW_SELECTION')
-        intersections = [row[0] for row in arcpy.da.SearchCursor(lyrIntersections, 'SHAPE@')]
+        intersections = [intersectionIndex.get_point(oid) for oid in sorted(routeIntersections.get_ints(self.rte_nm))]
         for intersection in intersections:
             dist = BeginPoint.distanceTo(intersection)
             if self.distanceToClosestIntersection is None:
@@ -92,12 +122,8 @@ class MatchedRoute:
     def get_ints(self, intersections):
         """ Locates all of the routes that are near this potential match and the XD segment geometry """
 
-        arcpy.management.SelectLayerByAttribute(intersections,'CLEAR_SELECTION')
-        arcpy.SelectLayerByLocation_management(intersections, 'WITHIN_A_DISTANCE', self.geom, '5 METERS', 'NEW_SELECTION')
-        arcpy.SelectLayerByLocation_management(intersections, 'WITHIN_A_DISTANCE', self.XDSegGeom, '15 METERS', 'SUBSET_SELECTION')
-
-
-        self.intersections = list(intersections.getSelectionSet())
+        nearXDSeg = intersectionIndex.near_polyline(self.XDSegGeom, 15)
+        self.intersections = [oid for oid in nearXDSeg if oid in routeIntersections.get_ints(self.rte_nm)]
 
     
 
@@ -111,23 +137,26 @@ def get_begin_middle_end(geom):
     return
 
 
-def find_nearby_routes(point, lrs, XDSeg, searchDistance="9 METERS", rerun=False):
-    """ Given an input point, will return a list of all routes within the searchDistance """
+@timed()
+def find_nearby_routes(point, lrs, XDSeg, searchDistance=9, rerun=False, withDistances=False):
+    """ Given an input point, will return a list of all routes within the searchDistance
+        (in meters).  If withDistances is True, a list of (rte_nm, distance) is returned
+        so that callers can re-rank the candidates without redoing the geometry work. """
 
     # Short routes require a short search distance in order to find anything
     if XDSeg.Geom.getLength() < 18:
-        searchDistance = f"{XDSeg.Geom.getLength() / 4} METERS"
+        searchDistance = XDSeg.Geom.getLength() / 4
     
     if rerun == True:
-        searchDistance = "20 METERS"
+        searchDistance = 20
 
-    routes = []
-    arcpy.management.SelectLayerByLocation(lrs, 'WITHIN_A_DISTANCE', point, searchDistance)
-    with arcpy.da.SearchCursor(lrs, 'RTE_NM') as cur:
-        for row in cur:
-            routes.append(row[0])
+    # The route index replaces a select by location on the full LRS layer
+    routes = routeIndex.query(point.firstPoint.X, point.firstPoint.Y, searchDistance)
 
-    return routes
+    if withDistances:
+        return routes
+
+    return [route[0] for route in routes]
 
 
 def get_most_common(c):
@@ -140,54 +169,41 @@ def get_most_common(c):
     return most_commons
 
 
+@timed()
+def get_point_mps(points, rte_nms):
+    """ Locates the MP values of many points along the LRS in a single vectorized pass.
+        See RouteStore.locate_points.
+    Input:
+        points - a list of PointGeometry or Point objects from the geometry backend
+        rte_nms - the lrs rte_nm that each point will be placed on
+    Output:
+        a list of m-values rounded to 3 decimals, with None where the point could not be located
+    """
+    xy = [get_xy(point) for point in points]
+    measures, positions, partIndexes = routeStore.locate_points(xy, rte_nms, intersectionIndex)
+
+    return [None if np.isnan(mp) else round(float(mp), 3) for mp in measures]
+
+
+@timed()
 def get_point_mp(inputPointGeometry, lrs, rte_nm, lyrIntersections):
     """ Locates the MP value of an input point along the LRS
         ** The spatial reference of the input must match the spatial reference
            of the lrs! **
     Input:
-        inputPointGeometry - an arcpy PointGeometry object
+        inputPointGeometry - a PointGeometry from the geometry backend
         lrs - a reference to the lrs layer
         rte_nm - the lrs rte_nm that the polyline will be placed on
     Output:
         mp - the m-value of the input point
     """
-    try:
-        # Get the geometry for the LRS route
-        arcpy.management.SelectLayerByAttribute(lrs,'CLEAR_SELECTION')
-
-        with arcpy.da.SearchCursor(lrs, "SHAPE@", "RTE_NM = '{}'".format(rte_nm)) as cur:
-            for row in cur:
-                RouteGeom = row[0]
-
-        # Check for route multipart geometry.  If multipart, find closest part to
-        # ensure that the correct MP is returned
-        if RouteGeom.isMultipart:
-            # Get list of parts
-            parts = [arcpy.Polyline(RouteGeom[i], has_m=True) for i in range(RouteGeom.partCount)]
-
-            # Get distances from inputPolyline's mid-point to each route part
-            partDists = {inputPointGeometry.distanceTo(part):part for part in parts}
-
-            # Replace RouteGeom with closest polyline part
-            RouteGeom = partDists[min(partDists)]
-
-
-        rteMeasure = RouteGeom.measureOnLine(inputPointGeometry)
-        rtePosition = RouteGeom.positionAlongLine(rteMeasure)
-
-        rtePosition, moved = move_to_closest_int(rtePosition, lyrIntersections)
+    # The point is located on the closest part of the route and moved to the
+    # closest intersection within 10m, if there is one
+    mp = get_point_mps([inputPointGeometry], [rte_nm])[0]
+    if mp is None:
+        print(f'Unable to locate point on {rte_nm}')
 
-        if moved:
-            rteMeasure = RouteGeom.measureOnLine(rtePosition)
-            rtePosition = RouteGeom.positionAlongLine(rteMeasure)
-
-        mp = rtePosition.firstPoint.M
-        return round(mp, 3)
-    
-    except Exception as e:
-        print(e)
-        print(rte_nm)
-        return None
+    return mp
 
 
 def get_points_along_line(geom, d=50, rerun=False):
@@ -195,16 +211,13 @@ def get_points_along_line(geom, d=50, rerun=False):
         return them as a list """
     
     segLen = geom.getLength('GEODESIC','METERS')
-    log.debug(f'      segLen: {segLen}')
 
     # For short segments, reduce m to increase the number of test points
     if segLen <= 150:
         if rerun == False:
             d = segLen / 4
-            log.debug(f'      Reduced d to {d}')
         else:            
             d = segLen / 5
-            log.debug(f'      Reduced d to {d}')
     points = []
 
     m = 0
@@ -212,40 +225,27 @@ def get_points_along_line(geom, d=50, rerun=False):
         points.append(geom.positionAlongLine(m))
         m += d
 
-    for point in points:
-        log.debug(f'        {point.firstPoint.X}, {point.firstPoint.Y}')
+    if tracing.active:
+        tracing.trace('points_along_line', length=round(segLen, 2), d=round(d, 2), points=len(points))
     
     return points
 
 
+@timed()
 def move_to_closest_int(geom, lyrIntersections, testDistance=10):
     """ Returns input testGeom moved to the nearest intersection """
-    log.debug(f"        move_to_closest_int input geom: {geom.firstPoint.X}, {geom.firstPoint.Y}")
+    x = geom.firstPoint.X
+    y = geom.firstPoint.Y
 
-    arcpy.SelectLayerByLocation_management(lyrIntersections, "INTERSECT", geom, testDistance)
-    intersections = [row[0] for row in arcpy.da.SearchCursor(lyrIntersections, "SHAPE@")]
-    if len(intersections) == 0:
-        log.debug(f"        No intersections within {testDistance}m distance.  Returning testGeom.")
+    oids, dists, coords = intersectionIndex.nearest_within((x, y), testDistance)
+    if oids[0] == -1:
         moved = False
         return geom, moved
-    
-    if len(intersections) == 1:
-        log.debug(f"        One intersection within {testDistance}m distance.  Returning intersection at {intersections[0].firstPoint.X}, {intersections[0].firstPoint.Y}.")
-        moved = True
-        return intersections[0].firstPoint, moved
-
-    log.debug(f"        {len(intersections)} intersections found.  Returning closest intersection.")
-    closestInt = intersections[0]
-    closestIntDist = testDistance
-    for intersection in intersections:
-        dist = geom.distanceTo(intersection)
-        if dist < closestIntDist:
-            closestInt = intersection
-            closestIntDist = dist
-    
-    log.debug(f"        Returning intersection at {closestInt.firstPoint.X}, {closestInt.firstPoint.Y}")
+
+    if tracing.active:
+        tracing.trace('move_to_closest_int', point=(round(x, 3), round(y, 3)), intersection=int(oids[0]), distance=round(float(dists[0]), 3))
     moved = True
-    return closestInt.firstPoint, moved
+    return backend.Point(coords[0][0], coords[0][1]), moved
 
 
 def compare_route_name_similarity(rteA, rteB, lrs, XDSegID_Bearing=None):
@@ -254,81 +254,67 @@ def compare_route_name_similarity(rteA, rteB, lrs, XDSegID_Bearing=None):
         identify these cases and only return one route if they are very similar.  In these
         cases, the prime direction will take priority.  If the XD segment belongs to the
         non-prime side, this will be fixed in the route flipping step. """
-    log.debug(f"\n        Comparing similarity between '{rteA}' and '{rteB}'")
-
     # First check route type (eg, IS, US, etc).  If they do not match, then the routes are different
     rteA_type = rteA[7:9]
     rteB_type = rteB[7:9]
     
     if rteA_type != rteB_type and rteA.startswith('R-VA'):
-        log.debug(f"\n        Routes of different type - returning both '{rteA}' and '{rteB}'")
+        if tracing.active:
+            tracing.trace('compare_route_names', routes=[rteA, rteB], similarity=None, result=[rteA, rteB])
         return [rteA, rteB]
 
     sm = SequenceMatcher(None, rteA, rteB)
     similarity = sm.ratio()
-    log.debug(f'        Similarity Ratio: {similarity}')
     if similarity >= 0.9: # Likely the same route
         # Identify the prime direction
-        arcpy.management.SelectLayerByAttribute(lrs,'CLEAR_SELECTION')
-        rte_parent_rte_nm = [row[0] for row in arcpy.da.SearchCursor(lrs, 'RTE_PARENT_RTE_NM', f"RTE_NM IN ('{rteA}','{rteB}')") if row[0] is not None]
+        rte_parent_rte_nm = [routeStore.parent[rte_nm] for rte_nm, geom in routeStore.get_routes([rteA, rteB]) if routeStore.parent[rte_nm] is not None]
 
         if len(rte_parent_rte_nm) == 1:
-            log.debug(f'        Returning {rte_parent_rte_nm}\n')
+            if tracing.active:
+                tracing.trace('compare_route_names', routes=[rteA, rteB], similarity=round(similarity, 3), result=rte_parent_rte_nm)
             return rte_parent_rte_nm
     
-    log.debug(f'        Returning {[rteA, rteB]}\n')
+    if tracing.active:
+        tracing.trace('compare_route_names', routes=[rteA, rteB], similarity=round(similarity, 3), result=[rteA, rteB])
     return [rteA, rteB]
 
 
+@timed()
 def find_common_intersection(rteA, rteB, lrs, intersections, XDSeg, commonIntsUsed=[]):
     """ Given two rte_nms, this will return the intersection objectID if the two
         routes share a single intersection """
 
-    def get_ints(rte_nm, lrs, intersections):
-        arcpy.management.SelectLayerByAttribute(lrs,'CLEAR_SELECTION')
-        arcpy.management.SelectLayerByAttribute(intersections,'CLEAR_SELECTION')
-
-        geom = [row[0] for row in arcpy.da.SearchCursor(lrs, 'SHAPE@', f"RTE_NM = '{rte_nm}'")][0]
-
-        arcpy.SelectLayerByLocation_management(intersections, 'WITHIN_A_DISTANCE', geom, '5 METERS', 'NEW_SELECTION')
-
-
-        return list(intersections.getSelectionSet())
     try:
-        rteAInts = get_ints(rteA, lrs, intersections)
-        rteBInts = get_ints(rteB, lrs, intersections)
-
-        commonInts = [rte for rte in rteAInts if rte in rteBInts]
+        commonInts = routeIntersections.common_ints(rteA, rteB)
 
         # Remove int as an option if it's already been used
         if len(commonIntsUsed) != 0:
             commonInts = [int for int in commonInts if int not in commonIntsUsed]
 
         if len(commonInts) == 1:
-            log.debug(f'        One common intersection found: {commonInts}\n')
+            if tracing.active:
+                tracing.trace('common_intersection', routes=[rteA, rteB], common=commonInts, result=commonInts[0])
             return commonInts[0]
 
         if len(commonInts) > 1:
-            log.debug(f'        {len(commonInts)} common intersections found: {commonInts}\n')
             # Attempt to narrow down intersections to one
-            log.debug(f'        Selecting only nearby common intersections')
-            arcpy.management.SelectLayerByAttribute(intersections,'CLEAR_SELECTION')
-            arcpy.SelectLayerByLocation_management(intersections, "INTERSECT", XDSeg.Geom, "10 METERS")
-            nearbyInts = intersections.getSelectionSet()
+            nearbyInts = intersectionIndex.near_polyline(XDSeg.Geom, 10)
             commonInts2 = [int for int in nearbyInts if int in commonInts]
             if len(commonInts2) == 1:
-                log.debug(f'        {len(commonInts2)} nearby common intersection found.  Returning {commonInts2[0]}')
+                if tracing.active:
+                    tracing.trace('common_intersection', routes=[rteA, rteB], common=commonInts, nearby=commonInts2, result=commonInts2[0])
                 return commonInts2[0]
 
             if len(commonInts2) == 0:
-                log.debug(f'        {len(commonInts2)} nearby common intersections found.  Returning None and hoping for the best')
+                if tracing.active:
+                    tracing.trace('common_intersection', routes=[rteA, rteB], common=commonInts, nearby=commonInts2, result=None)
                 return None
 
-            log.debug(f'        {len(commonInts2)} nearby common intersections found.  Returning int closest to end point and hoping for the best')
+            # Several nearby common intersections.  Use the one closest to the end point and hope for the best
             closestInt = commonInts[0]
             closestIntDist = None
             for intersection in commonInts:
-                intGeom = [row[0] for row in arcpy.da.SearchCursor(intersections,'SHAPE@',f'OBJECTID = {intersection}')][0]
+                intGeom = intersectionIndex.get_point(intersection)
                 dist = XDSeg.EndPoint.distanceTo(intGeom)
                 if closestIntDist is None:
                     closestIntDist = dist
@@ -338,134 +324,180 @@ def find_common_intersection(rteA, rteB, lrs, intersections, XDSeg, commonIntsUs
                     closestInt = intersection
                     closestIntDist = dist
 
+            if tracing.active:
+                tracing.trace('common_intersection', routes=[rteA, rteB], common=commonInts, nearby=commonInts2, result=closestInt, fallback='closest_to_end_point')
             return closestInt
     except Exception as e:
-        log.debug('        ERROR IN find_common_intersection')
-        log.debug(f'       {e}')
-        log.debug('        No common intersections found\n')
+        if tracing.active:
+            tracing.trace('common_intersection', routes=[rteA, rteB], result=None, error=str(e))
         return None
-        
 
-    log.debug('        No common intersections found\n')
+    if tracing.active:
+        tracing.trace('common_intersection', routes=[rteA, rteB], common=[], result=None)
     return None
 
 
+@timed()
 def is_similar_shape(geom1, rte_nm, lrs, normalize=True):
-    arcpy.management.SelectLayerByAttribute(lrs,'CLEAR_SELECTION')
-    geom2 = [row[0] for row in arcpy.da.SearchCursor(lrs, 'SHAPE@', f"RTE_NM = '{rte_nm}'")][0]
-    rawDistances = []
-    finalDistances = []
-
-    # Compare geom1 to geom2
-    for part in geom1:
-        for point in part:
-            point = arcpy.PointGeometry(point, arcpy.SpatialReference(3969))
-            rawDistances.append(point.distanceTo(geom2))
-    
-    if normalize:
-        # Normalize by reducing each distance by minimum distance.  This will "move" the
-        # closest parts of geom1 and geom2 together to better compare geometry shape
-        rawDistances = [dist - min(rawDistances) for dist in rawDistances]
-
-    maxDist = max(rawDistances)
-    finalDistances.append(maxDist)
-
-    # Compare geom2 to geom1
-    rawDistances = []
-    geom2 = geom1.buffer(20).intersect(geom2,2)
-    for part in geom2:
-        for point in part:
-            point = arcpy.PointGeometry(point, arcpy.SpatialReference(3969))
-            rawDistances.append(point.distanceTo(geom1))
-    
-    if normalize:
-        # Normalize by reducing each distance by minimum distance.  This will "move" the
-        # closest parts of geom1 and geom2 together to better compare geometry shape
-        rawDistances = [dist - min(rawDistances) for dist in rawDistances]
-
-    maxDist = max(rawDistances)
-    finalDistances.append(maxDist)
-
-    # Get min score from both comparisons
-    hausdorff = min(finalDistances)
-    log.debug(f'Hausdorff: {hausdorff}.  Normalized: {normalize}')
-    if hausdorff < (geom1.getLength()/4):
+    geom2 = routeStore.geoms[rte_nm]
+    similarDist = geom1.getLength()/4
+
+    # Compare geom1 to geom2.  The final score is the min of both comparisons, so if
+    # this one is already similar enough there is no need to compare geom2 to geom1
+    hausdorff = directed_hausdorff(geom1, routeStore.vertices[rte_nm], normalize, threshold=similarDist)
+
+    if hausdorff >= similarDist:
+        # Compare geom2 to geom1.  If no part of the route is within the buffer, the shapes
+        # are not similar.
+        geom2 = backend.buffer_intersect(geom1, geom2, 20)
+        if geom2 is not None and geom2.pointCount > 1:
+            hausdorff = min(hausdorff, directed_hausdorff(geom2, geom1, normalize, threshold=similarDist))
+
+    if tracing.active:
+        tracing.trace('similar_shape', rte_nm=rte_nm, hausdorff=round(float(hausdorff), 2), threshold=round(similarDist, 2), normalized=normalize, similar=bool(hausdorff < similarDist))
+    if hausdorff < similarDist:
         return True
     else:
         return False
 
 
 
+@timed()
 def first_iteration(XDSeg, lrs, rerun=False):
     """ Find the nearby routes for the begin, middle, and end point of the XD segment.
         If only one route appears, then that is considered the likely match. """
 
-    log.debug('    First Iteration...')
     routes = Counter()
     for point in [XDSeg.BeginPoint, XDSeg.MidPoint, XDSeg.EndPoint]:
         nearbyRoutes = find_nearby_routes(point, lrs, XDSeg, rerun=rerun)
         for route in nearbyRoutes:
             routes[route] += 1
 
+    if tracing.active:
+        tracing.trace('first_iteration', rerun=rerun, routes=dict(routes))
+
     if len(routes) == 0:
         if rerun == False:
         # Try again with longer distance before trying more detailed approach
-            log.debug(f'\n\n      Failed to find matching route - trying larger search distance')
             results = first_iteration(XDSeg, lrs, rerun=True)
             if results:
                 return results
             else:
-                log.debug(f'      -- Failed to find matching route --')
                 return None
 
-        log.debug(f'      -- Failed to find matching route --')
         return None
-
-    log.debug(f'      Nearby routes found:\n')
-    log.debug(f'      {routes}\n')
     
     # This is different than routes.most_common().  Get_most_common() will return only the 
     # most common value(s) rather than ordering the results by most common.
     mostCommonRoutes = get_most_common(routes) 
 
-    log.debug(f'      Most Common: {mostCommonRoutes}')
-    log.debug(f'      Most Common Count: {len(mostCommonRoutes)}')
-
     # If only one route is found 3 times, return matching rte_nm
     if len(mostCommonRoutes) == 1 and mostCommonRoutes[0][1] == 3:
-        log.debug(f'      -- Matching route found --')
         return mostCommonRoutes[0][0]
     else:
         if rerun == False:
         # Try again with longer distance before trying more detailed approach
-            log.debug(f'\n\n      Failed to find matching route - trying larger search distance')
             results = first_iteration(XDSeg, lrs, rerun=True)
             if results:
-                log.debug(f'\n\n        Results found - testing for shape similarity:')
-
                 # Test Hausdorff Distance to ensure random route wasn't picked up
                 if is_similar_shape(XDSeg.Geom, results, lrs, normalize=False):
-                    log.debug(f'\n\n        is_similar_shape == True')
                     return results
                 else:
-                    log.debug(f'      -- Shape not similar enough: Failed to find matching route --')
                     return None
             else:
-                log.debug(f'      -- Failed to find matching route --')
                 return None
-        log.debug(f'      -- Failed to find matching route --')
         return None
 
 
+def match_all_points(xy, searchDistances, segmentCount):
+    """ Batch version of the first_iteration route count.  xy holds the begin, middle
+        and end point of each XD segment, one after the other.
+    Output:
+        (matches, found) - matches is the route id found near all three points of each
+        segment, or -1 if there is not exactly one such route.  found is True for
+        segments with any nearby route.
+    """
+    pointIndexes, routeIds = routeIndex.query_many(xy[:, 0], xy[:, 1], searchDistances)
+    routeCount = max(len(routeIndex.rte_nms), 1)
+    segmentIndexes = pointIndexes // 3
+
+    found = np.bincount(segmentIndexes, minlength=segmentCount) > 0
+
+    # A route that is near the begin, middle and end point is counted 3 times.  This is
+    # only a match if it is the single most common route of the segment.
+    keys, counts = np.unique(segmentIndexes * routeCount + routeIds, return_counts=True)
+    keys = keys[counts == 3]
+    matchSegments = keys // routeCount
+    single = np.bincount(matchSegments, minlength=segmentCount)[matchSegments] == 1
+
+    matches = np.full(segmentCount, -1, dtype=np.int64)
+    matches[matchSegments[single]] = keys[single] % routeCount
+
+    return matches, found
+
+
+@timed()
+def bulk_first_iteration(XDSegs, lrs):
+    """ Runs first_iteration for many XD segments at once.  The begin, middle and end
+        points of every segment are queried against the route index in one batch at
+        the normal search distance and again at the rerun distance for the segments
+        that are still unresolved.
+    Output:
+        a list of (rte_nm, beginMP, endMP) for each segment, with (None, None, None)
+        where the first iteration failed.  These are passed to conflate_segment.
+    """
+    if not XDSegs:
+        return []
+
+    xy = np.array([[get_xy(point) for point in (XDSeg.BeginPoint, XDSeg.MidPoint, XDSeg.EndPoint)] for XDSeg in XDSegs], dtype=float).reshape(-1, 2)
+
+    # Short routes require a short search distance in order to find anything (see find_nearby_routes)
+    lengths = np.array([XDSeg.Geom.getLength() for XDSeg in XDSegs])
+    searchDistances = np.repeat(np.where(lengths < 18, lengths / 4, 9), 3)
+
+    matches, found = match_all_points(xy, searchDistances, len(XDSegs))
+
+    # Try again with longer distance for the segments without a single match
+    rerun = np.flatnonzero(matches < 0)
+    rerunMatches, rerunFound = match_all_points(xy[(rerun[:, None] * 3 + np.arange(3)).ravel()], 20, len(rerun))
+
+    results = [None] * len(XDSegs)
+    for i in np.flatnonzero(matches >= 0):
+        results[i] = routeIndex.rte_nms[matches[i]]
+
+    for i, match in zip(rerun, rerunMatches):
+        if match < 0:
+            continue
+
+        rte_nm = routeIndex.rte_nms[match]
+        if not found[i]:
+            results[i] = rte_nm
+
+        # Test Hausdorff Distance to ensure random route wasn't picked up
+        elif is_similar_shape(XDSegs[i].Geom, rte_nm, lrs, normalize=False):
+            results[i] = rte_nm
+
+    # Locate the begin and end points of every match in one pass
+    matched = [i for i, rte_nm in enumerate(results) if rte_nm is not None]
+    points = [XDSegs[i].BeginPoint for i in matched] + [XDSegs[i].EndPoint for i in matched]
+    rte_nms = [results[i] for i in matched]
+    mps = get_point_mps(points, rte_nms * 2)
+
+    firstMatches = [(None, None, None)] * len(XDSegs)
+    for i, rte_nm, beginMP, endMP in zip(matched, rte_nms, mps[:len(matched)], mps[len(matched):]):
+        for mp in (beginMP, endMP):
+            if mp is None:
+                print(f'Unable to locate point on {rte_nm}')
+        firstMatches[i] = (rte_nm, beginMP, endMP)
+
+    return firstMatches
+
+
+@timed()
 def second_iteration(XDSeg, lrs, d=25, rerun=False):
     """ Similar to first_iteration, except the nearby routes are found every d
         distance along the line. """
 
-    if rerun == False:
-        log.debug('\n    Second Iteration...')
-    else:
-        log.debug('\n    Third Iteration...')
-
     routes = Counter()
     
     # Get a list of points every d distance along segment
@@ -477,18 +509,14 @@ def second_iteration(XDSeg, lrs, d=25, rerun=False):
         for route in nearbyRoutes:
             routes[route] += 1
 
-    log.debug(f'\n      Nearby routes found:')
-    log.debug(f'      {routes}\n')
+    if tracing.active:
+        tracing.trace('second_iteration', rerun=rerun, d=d, points=len(points), routes=dict(routes))
     mostCommonRoutes = routes.most_common()
 
-    log.debug(f'      Most Common: {mostCommonRoutes}')
-
     # Get matching routes where there are at least 3 matches
     routes = [route[0] for route in mostCommonRoutes if route[1] >= 3]
-    log.debug(f'      Most Common Count (>= 3): {len(routes)}')
 
     if len(routes) == 1:
-        log.debug(f'      -- Matching route found --')
         return routes
 
     if len(routes) >= 1:
@@ -498,25 +526,21 @@ def second_iteration(XDSeg, lrs, d=25, rerun=False):
         firstCommonCount = mostCommonRoutes[0][1]
         secondCommonCount = mostCommonRoutes[1][1]
         if firstCommonCount - secondCommonCount > 10 and secondCommonCount < 10:
-            log.debug(f'      -- Matching route(s) found --')
-            log.debug(f'      Large gap between first and second most common route.  Only returning first.')
+            # Large gap between first and second most common route.  Only return the first
+            if tracing.active:
+                tracing.trace('fallback', reason='large_count_gap', kept=mostCommonRoutes[0][0])
             return [mostCommonRoutes[0][0]]
-            
-        log.debug(f'      -- Matching route(s) found --')
         
         return routes
     else:
         if rerun == False:
             # Try reducing the distance farther
-            log.debug(f'      Reducing d to 10...\n')
             routes = second_iteration(XDSeg, lrs, d=10, rerun=True)
             if routes is not None:
                 return routes
             else:
-                log.debug(f'      -- Failed to find matching route(s) --')
                 return None
 
-    log.debug(f'      -- Failed to find matching route(s) --')
     return None
 
 
@@ -526,21 +550,92 @@ def third_iteration(XDSeg):
     return
 
 
-def match_xd_to_lrs(xd, lrs, intersections, xdFilter='', lrsFilter='', printProgress=False):
-    """ For each xd segment in input xd, attempt to locate on the lrs.  If unable to locate,
-        the record will contain null values for all except XDSegID """
+def set_backend(name=None):
+    """ Sets the geometry backend used by the conflation, 'arcpy' or 'numpy'.  The
+        numpy backend runs without ArcGIS on MemoryTable inputs. """
+    global backend
+    backend = get_backend(name)
+
+
+@timed()
+def load_lrs(lrs, intersections, lrsFilter=''):
+    """ Builds the read-only route and intersection indexes used by the conflation.
+        lrs and intersections are feature classes, or MemoryTables with the numpy
+        backend.  Returns (lrs, lyrIntersections). """
+
+    global dict_LRS_Route_Opposite
+    global routeStore
+    global routeIndex
+    global intersectionIndex
+    global routeIntersections
+    global loadedLRS
+
+    # Sources are compared by identity, except paths and SQL filters
+    key = (lrs, intersections, lrsFilter, backend.name)
+    if loadedLRS is not None and all(a == b if isinstance(a, str) else a is b for a, b in zip(key, loadedLRS)):
+        print('Using the loaded LRS indexes')
+        return lrs, intersections
+
+    print('Loading LRS Routes')
+    routeStore = RouteStore(lrs, backend, lrsFilter)
+    dict_LRS_Route_Opposite = routeStore.opposite
 
+    print('Building LRS Route Index')
+    routeIndex = RouteIndex.from_store(routeStore)
+
+    print('Building Intersection Index')
+    intersectionIndex = IntersectionIndex(intersections, backend)
+
+    print('Loading Route Intersection Table')
+    routeIntersections = RouteIntersectionTable.load_or_build(lrs, routeStore, routeIndex, intersectionIndex)
+    loadedLRS = key
+
+    return lrs, intersections
+
+
+def reset_counts():
+    """ Clears the per-iteration counters at the start of a run """
     global count_firstIteration
     global count_secondIteration
     global count_error
-    global error_list
 
-    global dict_LRS_Route_Opposite
+    count_firstIteration = 0
+    count_secondIteration = 0
+    count_error = 0
+    error_list.clear()
+
+
+def count_result(XDSegID, status):
+    """ Updates the per-iteration counters with the status returned by conflate_segment """
+
+    global count_firstIteration
+    global count_secondIteration
+    global count_error
+
+    if status == 'first':
+        count_firstIteration += 1
+    elif status == 'second':
+        count_secondIteration += 1
+    elif status == 'error':
+        count_error += 1
+        error_list.append(XDSegID)
+
+
+@timed()
+def conflate_segment(XDSeg, lrs, lyrIntersections, firstMatch=None):
+    """ Attempts to locate a single XD segment on the LRS.
+    Input:
+        firstMatch - the (rte_nm, beginMP, endMP) result of bulk_first_iteration for this
+                     segment.  If None, first_iteration is run for the segment.
+    Output:
+        (events, status) - events is a list of [XDSegID, RTE_NM, BEGIN_MSR, END_MSR] records.
+                           status is the iteration that matched the segment ('first' or
+                           'second'), or 'error' if it could not be matched
+    """
 
     output = []
 
     def add_to_output(eventDict, SlipRoad, lrs):
-        log.debug(f'\nAdding Event: {eventDict}')
         XDSegID = eventDict['XDSegID']
         RTE_NM = eventDict['RTE_NM']
         BEGIN_MSR = eventDict['BEGIN_MSR']
@@ -549,447 +644,662 @@ def match_xd_to_lrs(xd, lrs, intersections, xdFilter='', lrsFilter='', printProg
         # Ramps with non-ramp routes that are digitized in reverse are likely errors and should not be added to output
         if SlipRoad in ('1', 1) and RTE_NM is not None:
             if 'RMP' not in RTE_NM and ((RTE_NM[14:16] in ('NB','EB') and BEGIN_MSR > END_MSR) or (RTE_NM[14:16] in ('SB','WB') and BEGIN_MSR < END_MSR)) and RTE_NM not in LRS_RTE_ERRORS__REVERSED_MP:
-                log.debug(f"'{RTE_NM}' is digitized in reverse on a sliproad.  ({BEGIN_MSR} - {END_MSR})Ignoring this event.")
+                if tracing.active:
+                    tracing.trace('fallback', reason='reversed_sliproad', rte_nm=RTE_NM, begin=BEGIN_MSR, end=END_MSR)
                 return
         
         # Ramps where the begin_msr == end_msr are likely an error.  If slip road and RMP has zero length, include the entire RMP route
         if SlipRoad in ('1', 1) and RTE_NM is not None:
             if 'RMP' in RTE_NM and BEGIN_MSR == END_MSR:
-                rmpGeom = [row[0] for row in arcpy.da.SearchCursor(lrs, 'SHAPE@', f"RTE_NM = '{RTE_NM}'")][0]
+                rmpGeom = routeStore.geoms[RTE_NM]
                 rmpBeginPoint = rmpGeom.firstPoint.M
                 rmpEndPoint = rmpGeom.lastPoint.M
                 
                 BEGIN_MSR = rmpBeginPoint
                 END_MSR = rmpEndPoint
+                if tracing.active:
+                    tracing.trace('fallback', reason='zero_length_ramp', rte_nm=RTE_NM)
 
-
+        if tracing.active:
+            tracing.trace('event', rte_nm=RTE_NM, begin=BEGIN_MSR, end=END_MSR)
         output.append([XDSegID, RTE_NM, BEGIN_MSR, END_MSR])
 
 
-    XDFields = ['XDSegID','RoadNumber','RoadName','SlipRoad','SHAPE@']
+    # Each XD Segment is match tested against the LRS in 3 iterations of increasing complexity.
+    # If a single match is found, the next iterations are passed
+
+    #####################
+    ## FIRST ITERATION ##
+    #####################
+    # Find the nearby routes for the begin, middle, and end point of the XD segment.
+    # If only one route appears, then that is considered the likely match.
+    if firstMatch is None:
+        segResults = first_iteration(XDSeg, lrs)
+        if segResults:
+            firstMatch = (segResults, get_point_mp(XDSeg.BeginPoint, lrs, segResults, lyrIntersections), get_point_mp(XDSeg.EndPoint, lrs, segResults, lyrIntersections))
+    elif tracing.active:
+        tracing.trace('first_iteration', bulk=True, result=firstMatch[0])
+
+    segResults, beginMP, endMP = firstMatch or (None, None, None)
+    if segResults:
+        event = {
+            "XDSegID": XDSeg.XDSegID,
+            "RTE_NM": segResults,
+            "BEGIN_MSR": beginMP,
+            "END_MSR": endMP
+        }
+
+        add_to_output(event, XDSeg.SlipRoad, lrs)
+        return output, "first"
+    
+    ######################
+    ## SECOND ITERATION ##
+    ######################
+    # Similar to first_iteration, except the nearby routes are found every d
+    # distance along the line.
+    segResults = second_iteration(XDSeg, lrs)
+    if segResults:
+
+        # If only one result, do hausdorff check to ensure it's not picking up a random route
+        if len(segResults) == 1 and not is_similar_shape(XDSeg.Geom, segResults[0], lrs):
+            if tracing.active:
+                tracing.trace('fallback', reason='not_similar_shape', rte_nm=segResults[0])
+            event = {
+                "XDSegID": XDSeg.XDSegID,
+                "RTE_NM": None,
+                "BEGIN_MSR": None,
+                "END_MSR": None
+            }
+            add_to_output(event, XDSeg.SlipRoad, lrs)
+            
+            return output, "error"
 
-    print('Creating LRS layer')
-    lrs = arcpy.MakeFeatureLayer_management(lrs, "LRS", lrsFilter)
-    lrs = lrs.getOutput(0)
+        # if len(segResults) >= 2 and XDSeg.SlipRoad == '1':
+        #     log.debug('\n        Slip road - removing non-ramps.  Really hope this doens\'t break everything')
 
-    print('Building LRS Opposite Route Dictionary')
-    dict_LRS_Route_Opposite = {row[0]: row[1] for row in arcpy.da.SearchCursor(lrs, ['RTE_NM','RTE_OPPOSITE_DIRECTION_RTE_NM'])}
+        #     for i, route in enumerate(segResults):
+        #         if 'RMP' not in route:
+        #             segResults.pop(i)
+        #     log.debug(f'\n        {segResults}')
 
-    print('Creating Intersection Layer')
-    intersectionResults = arcpy.MakeFeatureLayer_management(intersections, "int")
-    lyrIntersections = intersectionResults.getOutput(0)
+        # If two routes are in results, first make sure that they are acutally two
+        # different routes rather than both directions of the same route, then
+        # attempt to find a common intersection between the two to
+        # ensure that the resulting event table is a single continuous line
+        if len(segResults) == 2:
+            compareResult = compare_route_name_similarity(segResults[0], segResults[1], lrs)
 
-    # These serve no purpose other than to fix a stuid bug in arcpy that prevents
-    # select by attributes and select by location from working on these layers.
-    # The only fix I've found is to hit them both with a search cursor first.
-    DumbWorkaround_Routes = [row[0] for row in arcpy.da.SearchCursor(lrs,'RTE_NM')]
-    DumbWorkaround_Ints = [row[0] for row in arcpy.da.SearchCursor(lyrIntersections, 'INTERSECTION_ID')]
+            if len(compareResult) == 1: # Both directions of the same route found.  We will only use the prime direction
+                                        # Continue as if only one result in segResults
+                segResults = compareResult
 
-    with arcpy.da.SearchCursor(xd, XDFields, xdFilter) as cur:
+            if len(compareResult) != 1: # Two individual routes found.  Continue mapping on two routes
+                commonInt = find_common_intersection(segResults[0], segResults[1], lrs, lyrIntersections, XDSeg)
 
-        for row in cur:
-            XDSeg = XDSegment(row)
-            log.debug(f'\n\n  Processing {XDSeg.XDSegID}')
+                # Get geometry for both routes
+                [route1,route1Geom], [route2,route2Geom] = routeStore.get_routes(segResults)
+                
+                # Find geometry for common int
+                commonIntGeom = None
 
-            # Each XD Segment is match tested against the LRS in 3 iterations of increasing complexity.
-            # If a single match is found, the next iterations are passed
+                if commonInt is not None:
+                    commonIntGeom = intersectionIndex.get_point(commonInt)
+                else:
+                    # Try to find a common non-intersection point between the two route geometries
+                    route1EndPoints = [backend.PointGeometry(route1Geom.firstPoint), backend.PointGeometry(route1Geom.lastPoint)]
+                    route2EndPoints = [backend.PointGeometry(route2Geom.firstPoint), backend.PointGeometry(route2Geom.lastPoint)]
+
+                    for point in route1EndPoints:
+                        for route2Point in route2EndPoints:
+                            dist = point.distanceTo(route2Point)
+                            if dist < 5:
+                                commonIntGeom = point
+                                break
+                        if commonIntGeom is not None:
+                            if tracing.active:
+                                tracing.trace('fallback', reason='common_end_point', routes=[route1, route2])
+                            break
+
+                if commonIntGeom is not None:            
+
+                    # Of these two routes, determine which is closer to the XD begin point
+                    if XDSeg.BeginPoint.distanceTo(route1Geom) < XDSeg.BeginPoint.distanceTo(route2Geom):
+                        firstRoute = route1
+                        secondRoute = route2
+                    else:
+                        firstRoute = route2
+                        secondRoute = route1
+
+                    firstSegment = {
+                        "XDSegID": XDSeg.XDSegID,
+                        "RTE_NM": firstRoute,
+                        "BEGIN_MSR": get_point_mp(XDSeg.BeginPoint, lrs, firstRoute, lyrIntersections),
+                        "END_MSR": get_point_mp(commonIntGeom, lrs, firstRoute, lyrIntersections)
+                    }
+                    
+                    secondSegment = {
+                        "XDSegID": XDSeg.XDSegID,
+                        "RTE_NM": secondRoute,
+                        "BEGIN_MSR": get_point_mp(commonIntGeom, lrs, secondRoute, lyrIntersections),
+                        "END_MSR": get_point_mp(XDSeg.EndPoint, lrs, secondRoute, lyrIntersections)
+                    }
 
-            #####################
-            ## FIRST ITERATION ##
-            #####################
-            # Find the nearby routes for the begin, middle, and end point of the XD segment.
-            # If only one route appears, then that is considered the likely match.
-            segResults = first_iteration(XDSeg, lrs)
-            if segResults:
-                count_firstIteration += 1
-                event = {
-                    "XDSegID": XDSeg.XDSegID,
-                    "RTE_NM": segResults,
-                    "BEGIN_MSR": get_point_mp(XDSeg.BeginPoint, lrs, segResults, lyrIntersections),
-                    "END_MSR": get_point_mp(XDSeg.EndPoint, lrs, segResults, lyrIntersections)
-                }
+                    if tracing.active:
+                        tracing.trace('split', routes=[firstRoute, secondRoute], intersection=commonInt)
 
-                add_to_output(event, XDSeg.SlipRoad, lrs)
-                continue
-            
-            ######################
-            ## SECOND ITERATION ##
-            ######################
-            # Similar to first_iteration, except the nearby routes are found every d
-            # distance along the line.
-            segResults = second_iteration(XDSeg, lrs)
-            if segResults:
-
-                # If only one result, do hausdorff check to ensure it's not picking up a random route
-                if len(segResults) == 1 and not is_similar_shape(XDSeg.Geom, segResults[0], lrs):
-                    log.debug('        Not a similar shape.  Returning None')
+                    add_to_output(firstSegment, XDSeg.SlipRoad, lrs)
+                    add_to_output(secondSegment, XDSeg.SlipRoad, lrs)
+                    
+                    return output, "second"
+                
+                if commonInt is None: # Two different routes that do not share an intersection.  Try to use the route that matches most of the two
+                    if tracing.active:
+                        tracing.trace('fallback', reason='first_route_only', routes=segResults)
                     event = {
                         "XDSegID": XDSeg.XDSegID,
-                        "RTE_NM": None,
-                        "BEGIN_MSR": None,
-                        "END_MSR": None
+                        "RTE_NM": segResults[0],
+                        "BEGIN_MSR": get_point_mp(XDSeg.BeginPoint, lrs, segResults[0], lyrIntersections),
+                        "END_MSR": get_point_mp(XDSeg.EndPoint, lrs, segResults[0], lyrIntersections)
                     }
-                    count_error += 1
-                    error_list.append(XDSeg.XDSegID)
+
                     add_to_output(event, XDSeg.SlipRoad, lrs)
+                    return output, "second"
+
+        if len(segResults) > 2:
+            # For each route in segResults, attempt to find the order that they fall by distance from the
+            # begin point of the XDSegment, then map to LRS.
+            try:
+                rteDirections = Counter()
+                fullRteNmDict = {}
+                for route in segResults:
+                    if route.startswith('S-VA'):
+                        rteNoDirection = route[:7] + route[9:]
+                        rteDirections[rteNoDirection] += 1
+
+                    else:
+                        rteNoDirection = route[:14] + route[16:]
+                        rteDirections[rteNoDirection] += 1
                     
-                    continue
+                    if rteNoDirection not in fullRteNmDict.keys():
+                        fullRteNmDict[rteNoDirection] = [route]
+                    else:
+                        fullRteNmDict[rteNoDirection].append(route)
+
+                segResults = []
+                for route in fullRteNmDict.keys():
+                    if len(fullRteNmDict[route]) == 1:
+                        segResults.append(fullRteNmDict[route][0])
+                    else:
+                        compareResults = compare_route_name_similarity(fullRteNmDict[route][0],fullRteNmDict[route][1],lrs)
+                        for result in compareResults:
+                            segResults.append(result)
+
+                matchedRoutes = []
 
+                for route in segResults:
+                    matchedRoute = MatchedRoute(route, XDSeg, lrs)
+                    matchedRoutes.append(matchedRoute)
+
+                # Sort matched routes
+                matchedRoutes = sorted(matchedRoutes, key=lambda x: x.distanceFromXDSeg)
+                if tracing.active:
+                    tracing.trace('route_order', routes=[route.rte_nm for route in matchedRoutes])
+
+                # Verify that sorted routes share intersections
+                SortingVerified = False
+                try:
+                    for i, route in enumerate(matchedRoutes):
+                        if i < len(matchedRoutes)-1: # Not last route in list
+                            nextRoute = matchedRoutes[i+1]
+                            if find_common_intersection(route.rte_nm, nextRoute.rte_nm,lrs,lyrIntersections,XDSeg) is None:
+                                # Existing order is not correct
+                                if tracing.active:
+                                    tracing.trace('fallback', reason='reorder_by_intersections')
+
+                                # Attempt to create new order
+
+                                ### 02/03/2023 ###
+                                for route in matchedRoutes:
+                                    route.get_ints(lyrIntersections)
+                                # Loop through each route and find matching intersections to create new order
+                                # Route closest to XD Begin point is assumed to be the first route
+
+                                matchedRoutes[0].matchOrder = 0
+                                currentOrder = 1
+                                for match in matchedRoutes:
+                                    
+                                    checkMatches = (m for m in matchedRoutes if m.matchOrder is None)
 
-                count_secondIteration += 1
+                                    for route in checkMatches:
+                                        
+                                        x = list(set(match.intersections).intersection(set(route.intersections)))
+                                        if len(x) == 1:  # If more than one match, this will break since this method won't work anyway
+                                            route.matchOrder = currentOrder
+                                            currentOrder += 1
+                                            break
+
+                                matchedRoutes = sorted(matchedRoutes, key=lambda x: x.matchOrder)
+                                # matchedRoutes[0].matchOrder = 0
+                                # for route in matchedRoutes:
+                                #     if route.matchOrder is not None:
+                                #         for 
+
+                                ### Make this its own function ###
+                                # matchedRoutes[0].distanceToClosestIntersection = 0
+                                # for route in matchedRoutes[1:]:
+                                #     route.get_distance_to_closest_intersection(lyrIntersections, XDSeg)
+                                
+                                # matchedRoutes = sorted(matchedRoutes, key=lambda x: x.distanceToClosestIntersection)
+                                # log.debug(f'              {matchedRoutes}')
+
+                                break
+                        if i == len(matchedRoutes):
+                            # Sorting seems to be accurate
+                            SortingVerified = True
+                except Exception as e:
+                    print(XDSeg.XDSegID, e)
+                    if tracing.active:
+                        tracing.trace('fallback', reason='sorting_verification_failed', error=str(e))
+
+                # Find the begin and end points for each route
+                commonIntsUsed = [] # As intersectinos are used as a common intersection, they will be added here so they won't be used again later.  This is useful for routes that loop back
+                for i, route in enumerate(matchedRoutes):
+                    pointsFound = False
+                    while pointsFound == False:
+                        # Find begin point
+                        if i == 0: # If first point in matchedRoutes
+                            matchedRoutes[i].beginPoint = XDSeg.BeginPoint
+                        else:
+                            matchedRoutes[i].beginPoint = matchedRoutes[i-1].endPoint
+
+                        if route.rte_nm != matchedRoutes[-1].rte_nm: # If a middle route in matchedRoutes
+                            try:
+                                nextRoute_nm = matchedRoutes[i+1].rte_nm
+                                nextRoute_nmGeom = matchedRoutes[i+1].geom
+                            except IndexError: # No more routes to check - the last route in the list has been eliminated
+                                matchedRoutes[i].endPoint = XDSeg.EndPoint
+                                pointsFound = True
+                                break
+                            
+                            # Find closest distance between this route and next route.  If greater than 1m, remove next route
+                            # from potential matches and continue
+                            distanceToNextRoute_nm = route.geom.distanceTo(nextRoute_nmGeom)
+                            if distanceToNextRoute_nm > 1:
+                                if tracing.active:
+                                    tracing.trace('fallback', reason='removed_route', rte_nm=nextRoute_nm, distance=round(distanceToNextRoute_nm, 2))
+                                matchedRoutes.pop(i+1)
+                                continue
+
+                            # Find common intersection between this route and next route
+                            commonInt = find_common_intersection(route.rte_nm, nextRoute_nm, lrs, lyrIntersections, XDSeg, commonIntsUsed)
+                            commonIntsUsed.append(commonInt)
+
+                            if commonInt is None:
+                                raise Exception("No intersection found")
+
+                            commonIntGeom = intersectionIndex.get_point(commonInt)
+
+                            matchedRoutes[i].endPoint = commonIntGeom
+                            pointsFound = True
+                        else: # Last route in matchedRoutes
+                            matchedRoutes[i].endPoint = XDSeg.EndPoint
+                            pointsFound = True
+
+                # Add events to output
+                for route in matchedRoutes:
+                    event = {
+                        "XDSegID": XDSeg.XDSegID,
+                        "RTE_NM": route.rte_nm,
+                        "BEGIN_MSR": get_point_mp(route.beginPoint, lrs, route.rte_nm, lyrIntersections),
+                        "END_MSR": get_point_mp(route.endPoint, lrs, route.rte_nm, lyrIntersections)
+                    }
+                    
+                    add_to_output(event, XDSeg.SlipRoad, lrs)
+                return output, "second"
 
-                # if len(segResults) >= 2 and XDSeg.SlipRoad == '1':
-                #     log.debug('\n        Slip road - removing non-ramps.  Really hope this doens\'t break everything')
+            except Exception as e:
+                print(e)
+                print(traceback.format_exc())
+                if tracing.active:
+                    tracing.trace('fallback', reason='route_ordering_failed', error=str(e))
+        
+        for route in segResults:
+            event = {
+                    "XDSegID": XDSeg.XDSegID,
+                    "RTE_NM": route,
+                    "BEGIN_MSR": get_point_mp(XDSeg.BeginPoint, lrs, route, lyrIntersections),
+                    "END_MSR": get_point_mp(XDSeg.EndPoint, lrs, route, lyrIntersections)
+                }
+            
+            add_to_output(event, XDSeg.SlipRoad, lrs)
+        return output, "second"
+
+    segResults = third_iteration(XDSeg)
+    if segResults:
+        output.append(segResults)
+        return output, None
+
+    event = {
+            "XDSegID": XDSeg.XDSegID,
+            "RTE_NM": None,
+            "BEGIN_MSR": None,
+            "END_MSR": None
+        }
+    
+    add_to_output(event, XDSeg.SlipRoad, lrs)
 
-                #     for i, route in enumerate(segResults):
-                #         if 'RMP' not in route:
-                #             segResults.pop(i)
-                #     log.debug(f'\n        {segResults}')
+    return output, "error"
 
-                # If two routes are in results, first make sure that they are acutally two
-                # different routes rather than both directions of the same route, then
-                # attempt to find a common intersection between the two to
-                # ensure that the resulting event table is a single continuous line
-                if len(segResults) == 2:
-                    log.debug('        Two routes found.  Comparing RTE_NN values for duplicated route...')
-                    compareResult = compare_route_name_similarity(segResults[0], segResults[1], lrs)
 
-                    if len(compareResult) == 1: # Both directions of the same route found.  We will only use the prime direction
-                                                # Continue as if only one result in segResults
-                        segResults = compareResult
+def conflate_segments(XDSegs, lrs, lyrIntersections):
+    """ Conflates a block of XD segments.  The first iteration is run for the whole block
+        at once and only the segments it could not match go through the per-segment
+        iterations.  Returns a list of (XDSeg, events, status) in input order. """
 
-                    if len(compareResult) != 1: # Two individual routes found.  Continue mapping on two routes
-                        log.debug('        Two routes found.  Attempting to find common intersection...')
-                        commonInt = find_common_intersection(segResults[0], segResults[1], lrs, lyrIntersections, XDSeg)
+    count('segments', len(XDSegs))
+    firstMatches = bulk_first_iteration(XDSegs, lrs)
 
-                        # Get geometry for both routes
-                        [route1,route1Geom], [route2,route2Geom] = [[row[0],row[1]] for row in arcpy.da.SearchCursor(lrs, ['rte_nm','SHAPE@'], f"RTE_NM in ('{segResults[0]}','{segResults[1]}')")]
-                        
-                        # Find geometry for common int
-                        commonIntGeom = None
+    results = []
+    for XDSeg, firstMatch in zip(XDSegs, firstMatches):
+        tracing.begin_segment(XDSeg.XDSegID)
+        events, status = conflate_segment(XDSeg, lrs, lyrIntersections, firstMatch)
+        if tracing.active:
+            tracing.trace('result', status=status, events=len(events))
+        tracing.end_segment()
 
-                        if commonInt is not None:
-                            arcpy.management.SelectLayerByAttribute(lyrIntersections,'CLEAR_SELECTION')
-                            commonIntGeom = [row[0] for row in arcpy.da.SearchCursor(lyrIntersections, 'SHAPE@', f'OBJECTID = {commonInt}')][0]
-                        else:
-                            # Try to find a common non-intersection point between the two route geometries
-                            log.debug(f'        No common intersection.  Checking for common geometric point')
-                            route1EndPoints = [arcpy.PointGeometry(route1Geom.firstPoint), arcpy.PointGeometry(route1Geom.lastPoint)]
-                            route2EndPoints = [arcpy.PointGeometry(route2Geom.firstPoint), arcpy.PointGeometry(route2Geom.lastPoint)]
-
-                            for point in route1EndPoints:
-                                for route2Point in route2EndPoints:
-                                    dist = point.distanceTo(route2Point)
-                                    if dist < 5:
-                                        commonIntGeom = point
-                                        break
-                                if commonIntGeom is not None:
-                                    log.debug(f'        Common Geometry Found')
-                                    
-                                    break
+        results.append((XDSeg, events, status))
 
-                        if commonIntGeom is not None:            
-                            log.debug(f'        commonInt: {commonInt}')
-                            log.debug(f'        commonIntGeom: {(commonIntGeom.firstPoint.X, commonIntGeom.firstPoint.Y)}')
+    return results
 
-                            # Of these two routes, determine which is closer to the XD begin point
 
-                            log.debug(f'              XDSeg.BeginPoint: ({XDSeg.BeginPoint.firstPoint.X},{XDSeg.BeginPoint.firstPoint.Y})')
-                            log.debug(f'              {[route1,route1Geom], [route2,route2Geom]}')
-                            log.debug(f'              {XDSeg.BeginPoint.distanceTo(route1Geom)}')
-                            log.debug(f'              {XDSeg.BeginPoint.distanceTo(route2Geom)}')
+def iter_blocks(rows, blockSize=None):
+    """ Yields lists of up to blockSize rows from the input iterable """
+    blockSize = blockSize or FIRST_PASS_BLOCK_SIZE
+    block = []
+    for row in rows:
+        block.append(row)
+        if len(block) == blockSize:
+            yield block
+            block = []
 
+    if block:
+        yield block
 
-                            if XDSeg.BeginPoint.distanceTo(route1Geom) < XDSeg.BeginPoint.distanceTo(route2Geom):
-                                firstRoute = route1
-                                secondRoute = route2
-                            else:
-                                firstRoute = route2
-                                secondRoute = route1
-                            
 
-                            firstSegment = {
-                                "XDSegID": XDSeg.XDSegID,
-                                "RTE_NM": firstRoute,
-                                "BEGIN_MSR": get_point_mp(XDSeg.BeginPoint, lrs, firstRoute, lyrIntersections),
-                                "END_MSR": get_point_mp(commonIntGeom, lrs, firstRoute, lyrIntersections)
-                            }
-                            
-                            secondSegment = {
-                                "XDSegID": XDSeg.XDSegID,
-                                "RTE_NM": secondRoute,
-                                "BEGIN_MSR": get_point_mp(commonIntGeom, lrs, secondRoute, lyrIntersections),
-                                "END_MSR": get_point_mp(XDSeg.EndPoint, lrs, secondRoute, lyrIntersections)
-                            }
-
-                            log.debug(f'        firstSegment: {firstRoute}')
-                            log.debug(f'          {firstSegment}')
-                            log.debug(f'          XDSeg.BeginPoint: ({XDSeg.BeginPoint.firstPoint.X},{XDSeg.BeginPoint.firstPoint.Y})')
-                            log.debug(f'          commonIntGeom: ({commonIntGeom.firstPoint.X},{commonIntGeom.firstPoint.Y})')
-
-                            log.debug(f'        secondSegment: {secondRoute}')
-                            log.debug(f'          {secondSegment}')
-                            log.debug(f'          commonIntGeom: ({commonIntGeom.firstPoint.X},{commonIntGeom.firstPoint.Y})')
-                            log.debug(f'          XDSeg.EndPoint: ({XDSeg.EndPoint.firstPoint.X},{XDSeg.EndPoint.firstPoint.Y})')
-
-                            add_to_output(firstSegment, XDSeg.SlipRoad, lrs)
-                            add_to_output(secondSegment, XDSeg.SlipRoad, lrs)
-                            
-                            continue
-                        
-                        if commonInt is None: # Two different routes that do not share an intersection.  Try to use the route that matches most of the two
-                            log.debug('        No common routes.  Taking the first (most common) and hoping for the best')
-                            event = {
-                                "XDSegID": XDSeg.XDSegID,
-                                "RTE_NM": segResults[0],
-                                "BEGIN_MSR": get_point_mp(XDSeg.BeginPoint, lrs, segResults[0], lyrIntersections),
-                                "END_MSR": get_point_mp(XDSeg.EndPoint, lrs, segResults[0], lyrIntersections)
-                            }
-
-                            add_to_output(event, XDSeg.SlipRoad, lrs)
-                            continue
-                
+def match_xd_to_lrs(xd, lrs, intersections, xdFilter='', lrsFilter='', printProgress=False, workers=1, shardField=None, geometryBackend=None, writer=None, skip=None):
+    """ For each xd segment in input xd, attempt to locate on the lrs.  If unable to locate,
+        the record will contain null values for all except XDSegID.
 
-                    
+        If writer is given (see event_writer.EventWriter), the events are written to it as
+        the segments finish instead of being collected, and an empty list is returned.
+        Segments already in the writer's checkpoint are skipped, as are the XDSegIDs in skip.
 
-                if len(segResults) > 2:
-                    # For each route in segResults, attempt to find the order that they fall by distance from the
-                    # begin point of the XDSegment, then map to LRS.
-                    try:
+        If workers > 1, the XD segments are split into shards that are conflated in a
+        process pool.  See match_xd_to_lrs_parallel.
 
+        geometryBackend is 'arcpy' or 'numpy'.  MemoryTable inputs use the numpy backend
+        unless told otherwise. """
 
-                        log.debug('\n        More than two routes found.  Searching for same routes with both directions.\n')
+    if geometryBackend or isinstance(xd, MemoryTable):
+        set_backend(geometryBackend or 'numpy')
 
-                        rteDirections = Counter()
-                        fullRteNmDict = {}
-                        for route in segResults:
-                            if route.startswith('S-VA'):
-                                rteNoDirection = route[:7] + route[9:]
-                                rteDirections[rteNoDirection] += 1
+    if workers > 1:
+        return match_xd_to_lrs_parallel(xd, lrs, intersections, xdFilter, lrsFilter, workers, shardField, writer, skip)
 
-                            else:
-                                rteNoDirection = route[:14] + route[16:]
-                                rteDirections[rteNoDirection] += 1
-                            
-                            if rteNoDirection not in fullRteNmDict.keys():
-                                fullRteNmDict[rteNoDirection] = [route]
-                            else:
-                                fullRteNmDict[rteNoDirection].append(route)
-                        
-
-                        
-                        segResults = []
-                        for route in fullRteNmDict.keys():
-                            if len(fullRteNmDict[route]) == 1:
-                                segResults.append(fullRteNmDict[route][0])
-                            else:
-                                compareResults = compare_route_name_similarity(fullRteNmDict[route][0],fullRteNmDict[route][1],lrs)
-                                for result in compareResults:
-                                    segResults.append(result)
-                        
-                        
-                        
-                        
-                        log.debug('\n        More than two routes found.  Attempting to order results for better mapping.\n')
-
-
-
-
-
-
-
-                        matchedRoutes = []
-
-                        log.debug(f'          segResults: {segResults}')
-                        for route in segResults:
-                            matchedRoute = MatchedRoute(route, XDSeg, lrs)
-                            matchedRoutes.append(matchedRoute)
-
-                        log.debug(f'          {matchedRoute}')
-                        # Sort matched routes
-                        log.debug(f'          Sorted by distance from begin point:')
-                        matchedRoutes = sorted(matchedRoutes, key=lambda x: x.distanceFromXDSeg)
-                        log.debug(f'          {matchedRoutes}')
-
-                        # Verify that sorted routes share intersections
-                        log.debug(f'\n          Verifying sorting...')
-                        SortingVerified = False
-                        try:
-                            for i, route in enumerate(matchedRoutes):
-                                if i < len(matchedRoutes)-1: # Not last route in list
-                                    nextRoute = matchedRoutes[i+1]
-                                    if find_common_intersection(route.rte_nm, nextRoute.rte_nm,lrs,lyrIntersections,XDSeg) is None:
-                                        # Existing order is not correct
-                                        log.debug(f'            ...Sorting does not seem to be accurate')
-
-                                        # Attempt to create new order
-
-                                        ### 02/03/2023 ###
-                                        for route in matchedRoutes:
-                                            route.get_ints(lyrIntersections)
-                                        # Loop through each route and find matching intersections to create new order
-                                        # Route closest to XD Begin point is assumed to be the first route
-
-                                        matchedRoutes[0].matchOrder = 0
-                                        currentOrder = 1
-                                        for match in matchedRoutes:
-                                            
-                                            checkMatches = (m for m in matchedRoutes if m.matchOrder is None)
-
-                                            for route in checkMatches:
-                                                
-                                                x = list(set(match.intersections).intersection(set(route.intersections)))
-                                                if len(x) == 1:  # If more than one match, this will break since this method won't work anyway
-                                                    route.matchOrder = currentOrder
-                                                    currentOrder += 1
-                                                    break
-                                        
+    lrs, lyrIntersections = load_lrs(lrs, intersections, lrsFilter)
+    done = get_done(writer, skip)
+
+    output = []
+    with search_cursor(xd, XDFields, xdFilter) as cur:
+        for rows in iter_blocks(row for row in cur if str(row[0]) not in done):
+            for XDSeg, events, status in conflate_segments([XDSegment(row) for row in rows], lrs, lyrIntersections):
+                count_result(XDSeg.XDSegID, status)
+                if writer:
+                    writer.write(events, (XDSeg.XDSegID, status))
+                else:
+                    output += events
+    
+    return output
 
-                                        matchedRoutes = sorted(matchedRoutes, key=lambda x: x.matchOrder)
-                                        # matchedRoutes[0].matchOrder = 0
-                                        # for route in matchedRoutes:
-                                        #     if route.matchOrder is not None:
-                                        #         for 
 
-                                        ### Make this its own function ###
-                                        # matchedRoutes[0].distanceToClosestIntersection = 0
-                                        # for route in matchedRoutes[1:]:
-                                        #     route.get_distance_to_closest_intersection(lyrIntersections, XDSeg)
-                                        
-                                        # matchedRoutes = sorted(matchedRoutes, key=lambda x: x.distanceToClosestIntersection)
-                                        # log.debug(f'              {matchedRoutes}')
-                                        
+def get_done(writer, skip=None):
+    """ Returns the XDSegIDs (as str) to leave out of a run: those already conflated by a
+        resumed run, plus skip """
+    done = set(str(XDSegID) for XDSegID in skip) if skip else set()
+    if writer is not None and writer.checkpoint is not None:
+        done |= writer.checkpoint.done
 
+    return done
 
 
-                                        break
-                                if i == len(matchedRoutes):
-                                    # Sorting seems to be accurate
-                                    log.debug(f'            ...Sorting verified')
-                                    SortingVerified = True
-                        except Exception as e:
-                            print(XDSeg.XDSegID, e)
-                            log.debug('            Sorting Verification Failed')
-
-
-                        # Find the begin and end points for each route
-                        commonIntsUsed = [] # As intersectinos are used as a common intersection, they will be added here so they won't be used again later.  This is useful for routes that loop back
-                        for i, route in enumerate(matchedRoutes):
-                            pointsFound = False
-                            while pointsFound == False:
-                                log.debug(f'\n        Attempting to find begin and end points for {route}')
-                                # Find begin point
-                                if i == 0: # If first point in matchedRoutes
-                                    matchedRoutes[i].beginPoint = XDSeg.BeginPoint
-                                else:
-                                    matchedRoutes[i].beginPoint = matchedRoutes[i-1].endPoint
-                                    log.debug(f'          BeginPoint: {(matchedRoutes[i].beginPoint.firstPoint.X, matchedRoutes[i].beginPoint.firstPoint.Y)}')
-
-                                if route.rte_nm != matchedRoutes[-1].rte_nm: # If a middle route in matchedRoutes
-                                    try:
-                                        nextRoute_nm = matchedRoutes[i+1].rte_nm
-                                        nextRoute_nmGeom = matchedRoutes[i+1].geom
-                                    except IndexError: # No more routes to check - the last route in the list has been eliminated
-                                        matchedRoutes[i].endPoint = XDSeg.EndPoint
-                                        pointsFound = True
-                                        break
-                                    
-                                    # Find closest distance between this route and next route.  If greater than 1m, remove next route
-                                    # from potential matches and continue
-                                    distanceToNextRoute_nm = route.geom.distanceTo(nextRoute_nmGeom)
-                                    log.debug(f'          Distance to next rte_nm: {distanceToNextRoute_nm}')
-                                    if distanceToNextRoute_nm > 1:
-                                        log.debug(f"          '{nextRoute_nm}' does not appear to intersect '{route.rte_nm}'.")
-                                        log.debug(f"            Removing '{nextRoute_nm}'.")
-                                        matchedRoutes.pop(i+1)
-                                        continue
-                                    
-                                    log.debug(f"          Attempting to find common int between '{route.rte_nm}' and '{nextRoute_nm}'.")
+def get_shards(rows, xd, xdFilter='', workers=1, shardField=None):
+    """ Splits the XD segments into shards for match_xd_to_lrs_parallel.
+    Input:
+        rows - (OID, shardField value) records of the XD segments to split
+        shardField - if given (eg 'Batch'), there will be one shard per value of the field.
+                     Otherwise the segments are split into contiguous OBJECTID ranges.
+    Output:
+        a list of where clauses, one per shard.  These are filter functions for a MemoryTable.
+    """
 
-                                    # Find common intersection between this route and next route
-                                    commonInt = find_common_intersection(route.rte_nm, nextRoute_nm, lrs, lyrIntersections, XDSeg, commonIntsUsed)
-                                    commonIntsUsed.append(commonInt)
+    if isinstance(xd, MemoryTable):
+        if shardField:
+            values = sorted({row[1] for row in rows}, key=lambda value: (value is None, str(value)))
+            return [ValueFilter(shardField, value, xdFilter) for value in values]
+
+        oids = sorted(row[0] for row in rows)
+        shardSize = max(1, math.ceil(len(oids) / (workers * 4)))
+        return [RangeFilter(xd.OIDFieldName, oids[i], oids[min(i + shardSize, len(oids)) - 1], xdFilter) for i in range(0, len(oids), shardSize)]
+
+    def combine(where):
+        if xdFilter:
+            return f'({xdFilter}) AND ({where})'
+        return where
+
+    if shardField:
+        shards = []
+        values = sorted({row[1] for row in rows}, key=lambda value: (value is None, str(value)))
+        for value in values:
+            if value is None:
+                shards.append(combine(f"{shardField} IS NULL"))
+            elif isinstance(value, str):
+                shards.append(combine(f"{shardField} = '{value.replace(chr(39), chr(39) * 2)}'"))
+            else:
+                shards.append(combine(f"{shardField} = {value}"))
+        return shards
 
-                                    if commonInt is None:
-                                        raise Exception("No intersection found")
+    # Several shards per worker so that one slow shard doesn't hold up the pool
+    oidField = arcpy.Describe(xd).OIDFieldName
+    oids = sorted(row[0] for row in rows)
+    shardSize = max(1, math.ceil(len(oids) / (workers * 4)))
 
-                                    arcpy.management.SelectLayerByAttribute(lyrIntersections,'CLEAR_SELECTION')
-                                    commonIntGeom = [row[0] for row in arcpy.da.SearchCursor(lyrIntersections, 'SHAPE@', f'OBJECTID = {commonInt}')][0]
+    shards = []
+    for i in range(0, len(oids), shardSize):
+        chunk = oids[i:i + shardSize]
+        shards.append(combine(f'{oidField} >= {chunk[0]} AND {oidField} <= {chunk[-1]}'))
 
-                                    log.debug(f'          commonInt: {commonInt}')
-                                    log.debug(f'          commonIntGeom: {(commonIntGeom.firstPoint.X, commonIntGeom.firstPoint.Y)}')
-                                    matchedRoutes[i].endPoint = commonIntGeom
-                                    pointsFound = True
-                                else: # Last route in matchedRoutes
-                                    matchedRoutes[i].endPoint = XDSeg.EndPoint
-                                    pointsFound = True
-                            
-                                                
-                        # Add events to output
-                        for route in matchedRoutes:
-                            event = {
-                                "XDSegID": XDSeg.XDSegID,
-                                "RTE_NM": route.rte_nm,
-                                "BEGIN_MSR": get_point_mp(route.beginPoint, lrs, route.rte_nm, lyrIntersections),
-                                "END_MSR": get_point_mp(route.endPoint, lrs, route.rte_nm, lyrIntersections)
-                            }
-                            
-                            add_to_output(event, XDSeg.SlipRoad, lrs)
-                        continue
+    return shards
 
-                    except Exception as e:
-                        print(e)
-                        print(traceback.format_exc())
-                        log.debug('        Route ordering failed - mapping on LRS without ordering')
-                
-                for route in segResults:
-                    event = {
-                            "XDSegID": XDSeg.XDSegID,
-                            "RTE_NM": route,
-                            "BEGIN_MSR": get_point_mp(XDSeg.BeginPoint, lrs, route, lyrIntersections),
-                            "END_MSR": get_point_mp(XDSeg.EndPoint, lrs, route, lyrIntersections)
-                        }
-                    
-                    add_to_output(event, XDSeg.SlipRoad, lrs)
-                continue
 
-            segResults = third_iteration(XDSeg)
-            if segResults:
-                output.append(segResults)
-                continue
+# The LRS and intersection layers of a worker process and the XDSegIDs it should skip, set by init_worker
+workerLayers = None
+workerDone = set()
+
+
+def init_worker(lrs, intersections, lrsFilter, logPath, backendName, done=None, trace=None, profile=False):
+    """ Process pool initializer.  Each worker builds its own read-only copy of the
+        LRS indexes and logs and traces to its own files. """
+    global workerLayers
+    global workerDone
+
+    set_backend(backendName)
+    metrics.ENABLED = profile
+
+    log.handlers.clear()
+    if logPath:
+        log.addHandler(logging.FileHandler(f'{os.path.splitext(logPath)[0]}_{os.getpid()}.log', mode='w', delay=True))
+
+    if trace:
+        tracePath, xdSegIDs = trace
+        tracing.start(f'{os.path.splitext(tracePath)[0]}_{os.getpid()}.jsonl', xdSegIDs)
+
+    workerLayers = load_lrs(lrs, intersections, lrsFilter)
+    workerDone = done or set()
+
+
+def run_shard(xd, shardFilter):
+    """ Conflates the XD segments of one shard in a worker process.  Returns a list of
+        (OID, XDSegID, events, status) in search cursor order, and the metrics of the shard """
+    lrs, lyrIntersections = workerLayers
+    metrics.reset()
+
+    results = []
+    with search_cursor(xd, ['OID@'] + XDFields, shardFilter) as cur:
+        for rows in iter_blocks(row for row in cur if str(row[1]) not in workerDone):
+            segResults = conflate_segments([XDSegment(row[1:]) for row in rows], lrs, lyrIntersections)
+            for row, (XDSeg, events, status) in zip(rows, segResults):
+                results.append((row[0], XDSeg.XDSegID, events, status))
+
+    tracing.flush()
+    return results, metrics.get_metrics()
+
+
+def match_xd_to_lrs_parallel(xd, lrs, intersections, xdFilter='', lrsFilter='', workers=None, shardField=None, writer=None, skip=None):
+    """ Conflates the XD segments in shards on a process pool.  Each worker builds its
+        own copy of the LRS indexes.
+
+        Each XD segment is conflated independently, so the results and counters are
+        merged in the order the serial search cursor would have processed the segments.
+        This gives the same output as the serial match_xd_to_lrs.
+
+        Results are merged as soon as every segment before them in that order is done,
+        so with a writer the events are written and checkpointed as the run goes.
+        OBJECTID range shards usually finish close to that order.  Shards by shardField
+        interleave in it, so more of their results wait for the shards still running. """
+
+    workers = workers or os.cpu_count()
+
+    done = get_done(writer, skip)
+    shardFields = (['OID@', shardField] if shardField else ['OID@']) + ['XDSegID']
+    rows = [row for row in search_cursor(xd, shardFields, xdFilter) if str(row[-1]) not in done]
+    order = {row[0]: i for i, row in enumerate(rows)}
+    shards = get_shards(rows, xd, xdFilter, workers, shardField)
+
+    logPath = next((handler.baseFilename for handler in log.handlers if isinstance(handler, logging.FileHandler)), None)
+
+    print(f'Conflating {len(rows)} XD segments in {len(shards)} shards on {workers} workers')
+    output = []
+
+    # Results that arrived before the segments ahead of them in search cursor order
+    waiting = {}
+    nextIndex = 0
+
+    def merge(results):
+        nonlocal nextIndex
+        for result in results:
+            waiting[order[result[0]]] = result
+
+        while nextIndex in waiting:
+            oid, XDSegID, events, status = waiting.pop(nextIndex)
+            nextIndex += 1
+            count_result(XDSegID, status)
+            if writer:
+                writer.write(events, (XDSegID, status))
+            else:
+                output.extend(events)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(lrs, intersections, lrsFilter, logPath, backend.name, done, tracing.get_settings(), metrics.ENABLED)) as executor:
+        futures = [executor.submit(run_shard, xd, shard) for shard in shards]
+        for future in as_completed(futures):
+            shardResults, shardMetrics = future.result()
+            metrics.merge(shardMetrics)
+            merge(shardResults)
+
+    # A segment that no shard returned would hold up the rest, so whatever is left is merged in order
+    while waiting:
+        nextIndex = min(waiting)
+        merge([])
 
-            
-            count_error += 1
-            error_list.append(XDSeg.XDSegID)
-            event = {
-                    "XDSegID": XDSeg.XDSegID,
-                    "RTE_NM": None,
-                    "BEGIN_MSR": None,
-                    "END_MSR": None
-                }
-            
-            add_to_output(event, XDSeg.SlipRoad, lrs)
-    
     return output
 
 
-def run_conflation(conflationName, outputCSV, xd, lrs, intersections, xdFilter='', lrsFilter='', printProgress=False):
+def describe_source(source):
+    """ Returns a description of an input or filter that can be saved in a checkpoint.  Paths
+        and SQL filters are saved as they are. """
+    if source is None or isinstance(source, str):
+        return source
+    if callable(source):
+        return getattr(source, '__qualname__', type(source).__name__)
+    if hasattr(source, '__len__'):
+        return f'{type(source).__name__} of {len(source)} rows'
+    return type(source).__name__
+
+
+def start_trace(conflationName, trace):
+    """ Starts tracing to Logs/{conflationName}_trace.jsonl.  trace is True for every
+        XD segment, a list of XDSegIDs, or None for no tracing. """
+    if trace is True:
+        tracing.start(tracing.get_trace_path(conflationName))
+    elif trace:
+        tracing.start(tracing.get_trace_path(conflationName), trace)
+
+
+def run_conflation(conflationName, outputCSV, xd, lrs, intersections, xdFilter='', lrsFilter='', printProgress=False, workers=1, shardField=None, geometryBackend=None, resume=True, trace=None, events=None, profile=False):
+    """ Conflates the XD segments and writes the events to outputCSV.  Progress is
+        checkpointed as the events are written, so if a run with the same conflationName
+        and outputCSV was killed, it is resumed unless resume is False.
+
+        trace is True to record the decisions made for every XD segment in
+        Logs/{conflationName}_trace.jsonl, or a list of the XDSegIDs to record.
+        See the tracing module.
+
+        profile turns on the timing instrumentation for this run and the flipRoutes and
+        AutoQC stages after it, and saves it to Logs/{conflationName}_metrics.json.
+        See the metrics module.
+
+        If events is a list, the events are also added to it as they are written, for the
+        next stage of a pipeline (see RunConflation.start).  A resumed run adds the events
+        already in outputCSV first.
+
+        Returns the XD manifest saved with outputCSV. """
     global log
 
     start = datetime.now()
+    metrics.ENABLED = profile
+    metrics.reset()
+    reset_counts()
 
-    fileHandler = logging.FileHandler(f'Logs\{conflationName}.log', mode='w')
+    fileHandler = logging.FileHandler(os.path.join('Logs', f'{conflationName}.log'), mode='w')
     log.handlers.clear()
     log.addHandler(fileHandler)
-    
-    conflationResults = match_xd_to_lrs(xd, lrs, intersections, xdFilter, lrsFilter, printProgress)
-    log.debug(conflationResults)
+    start_trace(conflationName, trace)
 
-    df = pd.DataFrame(conflationResults, columns=['XDSegID','RTE_NM','BEGIN_MSR','END_MSR'])
-    print(df)
+    # Restore the counters of the segments conflated before the run was interrupted.  A run
+    # with different inputs or filters starts over.
+    settings = {name: describe_source(source) for name, source in [('xd', xd), ('lrs', lrs), ('intersections', intersections), ('xdFilter', xdFilter), ('lrsFilter', lrsFilter)]}
+    checkpoint = Checkpoint(conflationName, outputCSV, resume, settings)
+    for XDSegID, status in checkpoint.segments:
+        count_result(XDSegID, status)
 
-    df.to_csv(outputCSV, index=False)
+    # Events are streamed to the output as the segments finish.  outputCSV can also be a .parquet directory
+    try:
+        with EventWriter(outputCSV, checkpoint=checkpoint, events=events) as writer:
+            match_xd_to_lrs(xd, lrs, intersections, xdFilter, lrsFilter, printProgress, workers, shardField, geometryBackend, writer)
+    finally:
+        tracing.stop()
+    print(f'Wrote {writer.count} events to {outputCSV}')
 
+    # Save the XD manifest so that the next XD release can be conflated incrementally
+    manifest = build_manifest(xd, xdFilter)
+    save_manifest(manifest, get_manifest_path(outputCSV))
+
+    log_conflation_results(conflationName, start)
+
+    return manifest
+
+
+def log_conflation_results(conflationName, start):
+    """ Logs the run time and iteration counts of run_conflation and saves its metrics """
     end = datetime.now()
     log.info(f'\n\nRun Time: {end - start}')
     count_total = sum([count_firstIteration, count_secondIteration, count_error])
@@ -999,6 +1309,85 @@ def run_conflation(conflationName, outputCSV, xd, lrs, intersections, xdFilter='
     log.info(f'    Third Iteration: N/A, 0%')
     log.info(f'    Error: {count_error}, {round(count_error/count_total*100)}%')
 
+    metrics.add_time('run_conflation', (end - start).total_seconds())
+    metrics.save_metrics(conflationName)
+
+
+def run_incremental_conflation(conflationName, outputCSV, previousCSV, xd, lrs, intersections, xdFilter='', lrsFilter='', workers=1, shardField=None, geometryBackend=None, previousLRS=None, trace=None, events=None, profile=False):
+    """ Conflates a new XD map release using the output of a previous run.  The XD segments
+        are hashed and compared to the manifest saved with previousCSV.  Only new or changed
+        segments are run through match_xd_to_lrs.  The events of unchanged segments are
+        carried forward from previousCSV, and removed segments are dropped.
+
+        If previousLRS (the LRS used by the previous run) is given, the two LRS versions are
+        compared route by route and the XD segments touching changed routes are re-conflated
+        as well.  See lrs_diff.find_lrs_affected_segments.
+
+        The output is in XD search cursor order, the same as a full run.  If there is no
+        previous manifest, every segment is conflated.
+
+        Returns the set of XDSegIDs (as str) that were re-conflated, so that flipRoutes and
+        AutoQC can be re-run for only those segments.  trace, events and profile are the same
+        as for run_conflation. """
+    global log
+
+    start = datetime.now()
+    metrics.ENABLED = profile
+    metrics.reset()
+    reset_counts()
+
+    fileHandler = logging.FileHandler(os.path.join('Logs', f'{conflationName}.log'), mode='w')
+    log.handlers.clear()
+    log.addHandler(fileHandler)
+
+    print('Comparing XD segments to the previous run')
+    manifest = build_manifest(xd, xdFilter)
+    previousManifest = load_manifest(get_manifest_path(previousCSV))
+    if previousManifest is None:
+        print(f'  No manifest found for {previousCSV}.  Conflating every segment')
+    new, changed, unchanged, removed = diff_manifests(previousManifest, manifest)
+    print(f'  New: {len(new)}  Changed: {len(changed)}  Unchanged: {len(unchanged)}  Removed: {len(removed)}')
+
+    previousEvents = read_events(previousCSV) if unchanged else []
+
+    if previousLRS is not None and unchanged:
+        changes, affected = find_lrs_affected_segments(previousLRS, lrs, xd, previousEvents, xdFilter, lrsFilter)
+        save_lrs_changes(changes, f'{os.path.splitext(outputCSV)[0]}_lrs_changes.json')
+        affected &= unchanged
+        unchanged -= affected
+        print(f'  Affected by LRS changes: {len(affected)}')
+
+    carried = [event for event in previousEvents if event[0] in unchanged]
+
+    start_trace(conflationName, trace)
+    try:
+        conflationResults = match_xd_to_lrs(xd, lrs, intersections, xdFilter, lrsFilter, False, workers, shardField, geometryBackend, skip=unchanged)
+    finally:
+        tracing.stop()
+
+    # Merge the carried forward and new events in search cursor order
+    order = {XDSegID: i for i, XDSegID in enumerate(manifest)}
+    output = sorted(carried + conflationResults, key=lambda event: order[str(event[0])])
+
+    with EventWriter(outputCSV, events=events) as writer:
+        writer.write(output)
+    print(f'Wrote {writer.count} events to {outputCSV}.  {len(carried)} carried forward from {previousCSV}')
+
+    save_manifest(manifest, get_manifest_path(outputCSV))
+
+    end = datetime.now()
+    log.info(f'\n\nRun Time: {end - start}')
+    log.info(f'  Carried forward {len(unchanged)} unchanged XD Segments and dropped {len(removed)} removed XD Segments')
+    log.info(f'  Processed {len(new) + len(changed)} new and changed XD Segments')
+    log.info(f'    First Iteration: {count_firstIteration}')
+    log.info(f'    Second Iteration: {count_secondIteration}')
+    log.info(f'    Error: {count_error}')
+
+    metrics.add_time('run_incremental_conflation', (end - start).total_seconds())
+    metrics.save_metrics(conflationName)
+
+    return set(manifest) - unchanged
+
 
 
 if __name__ == '__main__':